@@ -0,0 +1,414 @@
+"""Micro-benchmarks for the training and evaluation hot paths, run with e.g. `python benchmark.py next_batch`"""
+import os
+import argparse
+import multiprocessing
+import time
+import tracemalloc
+import numpy as np
+
+from dataset.base import Dataset
+from job.prediction_store import PredictionStore
+from utilities.augmentation import apply_image_aug
+
+
+class SyntheticDataset(Dataset):
+    """`Dataset` over random in-memory arrays, skipping all file loading"""
+
+    def __init__(self, num_images=20, height=584, width=565, batch_size=4, seq=None, sgd=True, num_batch_buffers=1,
+                 patch_size=None, patch_sampling="random", vessel_oversample=0.0):
+        self.batch_size = batch_size
+        self.sgd = sgd
+        self.seq = seq
+        random_state = np.random.RandomState(0)
+        images = random_state.rand(num_images, height, width).astype(np.float32)
+        masks = (random_state.rand(num_images, height, width) > .1).astype(np.float32)
+        targets = (random_state.rand(num_images, height, width) > .9).astype(np.float32)
+        self.train_data = (images, masks, targets)
+        self.pointer = 0
+        self.num_batch_buffers = num_batch_buffers
+        self.batch_buffers = None
+        self.patch_size = (patch_size, patch_size) if patch_size is not None else None
+        self.patch_sampling = patch_sampling
+        self.vessel_oversample = vessel_oversample
+        self.patch_center_candidates = {}
+
+    def get_pads(self):
+        return 0, 0, 0, 0
+
+
+def legacy_next_batch(dataset, random_state):
+    """Batch assembly as it was done before the reusable batch buffers, for comparison"""
+    images, masks, targets = [], [], []
+    samples = random_state.choice(len(dataset.train_data[0]), dataset.batch_size)
+    for i in samples:
+        images.append(np.array(dataset.train_data[0][i]))
+        masks.append(np.array(dataset.train_data[1][i]))
+        targets.append(np.array(dataset.train_data[2][i]))
+    if dataset.seq is not None:
+        seq_det = dataset.get_seq_det(random_state)
+        images = apply_image_aug(images, seq_det)
+        masks = apply_image_aug(masks, seq_det, masks=True)
+        targets = apply_image_aug(targets, seq_det, masks=True)
+    return np.array(images), np.array(masks), np.array(targets)
+
+
+def time_batches(next_batch_fn, num_batches):
+    """Return the mean time and the mean peak of newly allocated memory per batch"""
+    next_batch_fn()
+    times = []
+    peaks = []
+    for _ in range(num_batches):
+        tracemalloc.start()
+        start = time.time()
+        next_batch_fn()
+        times.append(time.time() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return np.mean(times), np.mean(peaks)
+
+
+def benchmark_next_batch(args):
+    seq = None
+    if args.augment:
+        from imgaug import augmenters as iaa
+        seq = iaa.Sequential([iaa.Fliplr(.5), iaa.Affine(rotate=(-90, 90), mode="constant", cval=0)])
+    dataset = SyntheticDataset(num_images=args.num_images, height=args.height, width=args.width,
+                               batch_size=args.batch_size, seq=seq)
+    random_state = np.random.RandomState(0)
+    results = [("legacy", time_batches(lambda: legacy_next_batch(dataset, random_state), args.num_batches)),
+               ("buffered", time_batches(lambda: dataset.next_batch(random_state), args.num_batches))]
+    if args.patch_size is not None:
+        patch_dataset = SyntheticDataset(num_images=args.num_images, height=args.height, width=args.width,
+                                         batch_size=args.patches_per_batch, seq=seq, patch_size=args.patch_size,
+                                         patch_sampling="mask", vessel_oversample=.5)
+        results.append(("patches {}x{}x{}".format(args.patches_per_batch, args.patch_size, args.patch_size),
+                        time_batches(lambda: patch_dataset.next_batch(random_state), args.num_batches)))
+    for name, (batch_time, batch_peak) in results:
+        print("{}: {:.2f} ms/batch, {:.1f} MB allocated/batch".format(name, batch_time * 1000,
+                                                                      batch_peak / float(1 << 20)))
+
+
+def time_runs(run_fn, num_runs):
+    run_fn()
+    start = time.time()
+    for _ in range(num_runs):
+        run_fn()
+    return (time.time() - start) / num_runs
+
+
+def benchmark_export(args):
+    import tempfile
+    import tensorflow as tf
+    from network.drive import DriveNetwork
+    from network.dsa import DsaNetwork
+    from network.export import export_inference_graph, InferenceGraph
+
+    network_clss = {"drive": DriveNetwork, "dsa": DsaNetwork}
+    for name in args.networks:
+        network_cls = network_clss[name]
+        compute_precision = network_cls.get_device_compute_precision(args.precision, args.gpu_device)
+        graph = tf.Graph()
+        with graph.as_default(), tf.device(args.gpu_device):
+            network = network_cls(pos_weight=1.0, precision=args.precision, compute_precision=compute_precision)
+            sess = tf.Session()
+            sess.run(tf.global_variables_initializer())
+            image = np.random.rand(1, network.input_height, network.input_width).astype(np.float32)
+            mask = np.ones((1, network.output_height, network.output_width), dtype=np.float32)
+            feed_dict = {network.inputs: image[..., np.newaxis]}
+            if network.mask:
+                feed_dict[network.masks] = mask[..., np.newaxis]
+            train_graph_time = time_runs(lambda: sess.run(network.segmentation_result, feed_dict=feed_dict),
+                                         args.num_runs)
+            export_path = os.path.join(tempfile.mkdtemp(), "{}.pb".format(name))
+            export_inference_graph(network, sess, export_path, device=args.gpu_device)
+            sess.close()
+        inference_graph = InferenceGraph(export_path, gpu_device=args.gpu_device)
+        inference_graph_time = time_runs(lambda: inference_graph.run(image, mask), args.num_runs)
+        inference_graph.close()
+        print("{}: training graph {:.1f} ms/image, exported graph {:.1f} ms/image".format(
+            name, train_graph_time * 1000, inference_graph_time * 1000))
+
+
+def benchmark_metrics(args):
+    from job.base import Job
+    from metrics.histogram import ScoreHistogram, get_histogram_metric_scores
+
+    random_state = np.random.RandomState(0)
+    target_flat = (random_state.rand(args.num_pixels) > .88).astype(np.float32)
+    prediction_flat = np.clip(random_state.normal(.25 + .5 * target_flat, .2), 0, 1).astype(np.float32)
+    mask_flat = (random_state.rand(args.num_pixels) > .3).astype(np.float32)
+    neg_class_frac, pos_class_frac = 1 - target_flat.mean(), target_flat.mean()
+
+    start = time.time()
+    sklearn_scores, sklearn_threshold_scores = Job.get_sklearn_metric_scores(
+        prediction_flat, target_flat, mask_flat, .75, 10, neg_class_frac, pos_class_frac)
+    sklearn_time = time.time() - start
+    start = time.time()
+    histogram = ScoreHistogram(n_bins=args.n_bins).add(prediction_flat, target_flat, mask_flat)
+    histogram_scores, histogram_threshold_scores = get_histogram_metric_scores(histogram, .75, 10, neg_class_frac,
+                                                                               pos_class_frac)
+    histogram_time = time.time() - start
+
+    for key in sorted(sklearn_scores.keys()):
+        print("{}: sklearn {:.6f}, histogram {:.6f}".format(key, sklearn_scores[key], histogram_scores[key]))
+    for sklearn_threshold_score, histogram_threshold_score in zip(sklearn_threshold_scores,
+                                                                  histogram_threshold_scores):
+        print("threshold sklearn {:.4f} acc {:.4f}, histogram {:.4f} acc {:.4f}".format(
+            sklearn_threshold_score[0], sklearn_threshold_score[1], histogram_threshold_score[0],
+            histogram_threshold_score[1]))
+    print("{} pixels: sklearn {:.2f}s, histogram {:.2f}s".format(args.num_pixels, sklearn_time, histogram_time))
+
+
+def benchmark_eval_batch(args):
+    import tensorflow as tf
+    from network.drive import DriveNetwork
+
+    network = DriveNetwork(pos_weight=1.0)
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+    for eval_batch_size in args.eval_batch_sizes:
+        images = np.random.rand(eval_batch_size, network.input_height, network.input_width, 1).astype(np.float32)
+        masks = np.ones((eval_batch_size, network.output_height, network.output_width, 1), dtype=np.float32)
+        targets = (np.random.rand(*masks.shape) > .9).astype(np.float32)
+        feed_dict = {network.inputs: images, network.masks: masks, network.targets: targets}
+        fetches = [network.cost, network.cost_unweighted, network.segmentation_result]
+        batch_time = time_runs(lambda: sess.run(fetches, feed_dict=feed_dict), args.num_runs)
+        with_layer_outputs_time = time_runs(lambda: sess.run(fetches + [network.layer_outputs], feed_dict=feed_dict),
+                                            args.num_runs)
+        print("eval_batch_size {}: {:.2f} images/sec, {:.2f} images/sec fetching layer outputs".format(
+            eval_batch_size, eval_batch_size / batch_time, eval_batch_size / with_layer_outputs_time))
+    sess.close()
+
+
+def get_peak_rss():
+    """Peak resident memory of this process in bytes"""
+    import resource
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_isolated(fn, *args, **kwargs):
+    """Return `fn(*args, **kwargs)` run in a fresh process, so its peak memory readings are its own"""
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(fn, args, kwargs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_job(name):
+    from job.drive import DriveJob
+    from job.dsa import DsaJob
+    return {"drive": DriveJob, "dsa": DsaJob}[name]()
+
+
+def get_random_batch(network, batch_size):
+    """Random `tf_reshape`d training batch for `network`, in the order `Job.get_network_dict` expects"""
+    images = np.random.rand(batch_size, network.input_height, network.input_width, 1).astype(np.float32)
+    targets = (np.random.rand(batch_size, network.output_height, network.output_width, 1) > .9).astype(np.float32)
+    if network.mask:
+        return images, np.ones_like(targets), targets
+    return images, targets
+
+
+def measure_train_steps(name, num_runs, **network_kwargs):
+    """Time the training step of `Job.train` (`Job.run_train_step`) and return it with the peak gpu memory (0 on cpu)
+    and the peak resident memory"""
+    import tensorflow as tf
+
+    job = get_job(name)
+    network = job.network_cls(pos_weight=1.0, **network_kwargs)
+    # peak memory of the allocator of the first gpu
+    max_bytes_in_use = tf.contrib.memory_stats.MaxBytesInUse()
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+    batch_data = get_random_batch(network, 1)
+    step_time = time_runs(lambda: job.run_train_step(network, sess, batch_data), num_runs)
+    peak_bytes = sess.run(max_bytes_in_use)
+    sess.close()
+    return step_time, peak_bytes, get_peak_rss(), network.compute_dtype.name
+
+
+def benchmark_precision(args):
+    for precision in args.precisions:
+        step_time, peak_bytes, peak_rss, compute_dtype = run_isolated(
+            measure_train_steps, args.network, args.num_runs, precision=precision,
+            compute_precision=args.compute_precision)
+        print("{} (convs in {}): {:.1f} ms/step, peak gpu memory {:.1f} MB, peak rss {:.1f} MB".format(
+            precision, compute_dtype, step_time * 1000, peak_bytes / 2.0 ** 20, peak_rss / 2.0 ** 20))
+
+
+def benchmark_recompute(args):
+    for recompute_segments in [None] + args.recompute_segments:
+        step_time, peak_bytes, peak_rss, _ = run_isolated(measure_train_steps, args.network, args.num_runs,
+                                                          recompute_segments=recompute_segments)
+        print("recompute_segments {}: {:.1f} ms/step, peak gpu memory {:.1f} MB, peak rss {:.1f} MB".format(
+            recompute_segments, step_time * 1000, peak_bytes / 2.0 ** 20, peak_rss / 2.0 ** 20))
+
+
+def benchmark_batch_size(args):
+    import tensorflow as tf
+    from network.drive import DriveNetwork
+    from network.dsa import DsaNetwork
+
+    # a `SmallNetwork` and a `LargeNetwork`
+    network_clss = {"drive": DriveNetwork, "dsa": DsaNetwork}
+    patch_size = (args.patch_size, args.patch_size) if args.patch_size is not None else None
+    for name in args.networks:
+        graph = tf.Graph()
+        with graph.as_default():
+            network = network_clss[name](pos_weight=1.0, patch_size=patch_size)
+            sess = tf.Session()
+            sess.run(tf.global_variables_initializer())
+            for batch_size in args.batch_sizes:
+                images = np.random.rand(batch_size, network.input_height, network.input_width, 1).astype(np.float32)
+                targets = (np.random.rand(batch_size, network.output_height, network.output_width, 1) > .9).astype(
+                    np.float32)
+                feed_dict = {network.inputs: images, network.targets: targets}
+                if network.mask:
+                    feed_dict[network.masks] = np.ones_like(targets)
+                segmentation_result = sess.run(network.segmentation_result, feed_dict=feed_dict)
+                if segmentation_result.shape != targets.shape:
+                    raise ValueError("{} output shape {} for inputs of shape {}".format(
+                        name, segmentation_result.shape, images.shape))
+                feed_dict[network.is_training] = True
+                step_time = time_runs(lambda: sess.run(network.train_op, feed_dict=feed_dict), args.num_runs)
+                print("{} batch size {}: {:.1f} ms/step, {:.1f} ms/image".format(
+                    name, batch_size, step_time * 1000, step_time * 1000 / batch_size))
+            sess.close()
+
+
+def legacy_max_threshold_accuracy_image(results, neg_class_frac, pos_class_frac, masks, targets):
+    from sklearn.metrics import roc_curve
+
+    fprs, tprs, thresholds = roc_curve(targets.flatten(), results.flatten(), sample_weight=masks.flatten())
+    list_fprs_tprs_thresholds = list(zip(fprs, tprs, thresholds))
+    interval = 0.0001
+    thresh_max = 0.0
+    for i in np.arange(0.0, 1.0 + interval, interval):
+        index = int(round((len(thresholds) - 1) * i, 0))
+        fpr, tpr, threshold = list_fprs_tprs_thresholds[index]
+        thresh_acc = (1 - fpr) * neg_class_frac + tpr * pos_class_frac
+        if thresh_acc > thresh_max:
+            thresh_max = thresh_acc
+    return thresh_max
+
+
+def benchmark_max_thresh(args):
+    from metrics.histogram import get_max_threshold_accuracies
+
+    random_state = np.random.RandomState(0)
+    shape = (args.num_images, args.height, args.width)
+    targets = (random_state.rand(*shape) > .88).astype(np.float32)
+    masks = (random_state.rand(*shape) > .3).astype(np.float32)
+    results = np.clip(random_state.normal(.25 + .5 * targets, .2), 0, 1)
+    pos_class_fracs = (targets * masks).sum(axis=(1, 2)) / masks.sum(axis=(1, 2))
+    neg_class_fracs = 1 - pos_class_fracs
+
+    start = time.time()
+    accuracies = [legacy_max_threshold_accuracy_image(*image_args) for image_args in
+                  zip(results, neg_class_fracs, pos_class_fracs, masks, targets)]
+    print("legacy: {:.3f}s, mean max threshold accuracy {:.6f}".format(time.time() - start, np.mean(accuracies)))
+    start = time.time()
+    accuracies, thresholds = get_max_threshold_accuracies(results, targets, neg_class_fracs, pos_class_fracs,
+                                                          masks=masks)
+    print("batched: {:.3f}s, mean max threshold accuracy {:.6f}, mean threshold {:.4f}".format(
+        time.time() - start, np.mean(accuracies), np.mean(thresholds)))
+
+
+def benchmark_ensemble(args):
+    import shutil
+    import tempfile
+
+    store_dir = tempfile.mkdtemp()
+    try:
+        store = PredictionStore(store_dir)
+        random_state = np.random.RandomState(0)
+        run_names = ["run_{:03d}".format(i) for i in range(args.num_models)]
+        for run_name in run_names:
+            writer = store.open_epoch(run_name, 0, args.num_pixels)
+            writer.write(random_state.rand(args.num_pixels).astype(np.float32))
+            writer.close()
+        for combining_metric in args.combining_metrics:
+            tracemalloc.start()
+            start = time.time()
+            store.combine(run_names, 0, combining_metric=combining_metric, weights=np.ones(args.num_models),
+                          memory_budget=args.memory_budget)
+            combine_time = time.time() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print("{} over {} models: {:.2f}s, peak {:.1f} MB".format(combining_metric, args.num_models,
+                                                                      combine_time, peak / 2.0 ** 20))
+    finally:
+        shutil.rmtree(store_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark")
+
+    next_batch_parser = subparsers.add_parser("next_batch", help="training batch assembly")
+    next_batch_parser.add_argument("--num_images", type=int, default=20)
+    next_batch_parser.add_argument("--height", type=int, default=584)
+    next_batch_parser.add_argument("--width", type=int, default=565)
+    next_batch_parser.add_argument("--batch_size", type=int, default=4)
+    next_batch_parser.add_argument("--num_batches", type=int, default=50)
+    next_batch_parser.add_argument("--augment", action="store_true")
+    next_batch_parser.add_argument("--patch_size", type=int, default=None)
+    next_batch_parser.add_argument("--patches_per_batch", type=int, default=16)
+    next_batch_parser.set_defaults(func=benchmark_next_batch)
+
+    export_parser = subparsers.add_parser("export", help="latency of the training graph vs the exported graph")
+    export_parser.add_argument("--networks", nargs="+", default=["drive", "dsa"], choices=["drive", "dsa"])
+    export_parser.add_argument("--num_runs", type=int, default=20)
+    export_parser.add_argument("--precision", default="float32")
+    export_parser.add_argument("--gpu_device", default=None)
+    export_parser.set_defaults(func=benchmark_export)
+
+    metrics_parser = subparsers.add_parser("metrics", help="test set metrics, sklearn vs histogram engine")
+    metrics_parser.add_argument("--num_pixels", type=int, default=20 * 584 * 565)
+    metrics_parser.add_argument("--n_bins", type=int, default=10000)
+    metrics_parser.set_defaults(func=benchmark_metrics)
+
+    eval_batch_parser = subparsers.add_parser("eval_batch", help="evaluation throughput per eval_batch_size")
+    eval_batch_parser.add_argument("--eval_batch_sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    eval_batch_parser.add_argument("--num_runs", type=int, default=10)
+    eval_batch_parser.set_defaults(func=benchmark_eval_batch)
+
+    precision_parser = subparsers.add_parser("precision", help="training step time and peak memory per precision")
+    precision_parser.add_argument("--network", default="drive", choices=["drive", "dsa"])
+    precision_parser.add_argument("--precisions", nargs="+", default=["float32", "float16"])
+    precision_parser.add_argument("--compute_precision", default=None)
+    precision_parser.add_argument("--num_runs", type=int, default=10)
+    precision_parser.set_defaults(func=benchmark_precision)
+
+    recompute_parser = subparsers.add_parser("recompute", help="training step time and peak memory per segment size")
+    recompute_parser.add_argument("--network", default="dsa", choices=["drive", "dsa"])
+    recompute_parser.add_argument("--recompute_segments", type=int, nargs="+", default=[1, 2, 4])
+    recompute_parser.add_argument("--num_runs", type=int, default=10)
+    recompute_parser.set_defaults(func=benchmark_recompute)
+
+    batch_size_parser = subparsers.add_parser("batch_size", help="training step time per image per batch size")
+    batch_size_parser.add_argument("--networks", nargs="+", default=["drive", "dsa"], choices=["drive", "dsa"])
+    batch_size_parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 16])
+    batch_size_parser.add_argument("--patch_size", type=int, default=None)
+    batch_size_parser.add_argument("--num_runs", type=int, default=10)
+    batch_size_parser.set_defaults(func=benchmark_batch_size)
+
+    max_thresh_parser = subparsers.add_parser("max_thresh", help="per-image max threshold accuracy")
+    max_thresh_parser.add_argument("--num_images", type=int, default=20)
+    max_thresh_parser.add_argument("--height", type=int, default=584)
+    max_thresh_parser.add_argument("--width", type=int, default=565)
+    max_thresh_parser.set_defaults(func=benchmark_max_thresh)
+
+    ensemble_parser = subparsers.add_parser("ensemble", help="ensemble combination time and peak memory")
+    ensemble_parser.add_argument("--num_models", type=int, default=10)
+    ensemble_parser.add_argument("--num_pixels", type=int, default=20 * 584 * 565)
+    ensemble_parser.add_argument("--memory_budget", type=int, default=1 << 28)
+    ensemble_parser.add_argument("--combining_metrics", nargs="+", default=list(PredictionStore.COMBINING_METRICS),
+                                 choices=PredictionStore.COMBINING_METRICS)
+    ensemble_parser.set_defaults(func=benchmark_ensemble)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,71 @@
+"""This is the file for lazily indexed and normalized views of the dataset arrays"""
+import numpy as np
+
+
+class ArrayView(object):
+    """The images `indices` of `base` (all of them by default) as `base * scale + shift`, computed when read.
+
+    A view keeps nothing but the indices: indexing it reads only the selected images (or pixels) of `base` and returns
+    them as a new float32 array. Splits and the dataset normalization of memory-mapped arrays then don't load the
+    dataset into memory"""
+
+    dtype = np.dtype(np.float32)
+
+    def __init__(self, base, indices=None, scale=1.0, shift=0.0):
+        self.base = base
+        self.indices = np.arange(len(base)) if indices is None else np.asarray(indices)
+        self.scale = scale
+        self.shift = shift
+
+    @property
+    def shape(self):
+        return (len(self.indices),) + tuple(self.base.shape[1:])
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        # the image indices are mapped to `base`, the rest of the key indexes the images as is
+        values = np.asarray(self.base[(self.indices[key[0]],) + key[1:]], dtype=np.float32)
+        if self.scale != 1.0:
+            values *= np.float32(self.scale)
+        if self.shift != 0.0:
+            values += np.float32(self.shift)
+        return values
+
+    def __array__(self, dtype=None):
+        values = self[:]
+        return values if dtype is None else values.astype(dtype)
+
+    def flatten(self):
+        return self[:].flatten()
+
+    def take(self, indices):
+        """View of the images `indices` of this view"""
+        return ArrayView(self.base, self.indices[np.asarray(indices)], scale=self.scale, shift=self.shift)
+
+
+def take_images(arr, indices):
+    """View of the images `indices` of `arr`, without copying them"""
+    if isinstance(arr, ArrayView):
+        return arr.take(indices)
+    return ArrayView(arr, indices)
+
+
+def normalize_images(arr, scale=1.0, shift=0.0):
+    """`arr * scale + shift` as a view, `arr` itself for the identity"""
+    if scale == 1.0 and shift == 0.0:
+        return arr
+    if isinstance(arr, ArrayView):
+        return ArrayView(arr.base, arr.indices, scale=arr.scale * scale, shift=arr.shift * scale + shift)
+    return ArrayView(arr, scale=scale, shift=shift)
@@ -1,12 +1,27 @@
 """This is the file for the Dataset base class"""
+import hashlib
 import numpy as np
 import math
 from math import ceil
 import os
+import multiprocessing
 from sklearn.model_selection import train_test_split
 from imgaug import imgaug
-from utilities.augmentation import apply_image_aug
-from utilities.image_preprocessing import apply_dataset_normalization
+from utilities.augmentation import apply_image_aug, augment_uint8_images
+from utilities.image_preprocessing import get_dataset_normalization
+from utilities.tiling import extract_patches
+from utilities.cache_ops import get_cache_key, load_cached_arrays, save_cached_arrays, load_packed_arrays, \
+    save_packed_arrays
+from dataset.array_view import take_images, normalize_images
+
+
+def get_network_pads(network_cls):
+    """Padding (top, bottom, left, right) to fit an image into the input of `network_cls`"""
+    top_pad = int((network_cls.FIT_IMAGE_HEIGHT - network_cls.IMAGE_HEIGHT) / 2)
+    bot_pad = (network_cls.FIT_IMAGE_HEIGHT - network_cls.IMAGE_HEIGHT) - top_pad
+    left_pad = int((network_cls.FIT_IMAGE_WIDTH - network_cls.IMAGE_WIDTH) / 2)
+    right_pad = (network_cls.FIT_IMAGE_WIDTH - network_cls.IMAGE_WIDTH) - left_pad
+    return top_pad, bot_pad, left_pad, right_pad
 
 
 class Dataset(object):
@@ -17,49 +32,153 @@ class Dataset(object):
                  early_stopping_val_prop = .1, sgd = True, cv_train_inds = None, cv_test_inds = None, seq = None,
                  hist_eq=None, clahe_kwargs=None, gamma=None, zero_center=False, per_image_z_score_norm=False,
                  per_image_zero_center=False, per_image_zero_center_scale=False, zero_center_scale=False,
-                 z_score_norm=False, **kwargs):
+                 z_score_norm=False, cache_dir=None, storage="memory", num_workers=1, num_batch_buffers=1,
+                 patch_size=None, patch_sampling="random", vessel_oversample=0.0, tf_aug=None, **kwargs):
 
         self.WRK_DIR_PATH = WRK_DIR_PATH
+        self.num_workers = num_workers
+        # `memmap` storage keeps the packed arrays on disk, so it always goes through the cache directory
+        if storage == "memmap" and cache_dir is None:
+            cache_dir = os.path.join(self.WRK_DIR_PATH, "cache")
+        elif storage not in ("memory", "memmap"):
+            raise ValueError("Storage {} not recognized".format(storage))
+        self.cache_dir = cache_dir
+        self.storage = storage
         self.batch_size = batch_size
         self.sgd = sgd
+        # with a `patch_size`, batches consist of `batch_size` patches cropped from the training images
+        if isinstance(patch_size, int):
+            patch_size = (patch_size, patch_size)
+        self.patch_size = tuple(patch_size) if patch_size is not None else None
+        if patch_sampling not in ("random", "mask"):
+            raise ValueError("Patch sampling {} not recognized".format(patch_sampling))
+        self.patch_sampling = patch_sampling
+        self.vessel_oversample = vessel_oversample
+        self.patch_center_candidates = {}
 
         self.TRAIN_DIR_PATH = os.path.join(self.WRK_DIR_PATH, TRAIN_SUBDIR)
+        # the test set of a cv fold is named by its images, so the saved targets of different folds are kept apart
+        self.test_split_key = None
         if cv_test_inds is not None:
             self.TEST_DIR_PATH = os.path.join(self.WRK_DIR_PATH, TRAIN_SUBDIR)
+            test_inds_hash = hashlib.sha1(np.asarray(cv_test_inds, dtype=np.int64).tobytes()).hexdigest()
+            self.test_split_key = "test_" + test_inds_hash[:12]
         else:
             self.TEST_DIR_PATH = os.path.join(self.WRK_DIR_PATH, TEST_SUBDIR)
         self.seq = seq
+        # augmentation of the `tf_data` input pipeline with TF ops (see `TFDataPipeline`)
+        self.tf_aug = tf_aug
+        self.preprocessing_kwargs = dict(hist_eq=hist_eq, clahe_kwargs=clahe_kwargs, gamma=gamma,
+                                         per_image_z_score_norm=per_image_z_score_norm,
+                                         per_image_zero_center=per_image_zero_center,
+                                         per_image_zero_center_scale=per_image_zero_center_scale)
 
-        self.train_data = self.get_images_from_file(self.TRAIN_DIR_PATH, cv_train_inds, hist_eq=hist_eq,
-                                                    clahe_kwargs=clahe_kwargs, gamma=gamma,
-                                                    per_image_z_score_norm=per_image_z_score_norm,
-                                                    per_image_zero_center=per_image_zero_center,
-                                                    per_image_zero_center_scale=per_image_zero_center_scale)
+        self.train_data = self.load_images(self.TRAIN_DIR_PATH, cv_train_inds, **self.preprocessing_kwargs)
         self.train_data = list(self.train_data)
-        self.train_data[0], train_params = apply_dataset_normalization(self.train_data[0], zero_center=zero_center,
-                                                                       zero_center_scale=zero_center_scale,
-                                                                       z_score_norm=z_score_norm)
+        self.normalization_kwargs = dict(zero_center=zero_center, zero_center_scale=zero_center_scale,
+                                         z_score_norm=z_score_norm)
+        scale, shift, train_params = get_dataset_normalization(self.train_data[0], **self.normalization_kwargs)
+        self.train_data[0] = normalize_images(self.train_data[0], scale, shift)
+        self.normalization_params = train_params
 
         if early_stopping:
-            data = train_test_split(*self.train_data, test_size=early_stopping_val_prop)
-            self.train_data = data[::2]
-            self.val_data = data[1::2]
-        self.test_data = self.get_images_from_file(self.TEST_DIR_PATH, cv_test_inds, hist_eq=hist_eq,
-                                                   clahe_kwargs=clahe_kwargs, gamma=gamma,
-                                                   per_image_z_score_norm=per_image_z_score_norm,
-                                                   per_image_zero_center=per_image_zero_center,
-                                                   per_image_zero_center_scale=per_image_zero_center_scale)
+            # sorted, so packed files are read in the order of the split
+            train_inds, val_inds = (np.sort(inds) for inds in train_test_split(np.arange(len(self.train_data[0])),
+                                                                               test_size=early_stopping_val_prop))
+            self.val_data = [take_images(arr, val_inds) for arr in self.train_data]
+            self.train_data = [take_images(arr, train_inds) for arr in self.train_data]
+        if self.patch_sampling == "mask" and len(self.train_data) < 3:
+            raise ValueError("Patch sampling `mask` requires a dataset with masks")
+        self.test_data = self.load_images(self.TEST_DIR_PATH, cv_test_inds, **self.preprocessing_kwargs)
         self.test_data = list(self.test_data)
-        self.test_data[0], _ = apply_dataset_normalization(self.test_data[0], zero_center=zero_center,
-                                                           zero_center_scale=zero_center_scale,
-                                                           z_score_norm=z_score_norm, train_params=train_params)
+        scale, shift, _ = get_dataset_normalization(self.test_data[0], train_params=train_params,
+                                                    **self.normalization_kwargs)
+        self.test_data[0] = normalize_images(self.test_data[0], scale, shift)
 
         self.pointer = 0
+        self.num_batch_buffers = num_batch_buffers
+        self.batch_buffers = None
+
+    def load_images(self, DIR_PATH, file_indices=None, **preprocessing_kwargs):
+        """Return `get_images_from_file` results, re-using the on-disk cache when `cache_dir` is set.
+
+        With `memmap` storage the arrays are packed (float16 images, uint8 labels) and memory-mapped, so only the
+        slices handed out by `next_batch` and `get_test_image` become resident. The dataset normalization and the early
+        stopping split only wrap them in views (see `ArrayView`)"""
+        if self.cache_dir is None:
+            data = self.get_images_from_file(DIR_PATH, file_indices, **preprocessing_kwargs)
+            return tuple(np.asarray(arr, dtype=np.float32) for arr in data)
+
+        cache_key = get_cache_key(DIR_PATH, self.get_cache_params(file_indices, **preprocessing_kwargs))
+        if self.storage == "memmap":
+            cache_path = os.path.join(self.cache_dir, cache_key + ".packed")
+            load_fn, save_fn = load_packed_arrays, save_packed_arrays
+        else:
+            cache_path = os.path.join(self.cache_dir, cache_key + ".npz")
+            load_fn, save_fn = load_cached_arrays, save_cached_arrays
+        if not os.path.exists(cache_path):
+            data = self.get_images_from_file(DIR_PATH, file_indices, **preprocessing_kwargs)
+            save_fn(cache_path, data)
+            print("saved dataset arrays to cache: {}".format(cache_path))
+            if self.storage == "memory":
+                return tuple(np.asarray(arr, dtype=np.float32) for arr in data)
+            del data
+        print("load cached dataset arrays: {}".format(cache_path))
+        if self.storage == "memory":
+            return tuple(np.asarray(arr, dtype=np.float32) for arr in load_fn(cache_path))
+        return load_fn(cache_path)
+
+    def get_cache_params(self, file_indices=None, **preprocessing_kwargs):
+        """Everything besides the source files that changes the output of `get_images_from_file`"""
+        params = dict(preprocessing_kwargs)
+        params.update({"dataset_cls": type(self).__name__,
+                       "file_indices": None if file_indices is None else [int(i) for i in file_indices],
+                       "FIT_IMAGE_HEIGHT": self.network_cls.FIT_IMAGE_HEIGHT,
+                       "FIT_IMAGE_WIDTH": self.network_cls.FIT_IMAGE_WIDTH,
+                       "IMAGE_HEIGHT": self.network_cls.IMAGE_HEIGHT,
+                       "IMAGE_WIDTH": self.network_cls.IMAGE_WIDTH})
+        return params
 
     def get_images_from_file(self, DIR_PATH, file_indices=None, hist_eq=None, clahe_kwargs=None,
                              per_image_normalization=False, gamma=None):
         raise NotImplementedError("Method Not Implemented")
 
+    def map_files(self, load_fn, files):
+        """Apply `load_fn` to every entry of `files` across `num_workers` processes, keeping the original order.
+
+        `load_fn` has to be picklable, i.e. a module-level function or a `functools.partial` of one"""
+        num_workers = min(self.num_workers, len(files))
+        if num_workers <= 1:
+            return [load_fn(file_entry) for file_entry in files]
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            return pool.map(load_fn, files, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def get_pads(self):
+        """Padding (top, bottom, left, right) to fit an image into the network input"""
+        return get_network_pads(self.network_cls)
+
+    def get_config(self):
+        """Everything needed to load and normalize new images the way the training images were"""
+        return {"dataset_cls": [type(self).__module__, type(self).__name__],
+                "load_kwargs": self.get_load_kwargs(),
+                "normalization_kwargs": self.normalization_kwargs,
+                "normalization_params": None if self.normalization_params is None else
+                [float(param) for param in self.normalization_params],
+                "patch_size": self.patch_size}
+
+    def get_load_kwargs(self):
+        """Keyword arguments of `load_inference_image` besides the image path and the pads"""
+        return dict(self.preprocessing_kwargs)
+
+    @staticmethod
+    def load_inference_image(image_path, pads, mask_path=None, **load_kwargs):
+        """Decode and pre-process a single image for inference, returning the image and its FOV mask (or None)"""
+        raise NotImplementedError("Method Not Implemented")
+
     def get_data_for_tensorflow(self, dataset="train"):
         raise NotImplementedError("Method Not Implemented")
 
@@ -83,17 +202,134 @@ class Dataset(object):
                 reshaped_arrs += [np.reshape(arr, (arr.shape[0], arr.shape[1], arr.shape[2], 1))]
         return tuple(reshaped_arrs)
 
+    def get_seq_det(self, random_state=None):
+        """Deterministic version of the augmentation sequence, re-seeded from `random_state` if one is given"""
+        if random_state is not None and random_state is not np.random:
+            self.seq.reseed(random_state.randint(0, 2**31 - 1))
+        return self.seq._to_deterministic()
+
     def apply_aug(self, *args, **kwargs):
         return apply_image_aug(*args, **kwargs)
 
     def num_batches_in_epoch(self):
+        if self.patch_size is not None:
+            # an epoch covers as many pixels as one pass over the whole images
+            patches_per_image = int(math.ceil(float(np.prod(self.train_data[-1].shape[1:3])) /
+                                              np.prod(self.patch_size)))
+            return int(math.floor(len(self.train_data[0]) * patches_per_image / self.batch_size))
         return int(math.floor(len(self.train_data[0]) / self.batch_size))
 
     def reset_batch_pointer(self):
         self.pointer = 0
 
-    def next_batch(self):
-        raise NotImplementedError("Method Not Implemented")
+    def init_batch_buffers(self, num_batch_buffers=None):
+        """Allocate the float32 batches `next_batch` cycles through, plus the gather buffers they are filled from"""
+        if num_batch_buffers is not None:
+            self.num_batch_buffers = num_batch_buffers
+        if self.patch_size is not None:
+            batch_shapes = [(self.batch_size,) + self.patch_size for _ in self.train_data]
+        else:
+            batch_shapes = [(self.batch_size,) + tuple(arr.shape[1:]) for arr in self.train_data]
+        self.batch_buffers = [tuple(np.empty(shape, dtype=np.float32) for shape in batch_shapes)
+                              for _ in range(self.num_batch_buffers)]
+        self.batch_buffer_i = 0
+        # storage that is not float32 (e.g. packed memmaps) is gathered in its own dtype and converted in place
+        self.gather_buffers = [np.empty(shape, dtype=arr.dtype) if arr.dtype != np.float32 else None
+                               for arr, shape in zip(self.train_data, batch_shapes)]
+        self.aug_buffers = [np.empty(shape, dtype=np.uint8) for shape in batch_shapes]
+
+    def next_batch(self, random_state=None):
+        """Gather the next training batch into the next of the `num_batch_buffers` reusable batch buffers.
+
+        A returned batch is overwritten `num_batch_buffers` calls later, so consumers keeping batches around longer than
+        that have to copy them. Images come first in `train_data`, everything after them is augmented as a label"""
+        if random_state is None:
+            random_state = np.random
+        if self.batch_buffers is None or self.batch_buffers[0][0].shape[0] != self.batch_size:
+            self.init_batch_buffers()
+        num_images = len(self.train_data[0])
+        if self.sgd:
+            samples = random_state.randint(0, num_images, self.batch_size)
+        elif self.patch_size is None:
+            # like `reset_batch_pointer` at the start of an epoch, a batch never runs over into the next pass
+            if self.pointer + self.batch_size > num_images:
+                self.pointer = 0
+            samples = np.arange(self.pointer, self.pointer + self.batch_size)
+        else:
+            # an epoch of patches takes several passes over the images
+            samples = np.arange(self.pointer, self.pointer + self.batch_size) % num_images
+        self.pointer += self.batch_size
+        patch_offsets = self.get_patch_offsets(samples, random_state) if self.patch_size is not None else None
+
+        batch = self.batch_buffers[self.batch_buffer_i]
+        self.batch_buffer_i = (self.batch_buffer_i + 1) % self.num_batch_buffers
+        seq_det = self.get_seq_det(random_state) if self.seq is not None else None
+        for i, (arr, gather_buffer, out) in enumerate(zip(self.train_data, self.gather_buffers, batch)):
+            if gather_buffer is None:
+                self.gather_samples(arr, samples, out, patch_offsets, image=i == 0)
+            else:
+                self.gather_samples(arr, samples, gather_buffer, patch_offsets, image=i == 0)
+                np.copyto(out, gather_buffer, casting="unsafe")
+            if seq_det is not None:
+                # the batch is augmented as uint8 in [0, 1] * 255
+                aug_buffer = self.aug_buffers[i]
+                np.multiply(out, 255.0, out=out)
+                np.clip(np.rint(out, out=out), 0, 255, out=out)
+                np.copyto(aug_buffer, out, casting="unsafe")
+                np.multiply(augment_uint8_images(aug_buffer, seq_det, masks=i > 0), 1.0 / 255.0, out=out)
+        return batch
+
+    def gather_samples(self, arr, samples, out, patch_offsets=None, image=False):
+        """Copy the images `samples` of `arr`, or their patches at `patch_offsets`, into `out`"""
+        if patch_offsets is None:
+            if isinstance(arr, np.ndarray):
+                np.take(arr, samples, axis=0, out=out, mode="clip")
+            else:
+                np.copyto(out, arr[samples], casting="unsafe")
+            return
+        row_offsets, col_offsets = patch_offsets
+        if image:
+            # images are padded to fit the network, labels are not
+            top_pad, _, left_pad, _ = self.get_pads()
+            row_offsets, col_offsets = row_offsets + top_pad, col_offsets + left_pad
+        extract_patches(arr, samples, row_offsets, col_offsets, self.patch_size, out=out)
+
+    def get_patch_offsets(self, samples, random_state):
+        """Top left corners (in label coordinates) of one patch per entry of `samples`.
+
+        Patches are centered on a pixel drawn uniformly (`random`) or from the FOV mask (`mask`). With probability
+        `vessel_oversample` the center is drawn from the vessel pixels instead"""
+        height, width = self.train_data[-1].shape[1:3]
+        patch_height, patch_width = self.patch_size
+        if self.patch_sampling == "mask":
+            centers = self.draw_patch_centers(samples, 1, random_state)
+        else:
+            centers = random_state.randint(0, height * width, len(samples))
+        if self.vessel_oversample > 0:
+            vessel_patches = random_state.rand(len(samples)) < self.vessel_oversample
+            centers[vessel_patches] = self.draw_patch_centers(samples[vessel_patches], len(self.train_data) - 1,
+                                                              random_state)
+        rows, cols = np.unravel_index(centers, (height, width))
+        rows = np.clip(rows - patch_height // 2, 0, height - patch_height)
+        cols = np.clip(cols - patch_width // 2, 0, width - patch_width)
+        return rows, cols
+
+    def draw_patch_centers(self, samples, data_i, random_state):
+        """Draw one flat pixel index per entry of `samples` among the non-zero pixels of `train_data[data_i]`"""
+        if data_i not in self.patch_center_candidates:
+            arr = self.train_data[data_i]
+            candidates = [np.flatnonzero(arr[i] > .5) for i in range(len(arr))]
+            counts = np.array([len(image_candidates) for image_candidates in candidates])
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            self.patch_center_candidates[data_i] = (np.concatenate(candidates), starts, counts)
+        candidates, starts, counts = self.patch_center_candidates[data_i]
+        height, width = self.train_data[-1].shape[1:3]
+        centers = random_state.randint(0, height * width, len(samples))
+        # images without any candidate pixel fall back to uniform centers
+        draws = starts[samples] + (random_state.rand(len(samples)) * counts[samples]).astype(np.int64)
+        if len(candidates):
+            centers = np.where(counts[samples] > 0, candidates[np.minimum(draws, len(candidates) - 1)], centers)
+        return centers
 
     def get_tuned_pos_ce_weight(self, tuning_constant=1.0, *args):
         return tuning_constant*self.get_inverse_pos_freq(*args)[0]
@@ -111,3 +347,7 @@ class Dataset(object):
     @property
     def test_set(self):
         raise ValueError("Property Not Defined")
+
+    def get_test_image(self, i):
+        """The arrays of test image `i` (the image, then its labels), read without loading the other test images"""
+        return tuple(arr[i] for arr in self.test_data)
@@ -1,11 +1,55 @@
 import os
+from functools import partial
 import numpy as np
 from skimage import io as skio
 import cv2
 from PIL import Image
 
 from dataset.base import Dataset
-from utilities.image_preprocessing import preprocessing
+from utilities.image_preprocessing import preprocess_green_channel
+
+
+def load_fov_mask(image_arr, mask_path=None, mask_provided=True, init_mask_imgs=False, mask_threshold=None):
+    """Load the FOV mask at `mask_path`, or create it by thresholding the lightness of the decoded BGR image"""
+    if mask_path is not None and (mask_provided or init_mask_imgs):
+        mask = Image.open(mask_path)
+        mask_arr = np.array(mask)
+        mask_arr = mask_arr * 1.0 / 255.0
+        # load base files to produce masks
+        if init_mask_imgs:
+            # scale scores by 100
+            mask_arr = mask_arr * 100.0
+            mask_arr = np.where(mask_arr > mask_threshold, 1, 0)
+    else:
+        # convert from BGR to CLIELAB color space
+        l_image_arr = cv2.cvtColor(image_arr, cv2.COLOR_BGR2LAB)[:,:,0]*(100.0/255.0)
+        mask_arr = np.where(l_image_arr > mask_threshold, 1, 0.0)
+
+    # apply morphological open operation to created masks
+    if not mask_provided or mask_path is None:
+        kernel = np.ones((3, 3), np.uint8)
+        mask_arr = cv2.morphologyEx(mask_arr.astype(np.uint8), cv2.MORPH_OPEN, kernel)
+    return mask_arr
+
+
+def load_sample_w_masks(files, IMAGES_DIR_PATH, MASKS_DIR_PATH, TARGETS_DIR_PATH, pads, mask_provided,
+                        init_mask_imgs, mask_threshold, **preprocessing_kwargs):
+    """Decode and pre-process one (image, mask, target) file triple"""
+    image_file, mask_file, target_file = files
+
+    image_arr = cv2.imread(os.path.join(IMAGES_DIR_PATH,image_file), 1)
+    # apply image pre-processing
+    grn_chnl_arr = preprocess_green_channel(image_arr, pads, **preprocessing_kwargs)
+
+    mask_path = os.path.join(MASKS_DIR_PATH, mask_file) if mask_file is not None else None
+    mask_arr = load_fov_mask(image_arr, mask_path, mask_provided=mask_provided, init_mask_imgs=init_mask_imgs,
+                             mask_threshold=mask_threshold)
+
+    target_arr = np.array(skio.imread(os.path.join(TARGETS_DIR_PATH,target_file)))
+    target_arr = np.where(target_arr > 127,1.0,0.0)
+
+    return grn_chnl_arr, mask_arr, target_arr
+
 
 class DatasetWMasks(Dataset):
 
@@ -29,10 +73,6 @@ class DatasetWMasks(Dataset):
                              per_image_z_score_norm=False, per_image_zero_center=False,
                              per_image_zero_center_scale=False):
 
-        images = []
-        masks = []
-        targets = []
-
         IMAGES_DIR_PATH = os.path.join(DIR_PATH, self.IMAGES_DIR)
         MASKS_DIR_PATH = os.path.join(DIR_PATH, self.MASKS_DIR)
         TARGETS_DIR_PATH = os.path.join(DIR_PATH, self.TARGETS_DIR)
@@ -48,80 +88,44 @@ class DatasetWMasks(Dataset):
             mask_files = sorted(os.listdir(MASKS_DIR_PATH))
             if file_indices is not None:
                 mask_files = [mask_files[i] for i in file_indices]
-
-        for i, (image_file,target_file) in enumerate(zip(image_files, target_files)):
-
-            image_arr = cv2.imread(os.path.join(IMAGES_DIR_PATH,image_file), 1)
-            grn_chnl_arr = image_arr[:, :, 1]
-
-            top_pad = int((self.network_cls.FIT_IMAGE_HEIGHT - self.network_cls.IMAGE_HEIGHT) / 2)
-            bot_pad = (self.network_cls.FIT_IMAGE_HEIGHT - self.network_cls.IMAGE_HEIGHT) - top_pad
-            left_pad = int((self.network_cls.FIT_IMAGE_WIDTH - self.network_cls.IMAGE_WIDTH) / 2)
-            right_pad = (self.network_cls.FIT_IMAGE_WIDTH - self.network_cls.IMAGE_WIDTH) - left_pad
-
-            grn_chnl_arr = cv2.copyMakeBorder(grn_chnl_arr, top_pad, bot_pad, left_pad, right_pad, cv2.BORDER_CONSTANT, 0)
-            # apply image pre-processing
-            grn_chnl_arr = preprocessing(grn_chnl_arr, histo_eq=hist_eq, clahe_kwargs=clahe_kwargs, gamma=gamma,
-                                         per_image_z_score_norm=per_image_z_score_norm,
-                                         per_image_zero_center=per_image_zero_center,
-                                         per_image_zero_center_scale=per_image_zero_center_scale)
-            grn_chnl_arr = grn_chnl_arr * 1.0/255.0
-            images.append(grn_chnl_arr)
-
-            if self.mask_provided or self.init_mask_imgs:
-                mask_file = mask_files[i]
-                mask = Image.open(os.path.join(MASKS_DIR_PATH,mask_file))
-                mask_arr = np.array(mask)
-                mask_arr = mask_arr * 1.0 / 255.0
-                # load base files to produce masks
-                if self.init_mask_imgs:
-                    # scale scores by 100
-                    mask_arr = mask_arr * 100.0
-                    mask_arr = np.where(mask_arr > self.mask_threshold, 1, 0)
-            else:
-                # convert from BGR to CLIELAB color space
-                l_image_arr = cv2.cvtColor(image_arr, cv2.COLOR_BGR2LAB)[:,:,0]*(100.0/255.0)
-                mask_arr = np.where(l_image_arr > self.mask_threshold, 1, 0.0)
-
-            # apply morphological open operation to created masks
-            if not self.mask_provided:
-                kernel = np.ones((3, 3), np.uint8)
-                mask_arr = cv2.morphologyEx(mask_arr.astype(np.uint8), cv2.MORPH_OPEN, kernel)
-
-            masks.append(mask_arr)
-
-            target_arr = np.array(skio.imread(os.path.join(TARGETS_DIR_PATH,target_file)))
-            target_arr = np.where(target_arr > 127,1.0,0.0)
-
-            targets.append(target_arr)
-
-        return images, np.asarray(masks), np.asarray(targets)
-
-
-    def next_batch(self):
-        images = []
-        masks = []
-        targets = []
-
-        if self.sgd:
-            samples = np.random.choice(len(self.train_images), self.batch_size)
-
-        for i in range(self.batch_size):
-            if self.sgd:
-                images.append(np.array(self.train_images[samples[i]]))
-                masks.append(np.array(self.train_masks[samples[i]]))
-                targets.append(np.array(self.train_targets[samples[i]]))
-            else:
-                images.append(np.array(self.train_images[self.pointer + i]))
-                masks.append(np.array(self.train_masks[self.pointer + i]))
-                targets.append(np.array(self.train_targets[self.pointer + i]))
-        if self.seq is not None:
-            seq_det = self.seq._to_deterministic()
-            images = self.apply_aug(images, seq_det)
-            masks = self.apply_aug(masks, seq_det, masks=True)
-            targets = self.apply_aug(targets, seq_det, masks=True)
-        self.pointer += self.batch_size
-        return np.array(images), np.array(masks), np.array(targets)
+        else:
+            mask_files = [None] * len(image_files)
+
+        load_fn = partial(load_sample_w_masks, IMAGES_DIR_PATH=IMAGES_DIR_PATH, MASKS_DIR_PATH=MASKS_DIR_PATH,
+                          TARGETS_DIR_PATH=TARGETS_DIR_PATH, pads=self.get_pads(), mask_provided=self.mask_provided,
+                          init_mask_imgs=self.init_mask_imgs, mask_threshold=self.mask_threshold, hist_eq=hist_eq,
+                          clahe_kwargs=clahe_kwargs, gamma=gamma, per_image_z_score_norm=per_image_z_score_norm,
+                          per_image_zero_center=per_image_zero_center,
+                          per_image_zero_center_scale=per_image_zero_center_scale)
+        samples = self.map_files(load_fn, list(zip(image_files, mask_files, target_files)))
+        images, masks, targets = zip(*samples)
+
+        return list(images), np.asarray(masks), np.asarray(targets)
+
+    def get_cache_params(self, file_indices=None, **preprocessing_kwargs):
+        params = super(DatasetWMasks, self).get_cache_params(file_indices, **preprocessing_kwargs)
+        params.update({"mask_provided": self.mask_provided, "init_mask_imgs": self.init_mask_imgs,
+                       "mask_threshold": self.mask_threshold})
+        return params
+
+    def get_load_kwargs(self):
+        load_kwargs = super(DatasetWMasks, self).get_load_kwargs()
+        load_kwargs.update({"mask_provided": self.mask_provided, "init_mask_imgs": self.init_mask_imgs,
+                            "mask_threshold": self.mask_threshold})
+        return load_kwargs
+
+    @staticmethod
+    def load_inference_image(image_path, pads, mask_path=None, mask_provided=True, init_mask_imgs=False,
+                             mask_threshold=None, **preprocessing_kwargs):
+        image_arr = cv2.imread(image_path, 1)
+        grn_chnl_arr = preprocess_green_channel(image_arr, pads, **preprocessing_kwargs)
+        if mask_path is None and mask_threshold is None:
+            # no mask and nothing to derive it from, keep the whole image
+            mask_arr = np.ones(image_arr.shape[:2])
+        else:
+            mask_arr = load_fov_mask(image_arr, mask_path, mask_provided=mask_provided, init_mask_imgs=init_mask_imgs,
+                                     mask_threshold=mask_threshold)
+        return grn_chnl_arr, mask_arr
 
     def get_inverse_pos_freq(self, masks, targets):
         total_pos = 0
@@ -136,4 +140,5 @@ class DatasetWMasks(Dataset):
 
     @property
     def test_set(self):
-        return np.array(self.test_images), np.array(self.test_masks), np.array(self.test_targets)
\ No newline at end of file
+        """The test arrays as they are stored (memory-mapped or lazy views), see `get_test_image` to read one image"""
+        return self.test_images, self.test_masks, self.test_targets
\ No newline at end of file
@@ -1,10 +1,31 @@
 import os
+from functools import partial
 import numpy as np
 from skimage import io as skio
 import cv2
 
 from dataset.base import Dataset
-from utilities.image_preprocessing import preprocessing
+from utilities.image_preprocessing import preprocess_green_channel
+
+
+def load_sample_wo_masks(files, IMAGES_DIR_PATH, TARGETS_DIR_PATH, pads, hist_eq=None, clahe_kwargs=None, gamma=None,
+                         per_image_z_score_norm=False, per_image_zero_center=False,
+                         per_image_zero_center_scale=False):
+    """Decode and pre-process one (image, target) file pair"""
+    image_file, target_file = files
+
+    image_arr = cv2.imread(os.path.join(IMAGES_DIR_PATH,image_file), 1)
+    # for retinal images, extract green channel and apply image pre-processing
+    image_arr = preprocess_green_channel(image_arr, pads, hist_eq=hist_eq, clahe_kwargs=clahe_kwargs, gamma=gamma,
+                                         per_image_z_score_norm=per_image_z_score_norm,
+                                         per_image_zero_center=per_image_zero_center,
+                                         per_image_zero_center_scale=per_image_zero_center_scale)
+
+    target_arr = np.array(skio.imread(os.path.join(TARGETS_DIR_PATH,target_file)))
+    target_arr = np.where(target_arr > 127,1.0,0.0)
+
+    return image_arr, target_arr
+
 
 class DatasetWoMasks(Dataset):
 
@@ -24,9 +45,6 @@ class DatasetWoMasks(Dataset):
                              per_image_z_score_norm=False, per_image_zero_center=False,
                              per_image_zero_center_scale=False):
 
-        images = []
-        targets = []
-
         IMAGES_DIR_PATH = os.path.join(DIR_PATH, self.IMAGES_DIR)
         TARGETS_DIR_PATH = os.path.join(DIR_PATH, self.TARGETS_DIR)
 
@@ -37,53 +55,20 @@ class DatasetWoMasks(Dataset):
             image_files = [image_files[i] for i in file_indices]
             target_files = [target_files[i] for i in file_indices]
 
-        for image_file, target_file in zip(image_files, target_files):
-
-            image_arr = cv2.imread(os.path.join(IMAGES_DIR_PATH,image_file), 1)
-            # for retinal images, extract green channel
-            image_arr = image_arr[:, :, 1]
-
-            top_pad = int((self.network_cls.FIT_IMAGE_HEIGHT - self.network_cls.IMAGE_HEIGHT) / 2)
-            bot_pad = (self.network_cls.FIT_IMAGE_HEIGHT - self.network_cls.IMAGE_HEIGHT) - top_pad
-            left_pad = int((self.network_cls.FIT_IMAGE_WIDTH - self.network_cls.IMAGE_WIDTH) / 2)
-            right_pad = (self.network_cls.FIT_IMAGE_WIDTH - self.network_cls.IMAGE_WIDTH) - left_pad
-
-            image_arr = cv2.copyMakeBorder(image_arr, top_pad, bot_pad, left_pad, right_pad, cv2.BORDER_CONSTANT, 0)
-            # apply image pre-processing
-            image_arr = preprocessing(image_arr, histo_eq=hist_eq, clahe_kwargs=clahe_kwargs, gamma=gamma,
-                                      per_image_z_score_norm=per_image_z_score_norm,
-                                      per_image_zero_center=per_image_zero_center,
-                                      per_image_zero_center_scale=per_image_zero_center_scale)
-            image_arr = image_arr * 1.0 / 255.0
-            images.append(image_arr)
-
-            target_arr = np.array(skio.imread(os.path.join(TARGETS_DIR_PATH,target_file)))
-            target_arr = np.where(target_arr > 127,1.0,0.0)
-
-            targets.append(target_arr)
-
-        return images, np.asarray(targets)
-
-    def next_batch(self):
-        images = []
-        targets = []
-
-        if self.sgd:
-            samples = np.random.choice(len(self.train_images), self.batch_size)
-
-        for i in range(self.batch_size):
-            if self.sgd:
-                images.append(np.array(self.train_images[samples[i]]))
-                targets.append(np.array(self.train_targets[samples[i]]))
-            else:
-                images.append(np.array(self.train_images[self.pointer + i]))
-                targets.append(np.array(self.train_targets[self.pointer + i]))
-        if self.seq is not None:
-            seq_det = self.seq._to_deterministic()
-            images = self.apply_aug(images, seq_det)
-            targets = self.apply_aug(targets, seq_det, masks=True)
-        self.pointer += self.batch_size
-        return np.array(images), np.array(targets)
+        load_fn = partial(load_sample_wo_masks, IMAGES_DIR_PATH=IMAGES_DIR_PATH, TARGETS_DIR_PATH=TARGETS_DIR_PATH,
+                          pads=self.get_pads(), hist_eq=hist_eq, clahe_kwargs=clahe_kwargs, gamma=gamma,
+                          per_image_z_score_norm=per_image_z_score_norm,
+                          per_image_zero_center=per_image_zero_center,
+                          per_image_zero_center_scale=per_image_zero_center_scale)
+        samples = self.map_files(load_fn, list(zip(image_files, target_files)))
+        images, targets = zip(*samples)
+
+        return list(images), np.asarray(targets)
+
+    @staticmethod
+    def load_inference_image(image_path, pads, mask_path=None, **preprocessing_kwargs):
+        image_arr = cv2.imread(image_path, 1)
+        return preprocess_green_channel(image_arr, pads, **preprocessing_kwargs), None
 
     def get_data_for_tensorflow(self, dataset="train"):
         if dataset == "train":
@@ -108,4 +93,5 @@ class DatasetWoMasks(Dataset):
 
     @property
     def test_set(self):
-        return np.array(self.train_images), np.array(self.test_targets)
\ No newline at end of file
+        """The test arrays as they are stored (memory-mapped or lazy views), see `get_test_image` to read one image"""
+        return self.test_images, self.test_targets
\ No newline at end of file
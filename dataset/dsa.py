@@ -1,5 +1,6 @@
 """This is the file for the DsaDataset subclass"""
 import os
+from functools import partial
 import numpy as np
 from skimage import io as skio
 import cv2
@@ -9,6 +10,42 @@ from utilities.image_preprocessing import preprocessing
 from dataset.dataset_wo_masks import DatasetWoMasks
 from network.dsa import DsaNetwork
 
+
+def load_dsa_image(image_path, hist_eq=None, clahe_kwargs=None, gamma=None, **preprocessing_kwargs):
+    image_arr = cv2.imread(image_path, 0)
+    image_arr = preprocessing(image_arr, histo_eq=hist_eq, clahe_kwargs=clahe_kwargs, gamma=gamma,
+                              **preprocessing_kwargs)
+    return np.multiply(image_arr, 1.0 / 255, dtype=np.float32)
+
+
+def load_dsa_sample(image_file, DIR_PATH, WRK_DIR_PATH, IMAGES_DIR, TARGETS1_DIR, TARGETS2_DIR, hist_eq=None,
+                    clahe_kwargs=None, gamma=None, **preprocessing_kwargs):
+    """Decode and pre-process one DSA image and its target, whichever target directory it is in"""
+    image_path = os.path.join(DIR_PATH, IMAGES_DIR, image_file)
+    image_arr = load_dsa_image(image_path, hist_eq=hist_eq, clahe_kwargs=clahe_kwargs, gamma=gamma,
+                               **preprocessing_kwargs)
+
+    if os.path.exists(os.path.join(DIR_PATH, TARGETS1_DIR, image_file)):
+        target_file = os.path.join(DIR_PATH, TARGETS1_DIR, image_file)
+        target_arr = np.array(skio.imread(target_file))
+        target_arr = np.where(target_arr > 127,1,0).astype(np.uint8)
+    elif os.path.exists(os.path.join(DIR_PATH, TARGETS2_DIR, image_file)):
+        target_file = os.path.join(DIR_PATH, TARGETS2_DIR, image_file)
+        target_arr = np.array(skio.imread(target_file))[:, :, 3]
+        target_arr = np.where(target_arr > 127,1,0).astype(np.uint8)
+    else:
+        raise ValueError("Path for target file for \'{}\' not defined".format(image_file))
+
+    orig_img = image_file
+    orig_pth = os.path.join(WRK_DIR_PATH, orig_img)
+    imsave(orig_pth, image_arr * 255.0)
+    target_img = "target_" + image_file
+    target_pth = os.path.join(WRK_DIR_PATH, target_img)
+    imsave(target_pth, target_arr * 255.0)
+
+    return image_arr, target_arr
+
+
 class DsaDataset(DatasetWoMasks):
 
     TARGETS1_DIR = "targets1"
@@ -17,10 +54,8 @@ class DsaDataset(DatasetWoMasks):
     def __init__(self, **kwargs):
         super(DsaDataset, self).__init__(**kwargs)
 
-    def get_images_from_file(self, DIR_PATH, file_indices=None, hist_eq=None, clahe_kwargs=None,
-                             per_image_normalization=False, gamma=None):
-        images = []
-        targets = []
+    def get_images_from_file(self, DIR_PATH, file_indices=None, hist_eq=None, clahe_kwargs=None, gamma=None,
+                             **preprocessing_kwargs):
 
         IMAGES_DIR_PATH = os.path.join(DIR_PATH, self.IMAGES_DIR)
 
@@ -28,36 +63,19 @@ class DsaDataset(DatasetWoMasks):
         if file_indices is not None:
             image_files = [image_files[i] for i in file_indices]
 
-        for image_file in image_files:
-            image_path = os.path.join(IMAGES_DIR_PATH, image_file)
-            image_arr = cv2.imread(image_path, 0)
-            image_arr = preprocessing(image_arr, histo_eq=hist_eq, clahe_kwargs=clahe_kwargs,
-                                      per_image_normalization=per_image_normalization, gamma=gamma)
-            image_arr = np.multiply(image_arr, 1.0 / 255)
-            images.append(image_arr)
-
-            if os.path.exists(os.path.join(DIR_PATH, self.TARGETS1_DIR, image_file)):
-                target_file = os.path.join(DIR_PATH, self.TARGETS1_DIR, image_file)
-                target_arr = np.array(skio.imread(target_file))
-                target_arr = np.where(target_arr > 127,1,0)
-                targets.append(target_arr)
-            elif os.path.exists(os.path.join(DIR_PATH, self.TARGETS2_DIR, image_file)):
-                target_file = os.path.join(DIR_PATH, self.TARGETS2_DIR, image_file)
-                target_arr = np.array(skio.imread(target_file))[:, :, 3]
-                target_arr = np.where(target_arr > 127,1,0)
-                targets.append(target_arr)
-            else:
-                raise ValueError("Path for target file for \'{}\' not defined".format(image_file))
-
-            orig_img = image_file
-            orig_pth = os.path.join(self.WRK_DIR_PATH, orig_img)
-            imsave(orig_pth, image_arr * 255.0)
-            target_img = "target_" + image_file
-            target_pth = os.path.join(self.WRK_DIR_PATH, target_img)
-            imsave(target_pth, target_arr * 255.0)
+        load_fn = partial(load_dsa_sample, DIR_PATH=DIR_PATH, WRK_DIR_PATH=self.WRK_DIR_PATH,
+                          IMAGES_DIR=self.IMAGES_DIR, TARGETS1_DIR=self.TARGETS1_DIR, TARGETS2_DIR=self.TARGETS2_DIR,
+                          hist_eq=hist_eq, clahe_kwargs=clahe_kwargs, gamma=gamma, **preprocessing_kwargs)
+        samples = self.map_files(load_fn, image_files)
+        images, targets = zip(*samples)
 
         return np.asarray(images), np.asarray(targets)
 
+    @staticmethod
+    def load_inference_image(image_path, pads, mask_path=None, **preprocessing_kwargs):
+        # DSA images already fit the network
+        return load_dsa_image(image_path, **preprocessing_kwargs), None
+
     @property
     def network_cls(self):
         return DsaNetwork
@@ -0,0 +1,95 @@
+"""This is the file for the background batch prefetcher"""
+import sys
+import threading
+import time
+import numpy as np
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class BatchPrefetcher(object):
+    """Produces the training batches of a `Dataset` on a background thread while the current step runs.
+
+    Batches are handed over through a queue bounded by `num_prefetch`, together with their `tf_reshape`d version. Every
+    batch is drawn with its own random state derived from `seed`, so the sequence of batches does not depend on thread
+    timing. With `num_prefetch=0` batches are produced synchronously."""
+
+    def __init__(self, dataset, n_epochs, num_prefetch=2, seed=None):
+        self.dataset = dataset
+        self.n_epochs = n_epochs
+        self.num_batches_in_epoch = dataset.num_batches_in_epoch()
+        self.num_prefetch = num_prefetch
+        self.seed = seed if seed is not None else np.random.randint(0, 2**31 - 1)
+        # batches are reused from a ring of buffers: one being consumed, one being produced and the queued ones
+        self.dataset.init_batch_buffers(num_prefetch + 2)
+
+        # input wait statistics
+        self.num_batches = 0
+        self.num_waits = 0
+        self.wait_time = 0.0
+
+        self.batches = self.generate_batches()
+        self.thread = None
+        if self.num_prefetch > 0:
+            self.queue = queue.Queue(maxsize=self.num_prefetch)
+            self.stop_event = threading.Event()
+            self.thread = threading.Thread(target=self.produce_batches, name="batch_prefetcher")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def generate_batches(self):
+        for epoch_i in range(self.n_epochs):
+            self.dataset.reset_batch_pointer()
+            for batch_i in range(self.num_batches_in_epoch):
+                batch_seed = (self.seed + epoch_i * self.num_batches_in_epoch + batch_i) % (2**31 - 1)
+                batch_data = self.dataset.next_batch(random_state=np.random.RandomState(batch_seed))
+                yield batch_data, self.dataset.tf_reshape(batch_data)
+
+    def produce_batches(self):
+        try:
+            for batch in self.batches:
+                if not self.put(batch):
+                    return
+        except Exception:
+            # hand the error over to the training loop
+            self.put(sys.exc_info())
+
+    def put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def next_batch(self):
+        """Return the next `(batch_data, tf_batch_data)` pair"""
+        self.num_batches += 1
+        if self.thread is None:
+            return next(self.batches)
+
+        start = time.time()
+        try:
+            item = self.queue.get_nowait()
+        except queue.Empty:
+            self.num_waits += 1
+            item = self.queue.get()
+            self.wait_time += time.time() - start
+        if len(item) == 3:
+            exc_type, exc_value, _ = item
+            raise exc_value
+        return item
+
+    def get_wait_summary(self):
+        wait_frac = float(self.num_waits) / self.num_batches if self.num_batches else 0.0
+        return "input waits: {}/{} batches ({:.1%}), total input wait time: {:.3f}s".format(
+            self.num_waits, self.num_batches, wait_frac, self.wait_time)
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
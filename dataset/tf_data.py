@@ -0,0 +1,188 @@
+"""This is the file for building `tf.data` input pipelines from `Dataset` arrays"""
+import os
+import threading
+import numpy as np
+import tensorflow as tf
+
+from dataset.array_view import ArrayView
+
+
+def get_view_params(arr):
+    """`(base, indices, scale, shift)` such that `arr` holds the images `indices` of `base * scale + shift`"""
+    if isinstance(arr, ArrayView):
+        return arr.base, arr.indices, arr.scale, arr.shift
+    return arr, np.arange(len(arr)), 1.0, 0.0
+
+
+def is_packed_file(arr):
+    """Whether `arr` memory-maps the whole of a raw file, like the arrays of `load_packed_arrays`"""
+    return isinstance(arr, np.memmap) and arr.filename is not None and arr.flags.c_contiguous and \
+        os.path.getsize(arr.filename) == arr.offset + arr.nbytes
+
+
+def random_flip_aug(sample, seed=None):
+    """Flip a `[height, width, channels]` sample left-right and up-down, each with probability .5"""
+    sample = tf.image.random_flip_left_right(sample, seed=seed)
+    return tf.image.random_flip_up_down(sample, seed=None if seed is None else seed + 1)
+
+
+class TFDataPipeline(object):
+    """A `tf.data.Dataset` over `data`, a tuple of equally long arrays such as `dataset.train_data`, whose arrays are
+    handed to the iterator initializer by `get_feed_dict`.
+
+    Samples are read by TF ops: packed memory-mapped arrays (`storage="memmap"`) record by record from their files,
+    other arrays from the copy fed to the initializer. The split and the dataset normalization of `ArrayView`s are
+    applied to the read samples, which are augmented, reshaped to `[height, width, 1]` float32 by
+    `num_parallel_calls` parallel map calls, batched and prefetched. Packed files are read in order, so they are
+    shuffled through a buffer of `shuffle_buffer_size` samples.
+
+    With `augment`, the samples are augmented by the dataset's `tf_aug`, a function of the `[height, width, channels]`
+    sample (the image, then its labels) and an int seed, built from TF ops such as `random_flip_aug`. Labels smaller
+    than the image (which is padded to the network input) are padded like it for the augmentation and cropped back
+    after, so geometric augmentations keep them aligned with the image. Only if the dataset has no `tf_aug` but an
+    imgaug `seq`, that runs as the fallback in a `tf.py_func`: it holds the GIL while it augments and ties the graph
+    to this Python process"""
+
+    def __init__(self, dataset, data, batch_size=1, shuffle=False, repeat=False, augment=False, num_parallel_calls=4,
+                 num_prefetch=2, shuffle_buffer_size=64, seed=None):
+        self.dataset = dataset
+        self.shuffle = shuffle
+        if seed is None:
+            seed = np.random.randint(0, 2**31 - 1)
+        self.seed = seed
+        bases = [get_view_params(arr)[0] for arr in data]
+        self.packed = all(is_packed_file(base) for base in bases)
+        self.base_dtypes = [np.dtype(base.dtype) for base in bases]
+        self.sample_shapes = [tuple(base.shape[1:]) for base in bases]
+        self.scales = [tf.placeholder(tf.float32, []) for _ in data]
+        self.shifts = [tf.placeholder(tf.float32, []) for _ in data]
+        self.tf_aug = dataset.tf_aug if augment else None
+        self.seq_aug = augment and self.tf_aug is None and dataset.seq is not None
+        self.pads = None
+        if self.tf_aug is not None and any(shape != self.sample_shapes[0] for shape in self.sample_shapes[1:]):
+            self.pads = self.get_label_pads(dataset.get_pads())
+        # the augmentation sequence is shared, so only re-seeding it is serialized
+        self.seq_lock = threading.Lock()
+
+        if self.packed:
+            tf_dataset, read_fn = self.read_packed_files(shuffle_buffer_size)
+        else:
+            tf_dataset, read_fn = self.read_arrays()
+        if repeat:
+            tf_dataset = tf_dataset.repeat()
+        # number the drawn samples so every draw of an image gets its own augmentation
+        tf_dataset = tf.data.Dataset.zip((tf_dataset, tf.data.Dataset.range(np.iinfo(np.int64).max)))
+        tf_dataset = tf_dataset.map(lambda source, sample_num: self.get_sample(read_fn(source), sample_num),
+                                    num_parallel_calls=num_parallel_calls)
+        tf_dataset = tf_dataset.batch(batch_size)
+        self.tf_dataset = tf_dataset.prefetch(num_prefetch)
+
+    def read_arrays(self):
+        """Samples gathered from the fed arrays, by a (shuffled) range over the indices of the split"""
+        self.arrays = [tf.placeholder(tf.as_dtype(dtype), (None,) + shape)
+                       for dtype, shape in zip(self.base_dtypes, self.sample_shapes)]
+        self.indices = [tf.placeholder(tf.int64, [None]) for _ in self.arrays]
+        num_samples = tf.shape(self.indices[0], out_type=tf.int64)[0]
+        tf_dataset = tf.data.Dataset.range(num_samples)
+        if self.shuffle:
+            tf_dataset = tf_dataset.shuffle(num_samples, seed=self.seed, reshuffle_each_iteration=True)
+
+        def read_fn(i):
+            return [tf.gather(arr, tf.gather(indices, i)) for arr, indices in zip(self.arrays, self.indices)]
+        return tf_dataset, read_fn
+
+    def read_packed_files(self, shuffle_buffer_size):
+        """Samples read record by record from the packed files, keeping the images of the split"""
+        self.file_names = [tf.placeholder(tf.string, []) for _ in self.sample_shapes]
+        self.header_bytes = [tf.placeholder(tf.int64, []) for _ in self.sample_shapes]
+        self.selected = tf.placeholder(tf.bool, [None])
+        records = tuple(tf.data.FixedLengthRecordDataset(file_name, int(np.prod(shape)) * dtype.itemsize,
+                                                         header_bytes=header_bytes)
+                        for file_name, header_bytes, dtype, shape in zip(self.file_names, self.header_bytes,
+                                                                         self.base_dtypes, self.sample_shapes))
+        tf_dataset = tf.data.Dataset.zip((tf.data.Dataset.range(np.iinfo(np.int64).max), tf.data.Dataset.zip(records)))
+        tf_dataset = tf_dataset.filter(lambda i, sample_records: tf.gather(self.selected, i))
+        tf_dataset = tf_dataset.map(lambda i, sample_records: sample_records)
+        if self.shuffle:
+            tf_dataset = tf_dataset.shuffle(shuffle_buffer_size, seed=self.seed, reshuffle_each_iteration=True)
+
+        def read_fn(sample_records):
+            return [tf.reshape(tf.decode_raw(record, tf.as_dtype(dtype)), shape)
+                    for record, dtype, shape in zip(sample_records, self.base_dtypes, self.sample_shapes)]
+        return tf_dataset, read_fn
+
+    def get_label_pads(self, pads):
+        """The `[[top, bottom], [left, right]]` padding of every array to the shape of the image, given the dataset's
+        padding `pads` (top, bottom, left, right) of the images"""
+        top_pad, bot_pad, left_pad, right_pad = pads
+        image_shape = self.sample_shapes[0]
+        label_pads = []
+        for shape in self.sample_shapes:
+            if shape == image_shape:
+                label_pads.append([[0, 0], [0, 0]])
+            elif (shape[0] + top_pad + bot_pad, shape[1] + left_pad + right_pad) == image_shape:
+                label_pads.append([[top_pad, bot_pad], [left_pad, right_pad]])
+            else:
+                raise ValueError("Labels of shape {} don't fit the images of shape {} with the pads {}".format(
+                    shape, image_shape, pads))
+        return label_pads
+
+    def apply_tf_aug(self, sample):
+        if self.pads is None:
+            return tf.unstack(self.tf_aug(tf.stack(sample, axis=-1), seed=self.seed), axis=-1)
+        sample = [tf.pad(arr, pads) for arr, pads in zip(sample, self.pads)]
+        sample = tf.unstack(self.tf_aug(tf.stack(sample, axis=-1), seed=self.seed), axis=-1)
+        return [arr[top_pad:top_pad + shape[0], left_pad:left_pad + shape[1]]
+                for arr, ((top_pad, _), (left_pad, _)), shape in zip(sample, self.pads, self.sample_shapes)]
+
+    def get_sample(self, sample, sample_num):
+        sample = [tf.cast(arr, tf.float32) * scale + shift for arr, scale, shift in zip(sample, self.scales, self.shifts)]
+        if self.tf_aug is not None:
+            sample = self.apply_tf_aug(sample)
+        elif self.seq_aug:
+            augmented = tf.py_func(self.augment_sample, [sample_num] + sample, [tf.float32] * len(sample),
+                                   stateful=False)
+            for arr, tensor in zip(sample, augmented):
+                tensor.set_shape(arr.shape)
+            sample = augmented
+        return tuple(tf.expand_dims(arr, axis=-1) for arr in sample)
+
+    def augment_sample(self, sample_num, *sample):
+        """The imgaug fallback, run in a `tf.py_func`"""
+        with self.seq_lock:
+            seq_det = self.dataset.get_seq_det(np.random.RandomState((self.seed + sample_num) % (2**31 - 1)))
+        sample = [self.dataset.apply_aug([sample[0]], seq_det)[0]] + \
+                 [self.dataset.apply_aug([arr], seq_det, masks=True)[0] for arr in sample[1:]]
+        return [np.asarray(arr, dtype=np.float32) for arr in sample]
+
+    def get_feed_dict(self, dataset, data):
+        """The feed of the iterator initializer reading `data`, arrays with the sample shapes, dtypes and storage the
+        pipeline was built for"""
+        self.dataset = dataset
+        views = [get_view_params(arr) for arr in data]
+        for (base, _, _, _), dtype, shape in zip(views, self.base_dtypes, self.sample_shapes):
+            if base.dtype != dtype or tuple(base.shape[1:]) != shape or is_packed_file(base) != self.packed:
+                raise ValueError("The pipeline was not built for arrays like {}".format(base.shape))
+        feed_dict = {}
+        for (_, _, scale, shift), scale_placeholder, shift_placeholder in zip(views, self.scales, self.shifts):
+            feed_dict[scale_placeholder] = scale
+            feed_dict[shift_placeholder] = shift
+        if not self.packed:
+            for (base, indices, _, _), arr_placeholder, indices_placeholder in zip(views, self.arrays, self.indices):
+                feed_dict[arr_placeholder] = base
+                feed_dict[indices_placeholder] = indices
+            return feed_dict
+
+        indices = views[0][1]
+        if any(not np.array_equal(view[1], indices) for view in views[1:]):
+            raise ValueError("Packed arrays are read together, they need the same indices")
+        # the files are read in order, which only matches the order of the split if its indices increase
+        if not self.shuffle and np.any(np.diff(indices) <= 0):
+            raise ValueError("Packed arrays are read in file order, unshuffled splits need increasing indices")
+        selected = np.zeros(len(views[0][0]), dtype=np.bool_)
+        selected[indices] = True
+        feed_dict[self.selected] = selected
+        for (base, _, _, _), file_name, header_bytes in zip(views, self.file_names, self.header_bytes):
+            feed_dict[file_name] = base.filename
+            feed_dict[header_bytes] = base.offset
+        return feed_dict
@@ -1,11 +1,13 @@
 """This is the file for the base Job class"""
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 import matplotlib
 matplotlib.use('Agg')
 
 import os
 import time
-import glob
+import json
+import struct
 
 from scipy.misc import imsave
 import numpy as np
@@ -19,10 +21,19 @@ from sklearn.model_selection import KFold, ShuffleSplit
 from random import randint
 
 from utilities.output_ops import draw_results
+from utilities.misc import get_json_serializable, get_init_arg_names, save_array_once
+from metrics.histogram import ScoreHistogram, EvaluationAccumulator, get_histogram_metric_scores, get_kappa
 import csv
 from numpy import genfromtxt
 from statsmodels import robust
 from dataset.base import Dataset
+from dataset.prefetch import BatchPrefetcher
+from job.evaluator import AsyncEvaluator
+from job.early_stopping import EarlyStopping
+from job.prediction_store import PredictionStore
+from job.scheduler import MemberScheduler, get_threads_per_member
+from dataset.tf_data import TFDataPipeline, get_view_params, is_packed_file
+from utilities.tiling import get_tile_grid, get_tile_batches, extract_tiles, TileBlender
 
 
 class Job(object):
@@ -40,10 +51,29 @@ class Job(object):
 
     n_epochs = 100
 
+    # tiled inference for networks trained on patches
+    tile_overlap = 0
+    tile_blending = None
+    tile_batch_size = None
+
+    # test and val images per `sess.run`
+    eval_batch_size = 1
+
+    # "float16" or "uint8", the precision test set predictions are saved with, see `PredictionStore`
+    prediction_dtype = "float16"
+
+    # "sklearn" or "histogram", see `get_metrics_on_test_set`
+    metrics_engine = "sklearn"
+
+    # (key, network, graph ops) of the last network built by a run with `reuse_graph` in this process, see
+    # `get_network_key` and `create_graph_ops`
+    network_cache = None
+
     def __init__(self, OUTPUTS_DIR_PATH="."):
         if not os.path.exists(OUTPUTS_DIR_PATH):
             os.makedirs(OUTPUTS_DIR_PATH)
         self.OUTPUTS_DIR_PATH = OUTPUTS_DIR_PATH
+        self.evaluator = None
 
     def run_single_model(self, **kwargs):
         # kwargs are applied to train method
@@ -53,7 +83,8 @@ class Job(object):
 
     # only metrics are returned per fold
     # for most other output, only last is kept
-    def run_cv(self, n_splits=3, mc=False, val_prop=.20, mof_metric="mad", **kwargs):
+    def run_cv(self, n_splits=3, mc=False, val_prop=.20, mof_metric="mad", max_concurrent=1, threads_per_member=None,
+               max_retries=0, reuse_graph=False, **kwargs):
         # produce cv indices
         if not mc:
             fold_obj = KFold(n_splits=n_splits, shuffle=True)
@@ -73,7 +104,10 @@ class Job(object):
         metrics_log_fname_lst = os.path.splitext(metrics_log)
         folds_metrics_log_fname = []
 
-        # run job per cv fold
+        # run job per cv fold, `max_concurrent` folds at a time, or one after another in this process to share the graph
+        scheduler = MemberScheduler(self.train, max_concurrent=max_concurrent, max_retries=max_retries,
+                                    in_process=reuse_graph)
+        intra_op_threads = get_threads_per_member(max_concurrent, threads_per_member)
         for i, (train_inds, test_inds) in enumerate(fold_obj.split(imgs)):
             fold_metrics_log_fname_lst = list(metrics_log_fname_lst)
             fold_suffix = "_fold_"+str(i)
@@ -84,12 +118,14 @@ class Job(object):
             folds_metrics_log_fname += [fold_metrics_log_fname]
             fold_kwargs["cv_train_inds"] = train_inds
             fold_kwargs["cv_test_inds"] = test_inds
+            fold_kwargs["run_suffix"] = "_{:03d}".format(i)
+            fold_kwargs["reuse_graph"] = reuse_graph
+            fold_kwargs.setdefault("intra_op_threads", intra_op_threads)
 
             # fold_kwargs are applied to train method
+            scheduler.add("fold_" + str(i), fold_kwargs)
 
-            p = multiprocessing.Process(target=self.train, kwargs=fold_kwargs)
-            p.start()
-            p.join()
+        scheduler.run()
 
         # define func for measure of fit
         if mof_metric == "mad":
@@ -127,7 +163,9 @@ class Job(object):
             self.write_to_csv(row, combined_metrics_log_path)
 
     def run_ensemble(self, ensemble_count=10, combining_metric="mean", wce_start_tuning_constant=.5,
-                     wce_end_tuning_constant=2.0, wce_tuning_constants=None, **kwargs):
+                     wce_end_tuning_constant=2.0, wce_tuning_constants=None, ensemble_weights=None, ensemble_trim=1,
+                     ensemble_memory_budget=1 << 28, ensemble_num_workers=1, max_concurrent=1,
+                     threads_per_member=None, max_retries=0, reuse_graph=False, **kwargs):
 
         if wce_tuning_constants is not None:
             assert len(wce_tuning_constants) == ensemble_count
@@ -151,6 +189,10 @@ class Job(object):
         dataset = self.dataset_cls(**kwargs)
         kwargs["dataset"] = dataset
 
+        # train `max_concurrent` models at a time, or one after another in this process to share the graph
+        scheduler = MemberScheduler(self.train, max_concurrent=max_concurrent, max_retries=max_retries,
+                                    in_process=reuse_graph)
+        intra_op_threads = get_threads_per_member(max_concurrent, threads_per_member)
         for i in range(ensemble_count):
             model_kwargs = kwargs.copy()
             model_metrics_log_fname_lst = list(metrics_log_fname_lst)
@@ -164,11 +206,13 @@ class Job(object):
                 wce_tuning_constant = wce_tuning_constants[i]
 
             model_kwargs["tuning_constant"] = wce_tuning_constant
+            model_kwargs["run_suffix"] = "_{:03d}".format(i)
+            model_kwargs["reuse_graph"] = reuse_graph
+            model_kwargs.setdefault("intra_op_threads", intra_op_threads)
 
-            p = multiprocessing.Process(target=self.train, kwargs=model_kwargs)
-            p.start()
-            p.join()
+            scheduler.add("model_" + str(i), model_kwargs)
 
+        scheduler.run()
 
         n_epochs = kwargs.pop("n_epochs", self.n_epochs)
         num_thresh_scores = kwargs.pop("num_thresh_scores", self.num_thresh_scores)
@@ -183,14 +227,21 @@ class Job(object):
 
         self.get_ensemble_results(n_epochs, decision_threshold, num_thresh_scores, test_neg_class_frac,
                                   test_pos_class_frac, metrics_log=metrics_log, combining_metric=combining_metric,
-                                  **kwargs)
+                                  ensemble_weights=ensemble_weights, ensemble_trim=ensemble_trim,
+                                  ensemble_memory_budget=ensemble_memory_budget,
+                                  ensemble_num_workers=ensemble_num_workers, **kwargs)
 
     
     def train(self, dataset=None, gpu_device=None, early_stopping=False, early_stopping_metric="auc",
               tuning_constant=1.0, metrics_epoch_freq=1, viz_layer_epoch_freq=10, metrics_log="metrics_log.csv",
-              num_image_plots=5, save_model=True, save_sample_test_images=True,debug_net_output=True, **kwargs):
+              num_image_plots=5, save_model=True, save_sample_test_images=True,debug_net_output=True,
+              num_prefetch_batches=2, prefetch_seed=None, input_pipeline="feed_dict", num_parallel_calls=4,
+              async_eval=False, early_stopping_patience=None, early_stopping_min_delta=0.0,
+              early_stopping_snapshot="memory", time_budget=None, intra_op_threads=None, inter_op_threads=None,
+              run_suffix="", grad_accum_steps=1, reuse_graph=False, **kwargs):
 
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
+        # `run_suffix` tells apart the runs of concurrent members started in the same second
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S") + run_suffix
 
         # get `n_epochs` values from kwargs if exists
         if "n_epochs" in kwargs:
@@ -201,20 +252,77 @@ class Job(object):
         # get `decision_threshold` values from kwargs if exists
         if "decision_threshold" in kwargs:
             self.decision_threshold = kwargs.pop("decision_threshold")
+        # get tiled inference settings from kwargs if exist
+        for tile_kwarg in ("tile_overlap", "tile_blending", "tile_batch_size"):
+            if tile_kwarg in kwargs:
+                setattr(self, tile_kwarg, kwargs.pop(tile_kwarg))
+        if "metrics_engine" in kwargs:
+            self.metrics_engine = kwargs.pop("metrics_engine")
+        if "eval_batch_size" in kwargs:
+            self.eval_batch_size = kwargs.pop("eval_batch_size")
+        if "prediction_dtype" in kwargs:
+            self.prediction_dtype = kwargs.pop("prediction_dtype")
 
         # kwargs are applied to dataset class
         if dataset is None:
             dataset = self.dataset_cls(early_stopping=early_stopping, **kwargs)
         pos_weight = dataset.get_tuned_pos_ce_weight(tuning_constant, *dataset.train_data[1:])
+        # a network trained on patches is evaluated tile by tile
+        kwargs["patch_size"] = dataset.patch_size
+        # the network applies the gradients of every `grad_accum_steps` batches as one update
+        kwargs["grad_accum_steps"] = grad_accum_steps
+        # with mixed precision, convs run in half precision on a gpu `gpu_device`
+        kwargs.setdefault("compute_precision", self.network_cls.get_device_compute_precision(
+            kwargs.get("precision", "float32"), gpu_device))
+        # in-graph score histograms replace the host-side histogram of the test results
+        if kwargs.get("metrics_n_bins") is not None:
+            if self.metrics_engine != "histogram":
+                raise ValueError("In-graph metrics (`metrics_n_bins`) need metrics_engine=\"histogram\"")
+            if dataset.patch_size is not None:
+                raise ValueError("In-graph metrics are not supported for networks trained on patches")
+
+        # with `reuse_graph`, the network of the previous run in this process is trained again if only its
+        # hyperparameters differ, instead of building a new graph
+        network, graph_ops = None, None
+        if input_pipeline not in ("feed_dict", "tf_data"):
+            raise ValueError("Input pipeline {} not recognized".format(input_pipeline))
+        if reuse_graph:
+            input_key = None
+            if input_pipeline == "tf_data":
+                input_key = self.get_input_key(dataset, early_stopping=early_stopping,
+                                               num_parallel_calls=num_parallel_calls, seed=prefetch_seed)
+            network_key = self.get_network_key(kwargs, gpu_device=gpu_device, input_pipeline=input_pipeline,
+                                               input_key=input_key)
+            network, graph_ops = self.get_cached_network(network_key)
+
+        # with `tf_data`, the network reads its inputs from `tf.data` iterators instead of the feed dict
+        if input_pipeline == "tf_data":
+            if dataset.patch_size is not None:
+                raise ValueError("Patch training is not supported by the `tf_data` input pipeline")
+            if graph_ops is None:
+                kwargs["input_structure"] = self.init_tf_datasets(dataset, early_stopping=early_stopping,
+                                                                  num_parallel_calls=num_parallel_calls,
+                                                                  seed=prefetch_seed)
+            else:
+                self.tf_pipelines = graph_ops["tf_pipelines"]
+            self.input_feeds = self.get_input_feeds(dataset, early_stopping=early_stopping)
+            # there are no host-side batches to produce debug images from
+            debug_net_output = False
 
         # initialize network object
-        if gpu_device is not None:
-            with tf.device(gpu_device):
-                network = self.network_cls(pos_weight=pos_weight, num_batches_in_epoch = dataset.num_batches_in_epoch(),
+        if network is None:
+            if gpu_device is not None:
+                with tf.device(gpu_device):
+                    network = self.network_cls(pos_weight=pos_weight,
+                                               num_batches_in_epoch=dataset.num_batches_in_epoch(), **kwargs)
+            else:
+                network = self.network_cls(pos_weight=pos_weight, num_batches_in_epoch=dataset.num_batches_in_epoch(),
                                            **kwargs)
-        else:
-            network = self.network_cls(pos_weight=pos_weight, num_batches_in_epoch=dataset.num_batches_in_epoch(),
-                                       **kwargs)
+        if graph_ops is None:
+            graph_ops = self.create_graph_ops(network)
+            if reuse_graph:
+                Job.network_cache = (network_key, network, graph_ops)
+        kwargs.pop("input_structure", None)
 
         # create metrics log file
         metric_log_file_path = os.path.join(self.OUTPUTS_DIR_PATH, metrics_log)
@@ -230,7 +338,10 @@ class Job(object):
 
         # create directories and subdirectories
         if save_model:
-            os.makedirs(os.path.join(self.OUTPUTS_DIR_PATH, 'save', network.description, timestamp))
+            save_path = os.path.join(self.OUTPUTS_DIR_PATH, 'save', network.description, timestamp)
+            os.makedirs(save_path)
+            self.save_model_config(save_path, network, dataset,
+                                   self.get_network_kwargs(dict(kwargs, pos_weight=pos_weight)))
 
         viz_layer_outputs_path_test = None
         if viz_layer_epoch_freq is not None:
@@ -239,40 +350,70 @@ class Job(object):
 
         config = tf.ConfigProto(allow_soft_placement=True, log_device_placement=True)
         config.gpu_options.allow_growth = True
+        # cpu threads of the session, `None` lets TF use all cores
+        if intra_op_threads is not None:
+            config.intra_op_parallelism_threads = intra_op_threads
+        if inter_op_threads is not None:
+            config.inter_op_parallelism_threads = inter_op_threads
 
         with tf.Session(config=config) as sess:
-            sess.run(tf.global_variables_initializer())
-            tf.train.Saver(tf.all_variables(), max_to_keep=None)
+            sess.run(graph_ops["init_op"])
+            if reuse_graph:
+                # the graph may have been built with the hyperparameters of another run
+                network.set_hyperparameters(sess, pos_weight=pos_weight,
+                                            num_batches_in_epoch=dataset.num_batches_in_epoch(), **kwargs)
+            saver = graph_ops["saver"]
 
             if early_stopping:
-                best_early_stopping = None
+                if early_stopping_snapshot == "disk" and "snapshot_saver" not in graph_ops:
+                    graph_ops["snapshot_saver"] = tf.train.Saver(tf.global_variables(), max_to_keep=1)
+                early_stopper = EarlyStopping(early_stopping_metric, patience=early_stopping_patience,
+                                              min_delta=early_stopping_min_delta, snapshot=early_stopping_snapshot,
+                                              snapshot_path=os.path.join(self.OUTPUTS_DIR_PATH, "early_stopping",
+                                                                         timestamp, "best"),
+                                              time_budget=time_budget, saver=graph_ops.get("snapshot_saver"))
+
+            if network.input_handle is not None:
+                self.init_input_handles(sess, graph_ops)
+                prefetcher = None
+            else:
+                # batches (already reshaped for tensorflow) are produced in the background
+                prefetcher = BatchPrefetcher(dataset, self.n_epochs, num_prefetch=num_prefetch_batches,
+                                             seed=prefetch_seed)
+
+            # with `async_eval`, test set metrics, logs and plots are produced while the next epochs train
+            self.evaluator = AsyncEvaluator() if async_eval else None
 
             # loop over epochs
+            train_start = time.time()
             for epoch_i in range(self.n_epochs):
-                dataset.reset_batch_pointer()
                 # loop over batches in epoch
                 for batch_i in range(dataset.num_batches_in_epoch()):
                     start = time.time()
                     batch_num = epoch_i * dataset.num_batches_in_epoch() + batch_i
 
-                    batch_data = dataset.next_batch()
+                    if prefetcher is not None:
+                        batch_data, tf_batch_data = prefetcher.next_batch()
+                    else:
+                        batch_data, tf_batch_data = None, None
 
                     # produce debug image 1
                     if viz_layer_epoch_freq is not None and debug_net_output:
                         self.save_debug1(batch_data, viz_layer_outputs_path_train)
 
-                    # reshape array for tensorflow
-                    batch_data = dataset.tf_reshape(batch_data)
+                    batch_data = tf_batch_data
 
                     # produce debug image 2
                     if viz_layer_epoch_freq is not None and debug_net_output:
                         self.save_debug2(batch_data, viz_layer_outputs_path_train)
 
-                    # train on batch
-                    cost, cost_unweighted, layer_outputs, debug1, _, cur_learning_rate = sess.run(
-                        [network.cost, network.cost_unweighted, network.layer_outputs, network.debug1,
-                         network.train_op, network.cur_learning_rate],
-                        feed_dict=self.get_network_dict(network, batch_data))
+                    # train on batch, the layer outputs are only fetched for the visualized batch
+                    viz_batch = viz_layer_epoch_freq is not None and (epoch_i + 1) % viz_layer_epoch_freq == 0 and \
+                        batch_i == dataset.num_batches_in_epoch() - 1
+                    cost, cost_unweighted, debug1, cur_learning_rate, layer_outputs = self.run_train_step(
+                        network, sess, batch_data, fetch_layer_outputs=viz_batch)
+                    if network.apply_gradients_op is not None and (batch_num + 1) % grad_accum_steps == 0:
+                        sess.run(network.apply_gradients_op)
                     end = time.time()
                     # print training information
                     print('{}/{}, epoch: {}, cost: {}, cost unweighted: {}, batch time: {}, positive_weight: {}, learning rate {}'.format(
@@ -283,157 +424,445 @@ class Job(object):
                         self.save_debug3(batch_data,debug1,viz_layer_outputs_path_train)
 
                     # create network visualization output
-                    if viz_layer_epoch_freq is not None and (epoch_i + 1) % viz_layer_epoch_freq == 0 and \
-                                    batch_i == dataset.num_batches_in_epoch()-1:
+                    if viz_batch:
                         self.create_viz_layer_output(layer_outputs, self.decision_threshold,
                                                      viz_layer_outputs_path_train)
 
                     # calculate results on test set
                     if (epoch_i + 1) % metrics_epoch_freq == 0 and batch_i == dataset.num_batches_in_epoch()-1:
+                        improved = False
                         if early_stopping:
                             cur_early_stopping = self.get_results_on_val_set(metric_log_file_path, network, dataset, sess,
                                                                              self.decision_threshold,
                                                                              early_stopping_metric, save_model)
-                            if not best_early_stopping:
-                                best_early_stopping = cur_early_stopping
-                            elif early_stopping_metric not in ["cost","cost_unweighted"]:
-                                if cur_early_stopping > best_early_stopping:
-                                    best_early_stopping = cur_early_stopping
-                            else:
-                                if cur_early_stopping < best_early_stopping:
-                                    best_early_stopping = cur_early_stopping
+                            improved = early_stopper.update(cur_early_stopping, sess, epoch_i)
                             # if current model has best validation loss, re-create metric file
-                            if cur_early_stopping == best_early_stopping:
-                                self.write_to_csv(sorted(self.get_metric_names(self.num_thresh_scores)),
-                                                  metric_log_file_path, mode="w")
-                        if not early_stopping or cur_early_stopping == best_early_stopping:
+                            if improved:
+                                self.run_report(self.write_to_csv,
+                                                sorted(self.get_metric_names(self.num_thresh_scores)),
+                                                metric_log_file_path, mode="w")
+                        if not early_stopping or improved:
                             self.get_results_on_test_set(metric_log_file_path, network, dataset, sess,
                                                          self.decision_threshold, epoch_i, timestamp, viz_layer_epoch_freq,
                                                          viz_layer_outputs_path_test, num_image_plots, save_model,
                                                          save_sample_test_images, summary_writer, cost=cost,
                                                          cost_unweighted=cost_unweighted)
+                        # checkpoint every evaluated model, with early stopping only the best one at the end
+                        if save_model and not early_stopping:
+                            saver.save(sess, os.path.join(save_path, "model"), global_step=epoch_i)
+
+                if prefetcher is not None:
+                    print("epoch: {}, {}".format(epoch_i, prefetcher.get_wait_summary()))
+                if early_stopping and early_stopper.should_stop():
+                    break
+                # with early stopping, `early_stopper` keeps the time budget
+                if not early_stopping and time_budget is not None and time.time() - train_start > time_budget:
+                    print("time budget of {}s used up after epoch {}".format(time_budget, epoch_i))
+                    break
+            if prefetcher is not None:
+                prefetcher.close()
+
+            # continue with (and save) the best weights
+            if early_stopping:
+                early_stopper.restore(sess)
+                if save_model and early_stopper.best_epoch is not None:
+                    saver.save(sess, os.path.join(save_path, "model"), global_step=early_stopper.best_epoch)
+            if self.evaluator is not None:
+                self.evaluator.close()
+                self.evaluator = None
+
+    def run_train_step(self, network, sess, batch_data, fetch_layer_outputs=False):
+        """Run `train_op` on one batch and return the costs, `debug1`, the learning rate and the layer outputs (`None`
+        unless `fetch_layer_outputs`). Fetching the layer outputs keeps every activation alive until the step ends and
+        copies them to the host, which undoes `recompute_segments`, so they are only fetched when visualized"""
+        fetches = [network.cost, network.cost_unweighted, network.debug1, network.cur_learning_rate, network.train_op]
+        if fetch_layer_outputs:
+            fetches.append(network.layer_outputs)
+        outputs = sess.run(fetches, feed_dict=self.get_network_dict(network, batch_data))
+        layer_outputs = outputs[5] if fetch_layer_outputs else None
+        return outputs[0], outputs[1], outputs[2], outputs[3], layer_outputs
+
+    def get_network_key(self, network_kwargs, gpu_device=None, input_pipeline="feed_dict", input_key=None):
+        """What tells apart the graphs built for runs with `network_kwargs`: the network class, device, input
+        pipeline (with the `get_input_key` of `tf_data` pipelines) and the keyword arguments other than the dataset's
+        and the hyperparameters `Network.set_hyperparameters` loads into a built graph"""
+        key_kwargs = self.get_network_kwargs(network_kwargs)
+        key_kwargs.pop("num_batches_in_epoch", None)
+        key_kwargs.pop("pos_weight", None)
+        if key_kwargs.get("objective_fns") is not None:
+            key_kwargs.pop("objective_fn", None)
+        if "learning_rate_and_kwargs" in key_kwargs:
+            # whether and how the learning rate decays is part of the graph, its base and decay steps are not
+            _, learning_rate_kwargs = key_kwargs["learning_rate_and_kwargs"]
+            key_kwargs["learning_rate_and_kwargs"] = sorted((key, value) for key, value in learning_rate_kwargs.items()
+                                                            if key != "decay_epochs")
+        # values json can't write, e.g. layer objects, are told apart by their repr (their identity by default)
+        network_name = "{}.{}".format(self.network_cls.__module__, self.network_cls.__name__)
+        return network_name, gpu_device, input_pipeline, input_key, json.dumps(key_kwargs, sort_keys=True,
+                                                                               default=repr)
+
+    def get_network_kwargs(self, kwargs):
+        """The entries of the keyword arguments of a run that are not the dataset's"""
+        dataset_arg_names = get_init_arg_names(self.dataset_cls) - get_init_arg_names(self.network_cls)
+        return dict((key, value) for key, value in kwargs.items() if key not in dataset_arg_names)
+
+    def get_input_key(self, dataset, early_stopping=False, num_parallel_calls=4, seed=None):
+        """What tells apart the `tf_data` pipelines `init_tf_datasets` builds: the splits, the sample shapes, dtypes and
+        storage of their arrays, the batching and the augmentation. Other data of the same kind is only fed to them"""
+        splits = [dataset.train_data, dataset.test_data] + ([dataset.val_data] if early_stopping else [])
+        arrays = [[(str(get_view_params(arr)[0].dtype), tuple(arr.shape[1:]), is_packed_file(get_view_params(arr)[0]))
+                   for arr in data] for data in splits]
+        return json.dumps([arrays, dataset.batch_size, self.eval_batch_size, dataset.sgd, num_parallel_calls, seed,
+                           repr(dataset.tf_aug), repr(dataset.seq)])
+
+    def get_cached_network(self, network_key):
+        """The network and graph ops (see `create_graph_ops`) of the last run with `reuse_graph` if it has
+        `network_key`, otherwise `(None, None)` after resetting the default graph for a new network"""
+        if Job.network_cache is not None and Job.network_cache[0] == network_key:
+            print("reusing the graph of {}".format(Job.network_cache[1].description))
+            return Job.network_cache[1:]
+        Job.network_cache = None
+        tf.reset_default_graph()
+        return None, None
+
+    def create_graph_ops(self, network):
+        """The ops a run adds to the graph of `network`: the variable initializer, the checkpoint saver and the
+        iterators of the `tf_data` pipelines. With `reuse_graph` they are kept with the network in
+        `Job.network_cache`, so later runs only re-initialize the variables and feed their own data"""
+        graph_ops = {"init_op": tf.global_variables_initializer(),
+                     "saver": tf.train.Saver(tf.global_variables(), max_to_keep=None)}
+        if network.input_handle is not None:
+            graph_ops["tf_pipelines"] = self.tf_pipelines
+            graph_ops["input_iterators"] = dict((split, pipeline.tf_dataset.make_initializable_iterator())
+                                                for split, pipeline in self.tf_pipelines.items())
+            graph_ops["input_handles"] = dict((split, iterator.string_handle())
+                                              for split, iterator in graph_ops["input_iterators"].items())
+        return graph_ops
+
+    @staticmethod
+    def save_model_config(save_path, network, dataset, network_kwargs):
+        """Write what `Predictor` needs to rebuild the network and to load images like the training images. Classes and
+        functions in `network_kwargs` are stored by name, anything else json can't write raises a `TypeError`"""
+        config = {"network_cls": [type(network).__module__, type(network).__name__],
+                  "network_kwargs": get_json_serializable(network_kwargs, "network_kwargs"),
+                  "dataset": dataset.get_config()}
+        with open(os.path.join(save_path, "config.json"), "w") as f:
+            json.dump(config, f, indent=2)
+
+    def init_tf_datasets(self, dataset, early_stopping=False, num_parallel_calls=4, seed=None):
+        """Build the `tf.data` pipelines per split and return the structure the network iterator is built from"""
+        self.tf_pipelines = {"train": TFDataPipeline(dataset, dataset.train_data, batch_size=dataset.batch_size,
+                                                     shuffle=dataset.sgd, repeat=True, augment=True,
+                                                     num_parallel_calls=num_parallel_calls, seed=seed),
+                             "test": TFDataPipeline(dataset, dataset.test_data, batch_size=self.eval_batch_size,
+                                                    num_parallel_calls=num_parallel_calls)}
+        if early_stopping:
+            self.tf_pipelines["val"] = TFDataPipeline(dataset, dataset.val_data, batch_size=self.eval_batch_size,
+                                                      num_parallel_calls=num_parallel_calls)
+        tf_dataset = self.tf_pipelines["train"].tf_dataset
+        return tf_dataset.output_types, tf_dataset.output_shapes
+
+    def get_input_feeds(self, dataset, early_stopping=False):
+        """The iterator initializer feeds of the `tf_data` pipelines for the splits of `dataset`"""
+        splits = {"train": dataset.train_data, "test": dataset.test_data}
+        if early_stopping:
+            splits["val"] = dataset.val_data
+        return dict((split, self.tf_pipelines[split].get_feed_dict(dataset, data)) for split, data in splits.items())
+
+    def init_input_handles(self, sess, graph_ops):
+        self.input_iterators = graph_ops["input_iterators"]
+        self.input_handles = {}
+        for split, iterator in self.input_iterators.items():
+            sess.run(iterator.initializer, feed_dict=self.input_feeds[split])
+            self.input_handles[split] = sess.run(graph_ops["input_handles"][split])
+
+    def reset_input_iterator(self, network, sess, split):
+        # evaluation walks the split in order, in sync with the host-side targets and masks
+        if network.input_handle is not None:
+            sess.run(self.input_iterators[split].initializer, feed_dict=self.input_feeds[split])
+
+    def run_image(self, network, dataset, sess, image_data, split="test", fetch_layer_outputs=True):
+        """Return the costs, the `[height, width]` segmentation and the layer outputs (`None` unless
+        `fetch_layer_outputs`) for one `tf_reshape`d image.
+
+        Networks trained on patches run on a grid of tiles covering the image, which are stitched back together"""
+        if network.patch_size is None:
+            fetches = [network.cost, network.cost_unweighted, network.segmentation_result]
+            if fetch_layer_outputs:
+                fetches.append(network.layer_outputs)
+            outputs = sess.run(fetches, feed_dict=self.get_network_dict(network, image_data, False, split=split))
+            layer_outputs = outputs[3] if fetch_layer_outputs else None
+            return outputs[0], outputs[1], outputs[2][0, :, :, 0], layer_outputs
+
+        # tiles overlap by `tile_overlap` pixels, are run `tile_batch_size` at a time and blended with `tile_blending`
+        height, width = image_data[-1].shape[1:3]
+        tile_grid = get_tile_grid(height, width, network.patch_size, overlap=self.tile_overlap)
+        top_pad, _, left_pad, _ = dataset.get_pads()
+        blender = TileBlender((height, width), network.patch_size, blending=self.tile_blending)
+        cost = 0.0
+        cost_unweighted = 0.0
+        layer_outputs = None
+        tile_batches = get_tile_batches(tile_grid, self.tile_batch_size)
+        for batch_i, batch_grid in enumerate(tile_batches):
+            tiles_data = [extract_tiles(image_data[0][0, :, :, 0], batch_grid, network.patch_size, top_pad, left_pad)]
+            tiles_data += [extract_tiles(arr[0, :, :, 0], batch_grid, network.patch_size) for arr in image_data[1:]]
+            fetches = [network.cost, network.cost_unweighted, network.segmentation_result]
+            # the layer outputs of the last tile batch are visualized
+            if fetch_layer_outputs and batch_i == len(tile_batches) - 1:
+                fetches.append(network.layer_outputs)
+            outputs = sess.run(fetches, feed_dict=self.get_network_dict(network, dataset.tf_reshape(tiles_data), False,
+                                                                         split=split))
+            cost += outputs[0] * len(batch_grid)
+            cost_unweighted += outputs[1] * len(batch_grid)
+            blender.add(outputs[2][..., 0], batch_grid)
+            if len(outputs) > 3:
+                layer_outputs = outputs[3]
+        return cost / len(tile_grid), cost_unweighted / len(tile_grid), blender.result(), layer_outputs
+
+    def run_images(self, network, dataset, sess, data, split="test", viz_image=None, num_results=None):
+        """Yield `(image_data, cost, cost_unweighted, segmentation_result, layer_outputs, score_histogram)` for every
+        image of `data` (e.g. `dataset.test_data`), with `image_data` the `tf_reshape`d image.
+
+        Whole images are run `eval_batch_size` at a time and the costs are those of their batch. `layer_outputs` are
+        only fetched for image `viz_image`, segmentations only for the first `num_results` images (all by default) and
+        score histograms only for networks with in-graph metrics; what is not fetched is `None`"""
+        self.reset_input_iterator(network, sess, split)
+        if network.patch_size is not None:
+            for i, image_data in enumerate(zip(*data)):
+                image_data = dataset.tf_reshape(image_data)
+                cost, cost_unweighted, segmentation_result, layer_outputs = \
+                    self.run_image(network, dataset, sess, image_data, split=split, fetch_layer_outputs=i == viz_image)
+                yield image_data, cost, cost_unweighted, segmentation_result, layer_outputs, None
+            return
+
+        num_images = len(data[0])
+        for start in range(0, num_images, self.eval_batch_size):
+            end = min(start + self.eval_batch_size, num_images)
+            batch_data = dataset.tf_reshape([arr[start:end] for arr in data])
+            fetch_results = num_results is None or start < num_results
+            fetch_layer_outputs = viz_image is not None and start <= viz_image < end
+            fetches = [network.cost, network.cost_unweighted]
+            if network.score_histogram is not None:
+                fetches.append(network.score_histogram)
+            if fetch_results:
+                fetches.append(network.segmentation_result)
+            if fetch_layer_outputs:
+                fetches.append(network.layer_outputs)
+            outputs = sess.run(fetches, feed_dict=self.get_network_dict(network, batch_data, False, split=split))
+            cost, cost_unweighted = outputs[:2]
+            outputs = outputs[2:]
+            score_histograms = outputs.pop(0) if network.score_histogram is not None else None
+            segmentation_results = outputs.pop(0) if fetch_results else None
+            layer_outputs = outputs.pop(0) if fetch_layer_outputs else None
+
+            for k in range(end - start):
+                yield (tuple(arr[k:k + 1] for arr in batch_data), cost, cost_unweighted,
+                       segmentation_results[k, :, :, 0] if segmentation_results is not None else None,
+                       [layer_output[k:k + 1] for layer_output in layer_outputs] if start + k == viz_image else None,
+                       score_histograms[k] if score_histograms is not None else None)
 
     def get_results_on_test_set(self, metrics_log_file_path, network, dataset, sess, decision_threshold, epoch_i,
                                 timestamp, viz_layer_epoch_freq, viz_layer_outputs_path_test, num_image_plots,
                                 save_model, save_sample_test_images, summary_writer, **kwargs):
 
-        max_thresh_accuracy = 0.0
         test_cost = 0.0
         test_cost_unweighted = 0.0
 
-        segmentation_results = np.zeros((dataset.test_targets.shape[0], dataset.test_targets.shape[1],
-                                         dataset.test_targets.shape[2]))
+        # test images are added to the accumulator one by one. Only the sklearn metrics engine needs all results at once
+        accumulator = EvaluationAccumulator(n_bins=network.metrics_n_bins or 10000)
+        results_shape = dataset.test_targets.shape[:3]
+        segmentation_results = np.zeros(results_shape) if self.metrics_engine == "sklearn" else None
+        # as are the labels, which are collected image by image instead of loading the (lazy) test arrays whole
+        test_targets, test_masks = None, None
+        if segmentation_results is not None:
+            test_targets = np.zeros(results_shape, dtype=np.float32)
+            test_masks = np.zeros(results_shape, dtype=np.float32) if len(dataset.test_data) > 2 else None
+        plot_results = np.zeros((min(num_image_plots, results_shape[0]),) + results_shape[1:])
+        saved_results = self.save_data(network, dataset, timestamp, epoch_i) if save_model else None
         sample_test_image = randint(0, len(dataset.test_images) - 1)
+        viz_image = None
+        if viz_layer_epoch_freq is not None and (epoch_i + 1) % viz_layer_epoch_freq == 0:
+            viz_image = sample_test_image
+        # with in-graph metrics only the costs and the score histograms leave the device, unless results are plotted or
+        # saved
+        num_results = None
+        if network.score_histogram is not None and saved_results is None:
+            num_results = len(plot_results)
         # get test results per image
-        for i, test_data in enumerate(zip(*dataset.test_data)):
-            test_data = dataset.tf_reshape(test_data)
-            # get network results on test image
-            test_cost_, test_cost_unweighted_, segmentation_test_result, layer_outputs = \
-                sess.run([network.cost, network.cost_unweighted, network.segmentation_result,
-                          network.layer_outputs],
-                         feed_dict=self.get_network_dict(network, test_data, False))
-
-            segmentation_test_result = segmentation_test_result[0, :, :, 0]
-            segmentation_results[i, :, :] = segmentation_test_result
+        for i, (test_data, test_cost_, test_cost_unweighted_, segmentation_test_result, layer_outputs,
+                score_histogram) in enumerate(self.run_images(network, dataset, sess, dataset.test_data, split="test",
+                                                              viz_image=viz_image, num_results=num_results)):
+            if segmentation_results is not None:
+                segmentation_results[i, :, :] = segmentation_test_result
+                test_targets[i] = np.round(test_data[-1][0, :, :, 0])
+                if test_masks is not None:
+                    test_masks[i] = self.get_image_mask(test_data)[0, :, :, 0]
+            if i < len(plot_results):
+                plot_results[i, :, :] = segmentation_test_result
+            if saved_results is not None:
+                saved_results.write(segmentation_test_result)
 
             test_cost += test_cost_
             test_cost_unweighted += test_cost_unweighted_
 
             _, test_neg_class_frac, test_pos_class_frac = dataset.get_inverse_pos_freq(*test_data[1:])
+            if score_histogram is not None:
+                accumulator.add_counts(score_histogram, test_neg_class_frac, test_pos_class_frac)
+            else:
+                accumulator.add(segmentation_test_result, test_data[-1], self.get_image_mask(test_data),
+                                test_neg_class_frac, test_pos_class_frac)
 
-            # calculate max threshold accuracy per test image
-            thresh_max = self.get_max_threshold_accuracy_image(segmentation_test_result, test_neg_class_frac,
-                                                               test_pos_class_frac, *test_data[1:])
-            max_thresh_accuracy += thresh_max
-
-            if viz_layer_epoch_freq is not None and i == sample_test_image and (epoch_i + 1) % viz_layer_epoch_freq == 0:
+            if layer_outputs is not None:
                 self.create_viz_layer_output(layer_outputs, decision_threshold, viz_layer_outputs_path_test)
 
+        if saved_results is not None:
+            saved_results.close()
+
         # combine test results to produce overall metric scores
-        max_thresh_accuracy = max_thresh_accuracy / len(dataset.test_images)
+        max_thresh_accuracy = accumulator.get_max_threshold_accuracy()
         test_cost = test_cost / len(dataset.test_images)
         test_cost_unweighted = test_cost_unweighted / len(dataset.test_images)
 
-        prediction_flat = segmentation_results.flatten()
-        target_flat = np.round(dataset.test_targets.flatten())
-        mask_flat = self.get_test_mask_flat(dataset)
-
-        # save target (if files don't exist)
-        if save_model:
-            self.save_data(prediction_flat, target_flat, mask_flat, timestamp, epoch_i)
+        if segmentation_results is not None:
+            prediction_flat = segmentation_results.flatten()
+            target_flat = test_targets.ravel()
+            mask_flat = test_masks.ravel() if test_masks is not None else None
+        else:
+            prediction_flat, target_flat, mask_flat = None, None, None
 
         # get class proportion on test set
         _, test_neg_class_frac, test_pos_class_frac = dataset.get_inverse_pos_freq(*dataset.test_data[1:])
 
+        # the results are new arrays per call, so they can be reported while training goes on
+        report_args = (metrics_log_file_path, network, dataset, prediction_flat, target_flat, mask_flat,
+                       accumulator.histogram, plot_results, decision_threshold, test_neg_class_frac,
+                       test_pos_class_frac, epoch_i, num_image_plots, save_sample_test_images, summary_writer)
+        report_kwargs = dict(max_thresh_accuracy=max_thresh_accuracy, cost=kwargs['cost'],
+                             cost_unweighted=kwargs['cost_unweighted'], test_cost=test_cost,
+                             test_cost_unweighted=test_cost_unweighted)
+        self.run_report(self.report_test_results, *report_args, **report_kwargs)
+
+    def run_report(self, report_fn, *args, **kwargs):
+        # reports go through the evaluator (if any), so they stay in order with the pending ones
+        if self.evaluator is not None:
+            self.evaluator.submit(report_fn, *args, **kwargs)
+        else:
+            report_fn(*args, **kwargs)
+
+    def report_test_results(self, metrics_log_file_path, network, dataset, prediction_flat, target_flat, mask_flat,
+                            histogram, plot_results, decision_threshold, test_neg_class_frac, test_pos_class_frac,
+                            epoch_i, num_image_plots, save_sample_test_images, summary_writer, **kwargs):
+        """Compute and log the test set metrics and plot the sample test images. Runs no graph ops, so it can run on
+        the `AsyncEvaluator` thread"""
         acc = self.get_metrics_on_test_set(metrics_log_file_path, prediction_flat, target_flat, mask_flat,
                                            decision_threshold, self.num_thresh_scores, test_neg_class_frac,
-                                           test_pos_class_frac, max_thresh_accuracy=max_thresh_accuracy,
-                                           cost=kwargs['cost'], cost_unweighted=kwargs['cost_unweighted'],
-                                           test_cost=test_cost, test_cost_unweighted=test_cost_unweighted)
+                                           test_pos_class_frac, metrics_engine=self.metrics_engine,
+                                           histogram=histogram, **kwargs)
 
         # produce image plots
         if save_sample_test_images:
-            test_plot_buf = draw_results(dataset.test_images[:num_image_plots],
-                                         dataset.test_targets[:num_image_plots],
-                                         segmentation_results[:num_image_plots, :, :],
+            plot_data = [dataset.get_test_image(i) for i in range(len(plot_results))]
+            test_plot_buf = draw_results([image_data[0] for image_data in plot_data],
+                                         [image_data[-1] for image_data in plot_data],
+                                         plot_results,
                                          acc, network, epoch_i, num_image_plots, os.path.join(self.OUTPUTS_DIR_PATH,
                                                                                               self.IMAGE_PLOT_DIR),
                                          decision_threshold)
 
-            image = tf.image.decode_png(test_plot_buf.getvalue(), channels=4)
-            image = tf.expand_dims(image, 0)
-            image_summary_op = tf.summary.image("plot", image)
-            image_summary = sess.run(image_summary_op)
-            summary_writer.add_summary(image_summary)
+            # the png is written to the summary as is, without adding ops to the graph
+            png = test_plot_buf.getvalue()
+            width, height = struct.unpack(">II", png[16:24])
+            image_summary = tf.Summary(value=[tf.Summary.Value(tag="plot", image=tf.Summary.Image(
+                height=height, width=width, colorspace=4, encoded_image_string=png))])
+            summary_writer.add_summary(image_summary, epoch_i)
 
     def get_results_on_val_set(self, metrics_log_file_path, network, dataset, sess, decision_threshold,
                                early_stopping_metric, save_model, **kwargs):
 
-        max_thresh_accuracy = 0.0
         val_cost = 0.0
         val_cost_unweighted = 0.0
 
-        segmentation_results = np.zeros((dataset.val_targets.shape[0], dataset.val_targets.shape[1],
-                                         dataset.val_targets.shape[2]))
-        # get test results per image
-        for i, val_data in enumerate(zip(*dataset.val_data)):
-            val_data = dataset.tf_reshape(val_data)
-            # get network results on test image
-            val_cost_, val_cost_unweighted_, segmentation_val_result, layer_outputs = \
-                sess.run([network.cost, network.cost_unweighted, network.segmentation_result,
-                          network.layer_outputs],
-                         feed_dict=self.get_network_dict(network, val_data, False))
-
-            segmentation_val_result = segmentation_val_result[0, :, :, 0]
-            segmentation_results[i, :, :] = segmentation_val_result
+        # the costs need no segmentations
+        cost_metric = early_stopping_metric in ("cost", "cost_unweighted")
+        segmentation_results = None
+        if not cost_metric:
+            segmentation_results = np.zeros((dataset.val_targets.shape[0], dataset.val_targets.shape[1],
+                                             dataset.val_targets.shape[2]))
+        # get val results per image
+        for i, (val_data, val_cost_, val_cost_unweighted_, segmentation_val_result, _, _) in \
+                enumerate(self.run_images(network, dataset, sess, dataset.val_data, split="val",
+                                          num_results=0 if cost_metric else None)):
+            if segmentation_results is not None:
+                segmentation_results[i, :, :] = segmentation_val_result
 
             val_cost += val_cost_
             val_cost_unweighted += val_cost_unweighted_
 
-            _, val_neg_class_frac, val_pos_class_frac = dataset.get_inverse_pos_freq(*val_data[1:])
+        # combine val results to produce the early stopping metric
+        val_cost = val_cost / len(dataset.val_targets)
+        val_cost_unweighted = val_cost_unweighted / len(dataset.val_targets)
 
-            # calculate max threshold accuracy per test image
-            thresh_max = self.get_max_threshold_accuracy_image(segmentation_val_result, val_neg_class_frac,
-                                                               val_pos_class_frac, *val_data[1:])
-            max_thresh_accuracy += thresh_max
+        if cost_metric:
+            prediction_flat, target_flat, mask_flat = None, None, None
+        else:
+            prediction_flat = segmentation_results.flatten()
+            target_flat = np.round(dataset.val_targets.flatten())
+            mask_flat = self.get_val_mask_flat(dataset)
 
-        # combine test results to produce overall metric scores
-        max_thresh_accuracy = max_thresh_accuracy / len(dataset.test_images)
-        val_cost = val_cost / len(dataset.test_images)
-        val_cost_unweighted = val_cost_unweighted / len(dataset.test_images)
+        return self.get_metrics_on_val_set(prediction_flat, target_flat, mask_flat, early_stopping_metric,
+                                           decision_threshold, val_cost=val_cost, val_cost_unweighted=val_cost_unweighted)
 
-        prediction_flat = segmentation_results.flatten()
-        target_flat = np.round(dataset.val_targets.flatten())
-        mask_flat = self.get_val_mask_flat(dataset)
+    @classmethod
+    def get_test_metric_scores(cls, prediction_flat, target_flat, mask_flat, decision_threshold, num_thresh_scores,
+                               test_neg_class_frac, test_pos_class_frac, metrics_engine="sklearn", histogram=None,
+                               **kwargs):
+
+        # `histogram` computes all metrics from one binned score histogram per class in a single pass, a `histogram`
+        # accumulated over the test images is used as is
+        if metrics_engine == "histogram":
+            if histogram is None:
+                histogram = ScoreHistogram().add(prediction_flat, target_flat, mask_flat)
+            metric_scores, threshold_scores = get_histogram_metric_scores(histogram, decision_threshold,
+                                                                          num_thresh_scores, test_neg_class_frac,
+                                                                          test_pos_class_frac)
+        elif metrics_engine == "sklearn":
+            metric_scores, threshold_scores = cls.get_sklearn_metric_scores(prediction_flat, target_flat, mask_flat,
+                                                                            decision_threshold, num_thresh_scores,
+                                                                            test_neg_class_frac, test_pos_class_frac)
+        else:
+            raise ValueError("Metrics engine {} not recognized".format(metrics_engine))
 
-        return self.get_metrics_on_val_set(prediction_flat, target_flat, mask_flat, early_stopping_metric,
-                                          decision_threshold, max_thresh_accuracy=max_thresh_accuracy,
-                                          val_cost=val_cost, val_cost_unweighted=val_cost_unweighted)
+        metric_scores["test set average weighted log loss"] = kwargs["test_cost"]
+        metric_scores["test set average unweighted log loss"] = kwargs["test_cost_unweighted"]
+        metric_scores["training set batch weighted log loss"] = kwargs["cost"]
+        metric_scores["training set batch unweighted log loss"] = kwargs["cost_unweighted"]
+
+        metric_scores["max acc from threshold"] = kwargs["max_thresh_accuracy"]
+
+        for threshold_score, threshold_str in \
+                zip(threshold_scores, cls.get_thresh_scores_strs(num_thresh_scores)):
+            metric_scores[threshold_str[0]] = threshold_score[0]
+            metric_scores[threshold_str[1]] = threshold_score[1]
+            metric_scores[threshold_str[2]] = threshold_score[2]
+            metric_scores[threshold_str[3]] = threshold_score[3]
+
+        return metric_scores
 
     @classmethod
     def get_metrics_on_test_set(cls, metrics_log_file_path, prediction_flat, target_flat, mask_flat, decision_threshold,
                                 num_thresh_scores, test_neg_class_frac, test_pos_class_frac, **kwargs):
+        metric_scores = cls.get_test_metric_scores(prediction_flat, target_flat, mask_flat, decision_threshold,
+                                                   num_thresh_scores, test_neg_class_frac, test_pos_class_frac,
+                                                   **kwargs)
+
+        # save metric results to log
+        cls.write_to_csv([metric_scores[key] for key in sorted(metric_scores.keys())], metrics_log_file_path, **kwargs)
 
+        return metric_scores["accuracy"]
+
+    @staticmethod
+    def get_sklearn_metric_scores(prediction_flat, target_flat, mask_flat, decision_threshold, num_thresh_scores,
+                                  test_neg_class_frac, test_pos_class_frac):
         metric_scores = dict()
 
         # produce AUCROC score with map
@@ -503,11 +932,6 @@ class Job(object):
         r_acc = float(r_tp + r_tn) / float(r_tp + r_tn + r_fp + r_fn)
         r_specificity = float(r_tn) / float(r_tn + r_fp)
 
-        metric_scores["test set average weighted log loss"] = kwargs["test_cost"]
-        metric_scores["test set average unweighted log loss"] = kwargs["test_cost_unweighted"]
-        metric_scores["training set batch weighted log loss"] = kwargs["cost"]
-        metric_scores["training set batch unweighted log loss"] = kwargs["cost_unweighted"]
-
         metric_scores["auc"] = auc_score
         metric_scores["aucfpr10"] = auc_10_fpr
         metric_scores["aucfpr05"] = auc_05_fpr
@@ -527,23 +951,12 @@ class Job(object):
         metric_scores["dt f1_score"] = r_fbeta_score
         metric_scores["dt kappa"] = r_kappa
 
-        metric_scores["max acc from threshold"] = kwargs["max_thresh_accuracy"]
-
-        for threshold_score, threshold_str in \
-                zip(threshold_scores, cls.get_thresh_scores_strs(num_thresh_scores)):
-            metric_scores[threshold_str[0]] = threshold_score[0]
-            metric_scores[threshold_str[1]] = threshold_score[1]
-            metric_scores[threshold_str[2]] = threshold_score[2]
-            metric_scores[threshold_str[3]] = threshold_score[3]
-
-        # save metric results to log
-        cls.write_to_csv([metric_scores[key] for key in sorted(metric_scores.keys())], metrics_log_file_path, **kwargs)
-
-        return acc
+        return metric_scores, threshold_scores
 
     @classmethod
     def get_metrics_on_val_set(cls, prediction_flat, target_flat, mask_flat, early_stopping_metric, decision_threshold,
                                val_cost, val_cost_unweighted, **kwargs):
+        """The validation value of `early_stopping_metric` alone, computed like the test set metric of the same name"""
 
         if early_stopping_metric == "cost":
             return val_cost
@@ -555,129 +968,100 @@ class Job(object):
         if early_stopping_metric == "auc":
             return roc_auc_score(target_flat, prediction_flat, sample_weight=mask_flat)
 
-        if early_stopping_metric == "aucfpr10" or early_stopping_metric == "aucfpr05" or \
-                        early_stopping_metric == "aucfpr025":
-
-            # produce auc_score curve thresholded at different FP poinnts
-            fprs, tprs, thresholds = roc_curve(target_flat, prediction_flat, sample_weight=mask_flat)
-            np_fprs, np_tprs, np_thresholds = np.array(fprs).flatten(), np.array(tprs).flatten(), \
-                                              np.array(thresholds).flatten()
-
-            if early_stopping_metric == "auc_10_fpr":
-                fpr_10 = np_fprs[np.where(np_fprs < .10)]
-                tpr_10 = np_tprs[0:len(fpr_10)]
-                if len(fpr_10) > 1 and len(tpr_10)> 1:
-                    auc_10_fpr = auc(fpr_10, tpr_10)
-                else:
-                    auc_10_fpr = np.nan
-                return auc_10_fpr
-
-            if early_stopping_metric == "aucfpr05":
-                fpr_05 = np_fprs[np.where(np_fprs < .05)]
-                tpr_05 = np_tprs[0:len(fpr_05)]
-                if len(fpr_05) > 1 and len(tpr_05) > 1:
-                    auc_05_fpr = auc(fpr_05, tpr_05)
-                else:
-                    auc_05_fpr = np.nan
-                return auc_05_fpr
-
-            if early_stopping_metric == "aucfpr025":
-                fpr_025 = np_fprs[np.where(np_fprs < .025)]
-                tpr_025 = np_tprs[0:len(fpr_025)]
-                if len(fpr_025) > 1 and len(tpr_025) > 1:
-                    auc_025_fpr = auc(fpr_025, tpr_025)
-                else:
-                    auc_025_fpr = np.nan
-                early_stopping_metric = auc_025_fpr
-
-        # produce metrics based on predictions given by decisions thresholded at .5
-        rounded_prediction_flat = np.round(prediction_flat)
-        (precision, recall, fbeta_score, _) = precision_recall_fscore_support(target_flat,
-                                                                              rounded_prediction_flat,
-                                                                              average='binary',
-                                                                              sample_weight=mask_flat)
-        if early_stopping_metric == "precision":
-            return precision
-        if early_stopping_metric == "recall":
-            return recall
-
-        tn, fp, fn, tp = confusion_matrix(target_flat, rounded_prediction_flat).ravel()
-        kappa = cohen_kappa_score(target_flat, rounded_prediction_flat)
-        if early_stopping_metric == "kappa":
-            return kappa
-        acc = float(tp + tn) / float(tp + tn + fp + fn)
-        if early_stopping_metric == "acc":
-            return acc
-        specificity = float(tn) / float(tn + fp)
-        if early_stopping_metric == "specificity":
-            return specificity
-
-        # produce metrics based on predictions given by decision_threshold
-        thresh_prediction_flat = (prediction_flat > decision_threshold).astype(int)
-
-        (r_precision, r_recall, r_fbeta_score, _) = precision_recall_fscore_support(target_flat,
-                                                                                    thresh_prediction_flat,
-                                                                                    average='binary',
-                                                                                    sample_weight=mask_flat)
-        if early_stopping_metric == "r_precision":
-            return r_precision
-        if early_stopping_metric == "r_recall":
-            return r_recall
-
-
-        r_tn, r_fp, r_fn, r_tp = confusion_matrix(target_flat, thresh_prediction_flat, sample_weight=mask_flat).ravel()
-        r_kappa = cohen_kappa_score(target_flat, thresh_prediction_flat, sample_weight=mask_flat)
-        if early_stopping_metric == "r_kappa":
-            return r_kappa
-        r_acc = float(r_tp + r_tn) / float(r_tp + r_tn + r_fp + r_fn)
-        if early_stopping_metric == "r_acc":
-            return r_acc
-        r_specificity = float(r_tn) / float(r_tn + r_fp)
-        if early_stopping_metric == "r_specificity":
-            return r_specificity
-
-        return
+        if early_stopping_metric in ("aucfpr10", "aucfpr05", "aucfpr025"):
+            max_fpr = {"aucfpr10": .10, "aucfpr05": .05, "aucfpr025": .025}[early_stopping_metric]
+            # produce auc_score curve thresholded at the FP point
+            fprs, tprs, _ = roc_curve(target_flat, prediction_flat, sample_weight=mask_flat)
+            fpr_max = fprs[np.where(fprs < max_fpr)]
+            tpr_max = tprs[0:len(fpr_max)]
+            if len(fpr_max) > 1 and len(tpr_max) > 1:
+                return auc(fpr_max, tpr_max)
+            return np.nan
+
+        # `r_` metrics are based on predictions given by decision_threshold and computed inside the mask, the others on
+        # decisions thresholded at .5, with only precision and recall computed inside the mask
+        if early_stopping_metric.startswith("r_"):
+            metric, threshold, weights = early_stopping_metric[2:], decision_threshold, mask_flat
+        else:
+            metric, threshold = early_stopping_metric, .5
+            weights = mask_flat if metric in ("precision", "recall") else None
+        if metric not in ("precision", "recall", "kappa", "acc", "specificity"):
+            raise ValueError("Early stopping metric {} not recognized".format(early_stopping_metric))
+
+        predicted = prediction_flat > threshold
+        positive = target_flat > 0
+        weights = np.ones(len(target_flat)) if weights is None else weights
+        tp = weights[predicted & positive].sum()
+        fp = weights[predicted & ~positive].sum()
+        fn = weights[~predicted & positive].sum()
+        tn = weights.sum() - tp - fp - fn
+        if metric == "precision":
+            return float(tp) / (tp + fp) if tp + fp else 0.0
+        if metric == "recall":
+            return float(tp) / (tp + fn) if tp + fn else 0.0
+        if metric == "kappa":
+            return get_kappa(tn, fp, fn, tp)
+        if metric == "acc":
+            return float(tp + tn) / (tp + tn + fp + fn)
+        return float(tn) / (tn + fp)
 
     def get_ensemble_results(self, n_epochs, decision_threshold, num_thresh_scores, test_neg_class_frac, test_pos_class_frac,
-                             metrics_log='ensemble_results.txt', combining_metric="mean", **kwargs):
+                             metrics_log='ensemble_results.txt', combining_metric="mean", ensemble_weights=None,
+                             ensemble_trim=1, ensemble_memory_budget=1 << 28, ensemble_num_workers=1, dataset=None,
+                             **kwargs):
+        """Metrics of the ensemble of the runs saved for the test set of `dataset` at every epoch. The runs are
+        combined by `combining_metric` (see `PredictionStore.combine`), with `ensemble_weights[i]` the weight of the
+        i-th saved run for `"weighted_mean"`. `ensemble_num_workers` epochs are combined and scored at a time, each
+        within `ensemble_memory_budget` bytes; the metrics log stays ordered by epoch"""
 
         metric_log_file_path = os.path.join(self.OUTPUTS_DIR_PATH, metrics_log)
 
         ## load targets and masks once for test set
-        targets_path = os.path.join(self.OUTPUTS_DIR_PATH, "saved_targets", "target.npy")
-        masks_path = os.path.join(self.OUTPUTS_DIR_PATH, "saved_masks", "mask.npy")
-        preds_dir_path = os.path.join(self.OUTPUTS_DIR_PATH, "saved_preds")
+        targets_path = os.path.join(self.get_saved_data_path("saved_targets", dataset), "target.npy")
+        masks_path = os.path.join(self.get_saved_data_path("saved_masks", dataset), "mask.npy")
+        preds_dir_path = self.get_saved_data_path("saved_preds", dataset)
 
         mask_flat = np.load(masks_path) if os.path.exists(masks_path) else None
         target_flat = np.load(targets_path)
+        kwargs.setdefault("metrics_engine", self.metrics_engine)
+        kwargs.update(max_thresh_accuracy=np.nan, cost=np.nan, cost_unweighted=np.nan, test_cost=np.nan,
+                      test_cost_unweighted=np.nan)
+
+        store = PredictionStore(preds_dir_path)
+        # runs are named by their start timestamps, so they sort in the order the models were trained in
+        all_run_names = store.get_run_names()
+
+        def get_epoch_metric_scores(epoch_i):
+            ## combine the runs of an iteration, streaming from the store
+            run_names = store.get_run_names(epoch_i)
+            print(run_names)
+            if len(run_names) == 0:
+                return None
+            weights = None
+            if ensemble_weights is not None:
+                weights = [ensemble_weights[all_run_names.index(run_name)] for run_name in run_names]
+            prediction_flat = store.combine(run_names, epoch_i, combining_metric=combining_metric, weights=weights,
+                                            trim=ensemble_trim, memory_budget=ensemble_memory_budget)
+            return self.get_test_metric_scores(prediction_flat, target_flat, mask_flat, decision_threshold,
+                                               num_thresh_scores, test_neg_class_frac, test_pos_class_frac, **kwargs)
 
         ## for all iterations
-        for epoch_i in range(n_epochs):
-
-            suffix = "_" + str(epoch_i) + ".npy"
-            ## load all the files for an iteration
-            search_string = preds_dir_path +"/*" + suffix
-            model_results_files = glob.glob(search_string)
-
-            net_results_list = []
-
-            print(model_results_files)
-            if len(model_results_files) == 0:
-                continue
-
-            for result_file in model_results_files:
-                prediction_flat = np.load(result_file)
-                net_results_list += [prediction_flat]
-
-            if combining_metric == "mean":
-                prediction_flat = np.array(net_results_list).mean(0)
-            if combining_metric == "median":
-                prediction_flat = np.median(np.array(net_results_list),0)
-
-            self.get_metrics_on_test_set(metric_log_file_path, prediction_flat,target_flat,mask_flat, decision_threshold,
-                                         num_thresh_scores, test_neg_class_frac, test_pos_class_frac,
-                                         max_thresh_accuracy=np.nan, cost=np.nan, cost_unweighted=np.nan,
-                                         test_cost=np.nan, test_cost_unweighted=np.nan, **kwargs)
+        if ensemble_num_workers > 1:
+            pool = ThreadPool(ensemble_num_workers)
+            all_metric_scores = pool.imap(get_epoch_metric_scores, range(n_epochs))
+        else:
+            pool = None
+            all_metric_scores = (get_epoch_metric_scores(epoch_i) for epoch_i in range(n_epochs))
+
+        try:
+            for metric_scores in all_metric_scores:
+                if metric_scores is not None:
+                    self.write_to_csv([metric_scores[key] for key in sorted(metric_scores.keys())],
+                                      metric_log_file_path)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
     def create_viz_dirs(self, network, timestamp):
         viz_layer_outputs_path = os.path.join(self.OUTPUTS_DIR_PATH, 'viz_layer_outputs', network.description, timestamp)
@@ -723,19 +1107,28 @@ class Job(object):
             writer = csv.writer(csv_file, delimiter=',')
             writer.writerow(entries)
 
-    def save_data(self, prediction_flat, target_flat, mask_flat, timestamp, epoch_i):
-        targets_path = os.path.join(self.OUTPUTS_DIR_PATH, "saved_targets")
-        preds_path = os.path.join(self.OUTPUTS_DIR_PATH, "saved_preds")
-        if not os.path.exists(targets_path):
-            os.makedirs(targets_path)
-        if not os.path.exists(preds_path):
-            os.makedirs(preds_path)
-        if not os.path.exists(os.path.join(targets_path, "target.npy")):
-            np.save(os.path.join(targets_path,"target.npy"), target_flat)
-
-        # save prediction array e.g. for ensemble processing
-        file_name = timestamp + "_" + str(epoch_i)
-        np.save(os.path.join(preds_path,file_name), prediction_flat)
+    def get_saved_data_path(self, name, dataset=None):
+        """Directory of the saved `name` ("saved_targets", "saved_masks" or "saved_preds") of the test set of
+        `dataset`, a subdirectory per cv fold test set"""
+        test_split_key = getattr(dataset, "test_split_key", None)
+        if test_split_key is None:
+            return os.path.join(self.OUTPUTS_DIR_PATH, name)
+        return os.path.join(self.OUTPUTS_DIR_PATH, name, test_split_key)
+
+    def save_data(self, network, dataset, timestamp, epoch_i):
+        """Save the test targets (if the file of the test set doesn't exist) and return the `EpochWriter` the test
+        results of `epoch_i` are stored with, e.g. for ensemble processing"""
+        targets_path = self.get_saved_data_path("saved_targets", dataset)
+        preds_path = self.get_saved_data_path("saved_preds", dataset)
+        # concurrent members (see `MemberScheduler`) share these files
+        save_array_once(os.path.join(targets_path, "target.npy"),
+                        np.round(dataset.test_targets.flatten()).astype(np.uint8))
+
+        # masked networks output sigmoid(0) = .5 outside of the mask, so only the pixels inside it are stored
+        mask_flat = self.get_test_mask_flat(dataset) if network.mask else None
+        num_pixels = int(np.prod(dataset.test_targets.shape[:3]))
+        return PredictionStore(preds_path).open_epoch(timestamp, epoch_i, num_pixels, mask_flat=mask_flat,
+                                                      dtype=self.prediction_dtype, fill_value=.5)
 
     @staticmethod
     def save_debug1(input_data, save_path):
@@ -786,21 +1179,24 @@ class Job(object):
     def network_cls(self):
         raise ValueError("Property Not Defined")
 
-    @staticmethod
-    def get_max_threshold_accuracy_image(results, neg_class_frac, pos_class_frac, *args):
-        raise NotImplementedError("Not Implemented")
-
     def get_test_mask_flat(self, dataset):
         return None
 
+    def get_image_mask(self, image_data):
+        return None
+
     def get_val_mask_flat(self, dataset):
         return None
 
-    def get_network_dict(self, network, input_data, train=True):
+    def get_network_dict(self, network, input_data, train=True, split="train"):
         if train:
-            return {network.is_training: True}
+            net_dict = {network.is_training: True}
         else:
-            return {network.is_training: False}
+            net_dict = {network.is_training: False}
+        # inputs come from the iterator of `split` instead of `input_data`
+        if network.input_handle is not None:
+            net_dict[network.input_handle] = self.input_handles[split]
+        return net_dict
 
     def __call__(self):
         pass
@@ -0,0 +1,94 @@
+"""This is the file for early stopping on a validation metric"""
+import os
+import time
+import tensorflow as tf
+
+
+class EarlyStopping(object):
+    """Tracks a validation metric over the evaluations of a training run and keeps a snapshot of the best weights.
+
+    An evaluation improves on the best one if the metric moves by more than `min_delta` in its direction (lower for the
+    costs, higher otherwise). Training should stop after `patience` evaluations without improvement (never with
+    `patience=None`) or once `time_budget` seconds have passed since the `EarlyStopping` was created. The best weights
+    are kept in memory (`snapshot="memory"`) or as a checkpoint at `snapshot_path` (`snapshot="disk"`, for models too
+    large to hold twice) and are put back by `restore`."""
+
+    def __init__(self, metric="auc", patience=None, min_delta=0.0, snapshot="memory", snapshot_path=None,
+                 time_budget=None, saver=None):
+        if snapshot not in ("memory", "disk"):
+            raise ValueError("Snapshot {} not recognized".format(snapshot))
+        if snapshot == "disk" and snapshot_path is None:
+            raise ValueError("A `snapshot_path` is needed for disk snapshots")
+        self.metric = metric
+        self.patience = patience
+        self.min_delta = min_delta
+        self.snapshot = snapshot
+        self.snapshot_path = snapshot_path
+        self.time_budget = time_budget
+        self.start_time = time.time()
+
+        self.best_value = None
+        self.best_epoch = None
+        self.num_bad_evaluations = 0
+        self.variables = None
+        self.best_values = None
+        # a disk snapshot saver of the graph can be passed in, to not add one for every run
+        self.saver = saver
+
+    @property
+    def lower_is_better(self):
+        return self.metric in ("cost", "cost_unweighted")
+
+    def is_improvement(self, value):
+        if self.best_value is None:
+            return True
+        if self.lower_is_better:
+            return value < self.best_value - self.min_delta
+        return value > self.best_value + self.min_delta
+
+    def update(self, value, sess, epoch_i):
+        """Record the metric of an evaluation, snapshot the weights if it is the best one so far and return whether it
+        is"""
+        if not self.is_improvement(value):
+            self.num_bad_evaluations += 1
+            return False
+        self.best_value = value
+        self.best_epoch = epoch_i
+        self.num_bad_evaluations = 0
+        self.save_snapshot(sess)
+        return True
+
+    def should_stop(self):
+        if self.patience is not None and self.num_bad_evaluations >= self.patience:
+            print("early stopping: no improvement of {} in {} evaluations".format(self.metric,
+                                                                                self.num_bad_evaluations))
+            return True
+        if self.time_budget is not None and time.time() - self.start_time > self.time_budget:
+            print("early stopping: time budget of {}s used up".format(self.time_budget))
+            return True
+        return False
+
+    def save_snapshot(self, sess):
+        if self.variables is None:
+            self.variables = tf.global_variables()
+        if self.snapshot == "memory":
+            self.best_values = sess.run(self.variables)
+        else:
+            if self.saver is None:
+                self.saver = tf.train.Saver(self.variables, max_to_keep=1)
+            snapshot_dir = os.path.dirname(self.snapshot_path)
+            if snapshot_dir and not os.path.exists(snapshot_dir):
+                os.makedirs(snapshot_dir)
+            self.saver.save(sess, self.snapshot_path)
+
+    def restore(self, sess):
+        """Put the best weights back into the graph"""
+        if self.best_epoch is None:
+            return
+        if self.snapshot == "memory":
+            # `load` assigns through the variables' initializers, without adding ops to the graph
+            for variable, value in zip(self.variables, self.best_values):
+                variable.load(value, sess)
+        else:
+            self.saver.restore(sess, self.snapshot_path)
+        print("restored the weights of epoch {} ({} {})".format(self.best_epoch, self.metric, self.best_value))
@@ -0,0 +1,52 @@
+"""This is the file for the background evaluation worker"""
+import sys
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class AsyncEvaluator(object):
+    """Runs evaluation reports (test set metrics, metrics log, plots and summaries) on a background thread while
+    training goes on.
+
+    Reports are run one at a time in the order they are submitted, so the metrics log stays ordered by epoch. At most
+    `max_pending` reports wait in the queue; `submit` blocks beyond that. An error in a report is raised by the next
+    `submit` or by `close`."""
+
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.exc_info = None
+        self.thread = threading.Thread(target=self.run_reports, name="async_evaluator")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run_reports(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            report_fn, args, kwargs = item
+            if self.exc_info is not None:
+                continue
+            try:
+                report_fn(*args, **kwargs)
+            except Exception:
+                # hand the error over to the training loop
+                self.exc_info = sys.exc_info()
+
+    def raise_error(self):
+        if self.exc_info is not None:
+            exc_type, exc_value, _ = self.exc_info
+            raise exc_value
+
+    def submit(self, report_fn, *args, **kwargs):
+        self.raise_error()
+        self.queue.put((report_fn, args, kwargs))
+
+    def close(self):
+        """Wait for the submitted reports to finish"""
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
@@ -9,6 +9,7 @@ from sklearn.metrics import precision_recall_fscore_support, cohen_kappa_score,
     roc_curve, auc
 import os
 from job.base import Job
+from utilities.misc import save_array_once
 from scipy.misc import imsave
 
 
@@ -17,39 +18,24 @@ class JobWMasks(Job):
     def __init__(self, OUTPUTS_DIR_PATH="."):
         super(JobWMasks, self).__init__(OUTPUTS_DIR_PATH=OUTPUTS_DIR_PATH)
 
-    def get_network_dict(self, network, input_data, train=True):
-        net_dict = super(JobWMasks, self).get_network_dict(network, input_data, train=train)
-        net_dict.update({network.inputs: input_data[0], network.masks: input_data[1], network.targets: input_data[2]})
+    def get_network_dict(self, network, input_data, train=True, split="train"):
+        net_dict = super(JobWMasks, self).get_network_dict(network, input_data, train=train, split=split)
+        if network.input_handle is None:
+            net_dict.update({network.inputs: input_data[0], network.masks: input_data[1], network.targets: input_data[2]})
         return net_dict
 
-    @staticmethod
-    def get_max_threshold_accuracy_image(results, neg_class_frac, pos_class_frac, masks, targets):
-        fprs, tprs, thresholds = roc_curve(targets.flatten(), results.flatten(), sample_weight=masks.flatten())
-        list_fprs_tprs_thresholds = list(zip(fprs, tprs, thresholds))
-        interval = 0.0001
-        thresh_max = 0.0
-
-        for i in np.arange(0.0, 1.0 + interval, interval):
-            index = int(round((len(thresholds) - 1) * i, 0))
-            fpr, tpr, threshold = list_fprs_tprs_thresholds[index]
-            thresh_acc = (1 - fpr) * neg_class_frac + tpr * pos_class_frac
-            if thresh_acc > thresh_max:
-                thresh_max = thresh_acc
-            i += 1
-        return thresh_max
-
-    def save_data(self, prediction_flat, target_flat, mask_flat, timestamp, epoch_i):
-        super(JobWMasks, self).save_data(prediction_flat, target_flat, mask_flat, timestamp, epoch_i)
-        masks_path = os.path.join(self.OUTPUTS_DIR_PATH, "saved_masks")
-
-        if not os.path.exists(masks_path):
-            os.makedirs(masks_path)
-        if not os.path.exists(os.path.join(masks_path, "mask.npy")):
-            np.save(os.path.join(masks_path, "mask.npy"), mask_flat)
+    def save_data(self, network, dataset, timestamp, epoch_i):
+        saved_results = super(JobWMasks, self).save_data(network, dataset, timestamp, epoch_i)
+        masks_path = self.get_saved_data_path("saved_masks", dataset)
+        save_array_once(os.path.join(masks_path, "mask.npy"), self.get_test_mask_flat(dataset).astype(np.uint8))
+        return saved_results
 
     def get_test_mask_flat(self, dataset):
         return dataset.test_masks.flatten()
 
+    def get_image_mask(self, image_data):
+        return image_data[1]
+
     def get_val_mask_flat(self, dataset):
         return dataset.val_masks.flatten()
 
@@ -0,0 +1,187 @@
+"""This is the file for the compact on-disk store of the saved test set predictions"""
+import os
+import json
+import numpy as np
+
+from utilities.misc import make_dirs, save_array_once
+
+
+class PredictionStore(object):
+    """Saved test set predictions of the runs of a job, one data file and one json index per run.
+
+    Probabilities are quantized to `float16` or `uint8` (`round(p * 255)`). With a mask, only the pixels inside it are
+    stored and the others read back as the run's `fill_value`, e.g. the constant `sigmoid(0)` masked networks output
+    outside of the FOV. Each saved epoch is appended to the run's data file as one chunk and is read back lazily through
+    memory mapping."""
+
+    DTYPES = ("float16", "uint8")
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def get_data_path(self, run_name):
+        return os.path.join(self.store_dir, run_name + ".bin")
+
+    def get_index_path(self, run_name):
+        return os.path.join(self.store_dir, run_name + ".json")
+
+    def get_index(self, run_name):
+        with open(self.get_index_path(run_name)) as f:
+            return json.load(f)
+
+    def get_run_names(self, epoch_i=None):
+        """Names of the runs in the store, only those that saved `epoch_i` if given"""
+        if not os.path.exists(self.store_dir):
+            return []
+        run_names = sorted(os.path.splitext(file_name)[0] for file_name in os.listdir(self.store_dir)
+                           if file_name.endswith(".json"))
+        if epoch_i is not None:
+            run_names = [run_name for run_name in run_names if str(epoch_i) in self.get_index(run_name)["epochs"]]
+        return run_names
+
+    def get_mask(self):
+        return np.load(os.path.join(self.store_dir, "mask.npy")).astype(bool)
+
+    def open_epoch(self, run_name, epoch_i, num_pixels, mask_flat=None, dtype="float16", fill_value=0.0):
+        """Return an `EpochWriter` appending the predictions of `epoch_i` to the run's data file"""
+        if dtype not in self.DTYPES:
+            raise ValueError("Prediction dtype {} not recognized".format(dtype))
+        # the runs of concurrent ensemble members share the directory and the mask
+        make_dirs(self.store_dir)
+        if mask_flat is not None:
+            save_array_once(os.path.join(self.store_dir, "mask.npy"), (np.asarray(mask_flat) > 0).astype(np.uint8))
+        if os.path.exists(self.get_index_path(run_name)):
+            index = self.get_index(run_name)
+        else:
+            index = {"dtype": dtype, "num_pixels": int(num_pixels), "masked": mask_flat is not None,
+                     "fill_value": fill_value, "epochs": {}}
+        return EpochWriter(self, run_name, epoch_i, index, mask_flat)
+
+    def read_epoch(self, run_name, epoch_i):
+        """Memory-mapped stored (quantized, only masked pixels) predictions of `epoch_i` and the run's index"""
+        index = self.get_index(run_name)
+        offset, num_stored = index["epochs"][str(epoch_i)]
+        return np.memmap(self.get_data_path(run_name), dtype=index["dtype"], mode="r", offset=offset,
+                         shape=(num_stored,)), index
+
+    @staticmethod
+    def encode(values, dtype):
+        if dtype == "uint8":
+            return np.round(np.clip(values, 0.0, 1.0) * 255.0).astype(np.uint8)
+        return np.asarray(values, dtype=np.float16)
+
+    @staticmethod
+    def decode(values, dtype):
+        if dtype == "uint8":
+            return values.astype(np.float32) / 255.0
+        return values.astype(np.float32)
+
+    def expand(self, stored_values, index):
+        """Full prediction vector from the stored pixels"""
+        if not index["masked"]:
+            return stored_values
+        predictions = np.full(index["num_pixels"], index["fill_value"], dtype=np.float32)
+        predictions[self.get_mask()] = stored_values
+        return predictions
+
+    def load_epoch(self, run_name, epoch_i):
+        """Full float32 prediction vector of one run and epoch"""
+        stored_values, index = self.read_epoch(run_name, epoch_i)
+        return self.expand(self.decode(stored_values, index["dtype"]), index)
+
+    COMBINING_METRICS = ("mean", "weighted_mean", "trimmed_mean", "median")
+
+    def iter_chunks(self, run_name, epoch_i, chunk_size):
+        """Decoded stored predictions of one run and epoch, `chunk_size` pixels at a time"""
+        stored_values, index = self.read_epoch(run_name, epoch_i)
+        for start in range(0, len(stored_values), chunk_size):
+            yield start, self.decode(stored_values[start:start + chunk_size], index["dtype"])
+
+    def combine(self, run_names, epoch_i, combining_metric="mean", weights=None, trim=1, memory_budget=1 << 28):
+        """Full prediction vector of `epoch_i`, combined over `run_names` by `combining_metric`.
+
+        `"mean"` and `"weighted_mean"` (by `weights`, one per run) are running sums over the runs. `"median"` and
+        `"trimmed_mean"` (dropping the `trim` lowest and highest predictions of every pixel) are computed over blocks of
+        pixels whose working arrays (the stored predictions of all runs, or the running `trim` lowest and highest
+        values) fit in `memory_budget` bytes, so the memory used doesn't grow with the number of runs or pixels"""
+        if combining_metric not in self.COMBINING_METRICS:
+            raise ValueError("Combining metric {} not recognized".format(combining_metric))
+        index = self.get_index(run_names[0])
+        num_stored = index["epochs"][str(epoch_i)][1]
+        # float32 arrays held per pixel of a block
+        num_arrays = {"median": len(run_names), "trimmed_mean": 2 * trim + 2}.get(combining_metric, 1)
+        chunk_size = max(1, memory_budget // (4 * num_arrays))
+
+        if combining_metric == "median":
+            combined = np.empty(num_stored, dtype=np.float32)
+            stored = [self.read_epoch(run_name, epoch_i) for run_name in run_names]
+            for start in range(0, num_stored, chunk_size):
+                end = start + chunk_size
+                chunk = np.stack([self.decode(stored_values[start:end], run_index["dtype"])
+                                  for stored_values, run_index in stored])
+                combined[start:end] = np.median(chunk, 0)
+            return self.expand(combined, index)
+
+        if combining_metric == "trimmed_mean":
+            if len(run_names) <= 2 * trim:
+                raise ValueError("Trimming {} predictions per side needs more than {} runs".format(trim, 2 * trim))
+            combined = np.empty(num_stored, dtype=np.float32)
+            stored = [self.read_epoch(run_name, epoch_i) for run_name in run_names]
+            for start in range(0, num_stored, chunk_size):
+                end = min(start + chunk_size, num_stored)
+                total = np.zeros(end - start, dtype=np.float32)
+                lowest = np.full((trim, end - start), np.inf, dtype=np.float32)
+                highest = np.full((trim, end - start), -np.inf, dtype=np.float32)
+                for stored_values, run_index in stored:
+                    values = self.decode(stored_values[start:end], run_index["dtype"])
+                    total += values
+                    # insert into the sorted running extremes, each row keeps one side of its comparison
+                    low = high = values
+                    for i in range(trim):
+                        low, lowest[i] = np.maximum(lowest[i], low), np.minimum(lowest[i], low)
+                        high, highest[i] = np.minimum(highest[i], high), np.maximum(highest[i], high)
+                combined[start:end] = (total - lowest.sum(0) - highest.sum(0)) / (len(run_names) - 2 * trim)
+            return self.expand(combined, index)
+
+        if combining_metric == "weighted_mean":
+            if weights is None or len(weights) != len(run_names):
+                raise ValueError("One weight per run is needed, got {} for {} runs".format(
+                    None if weights is None else len(weights), len(run_names)))
+            weights = np.asarray(weights, dtype=np.float64) / np.sum(weights)
+        else:
+            weights = np.full(len(run_names), 1.0 / len(run_names))
+
+        combined = np.zeros(num_stored, dtype=np.float32)
+        for run_name, weight in zip(run_names, weights):
+            for start, values in self.iter_chunks(run_name, epoch_i, chunk_size):
+                combined[start:start + len(values)] += weight * values
+        return self.expand(combined, index)
+
+
+class EpochWriter(object):
+    """Appends the test results of one epoch to a run of a `PredictionStore`, image by image"""
+
+    def __init__(self, store, run_name, epoch_i, index, mask_flat=None):
+        self.store = store
+        self.run_name = run_name
+        self.epoch_i = epoch_i
+        self.index = index
+        self.mask_flat = np.asarray(mask_flat) > 0 if mask_flat is not None else None
+        self.pixel_pointer = 0
+        self.num_stored = 0
+        self.file = open(store.get_data_path(run_name), "ab")
+        self.offset = self.file.tell()
+
+    def write(self, results):
+        values = np.ravel(results)
+        if self.mask_flat is not None:
+            values = values[self.mask_flat[self.pixel_pointer:self.pixel_pointer + len(values)]]
+        self.pixel_pointer += np.size(results)
+        self.file.write(PredictionStore.encode(values, self.index["dtype"]).tobytes())
+        self.num_stored += len(values)
+
+    def close(self):
+        self.file.close()
+        self.index["epochs"][str(self.epoch_i)] = [self.offset, self.num_stored]
+        with open(self.store.get_index_path(self.run_name), "w") as f:
+            json.dump(self.index, f)
@@ -0,0 +1,138 @@
+"""This is the file for running a saved model on new images"""
+import os
+import json
+import time
+import importlib
+import numpy as np
+import tensorflow as tf
+from scipy.misc import imsave
+
+from dataset.base import get_network_pads
+from utilities.image_preprocessing import apply_dataset_normalization
+from utilities.misc import from_json_serializable
+from utilities.tiling import get_tile_grid, get_tile_batches, extract_tiles, TileBlender
+
+
+def load_class(module_and_name):
+    module_name, cls_name = module_and_name
+    return getattr(importlib.import_module(module_name), cls_name)
+
+
+class Predictor(object):
+    """Rebuilds the network of a run saved by `Job.train` (`config.json` plus checkpoints) and segments images with it.
+
+    Images are loaded, pre-processed and normalized exactly as configured for training. Whole images are run
+    `batch_size` at a time; with a `tile_size` (or for networks trained on patches) images of any size are segmented on
+    overlapping tiles instead, see `utilities.tiling`."""
+
+    def __init__(self, model_dir, checkpoint_path=None, batch_size=1, tile_size=None, tile_overlap=0,
+                 tile_blending=None, gpu_device=None):
+        with open(os.path.join(model_dir, "config.json")) as f:
+            self.config = json.load(f)
+        self.network_cls = load_class(self.config["network_cls"])
+        self.dataset_cls = load_class(self.config["dataset"]["dataset_cls"])
+        self.batch_size = batch_size
+        self.tile_overlap = tile_overlap
+        self.tile_blending = tile_blending
+
+        if isinstance(tile_size, int):
+            tile_size = (tile_size, tile_size)
+        if tile_size is None and self.config["dataset"]["patch_size"] is not None:
+            tile_size = self.config["dataset"]["patch_size"]
+        self.tile_size = tuple(tile_size) if tile_size is not None else None
+
+        network_kwargs = dict(from_json_serializable(self.config["network_kwargs"]), patch_size=self.tile_size)
+        # the training run's conv precision is for its device, not necessarily this one
+        network_kwargs["compute_precision"] = self.network_cls.get_device_compute_precision(
+            network_kwargs.get("precision", "float32"), gpu_device)
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            if gpu_device is not None:
+                with tf.device(gpu_device):
+                    self.network = self.network_cls(**network_kwargs)
+            else:
+                self.network = self.network_cls(**network_kwargs)
+            config = tf.ConfigProto(allow_soft_placement=True)
+            config.gpu_options.allow_growth = True
+            self.sess = tf.Session(config=config)
+            if checkpoint_path is None:
+                checkpoint_path = tf.train.latest_checkpoint(model_dir)
+            if checkpoint_path is None:
+                raise ValueError("No checkpoint found in {}".format(model_dir))
+            tf.train.Saver(tf.global_variables()).restore(self.sess, checkpoint_path)
+            print("restored model: {}".format(checkpoint_path))
+
+    def load_image(self, image_path, mask_path=None):
+        # tiles cover the image itself, whole images are padded to the network input
+        pads = (0, 0, 0, 0) if self.tile_size is not None else get_network_pads(self.network_cls)
+        image, mask = self.dataset_cls.load_inference_image(image_path, pads, mask_path=mask_path,
+                                                            **self.config["dataset"]["load_kwargs"])
+        if self.config["dataset"]["normalization_params"] is not None:
+            image, _ = apply_dataset_normalization(image, train_params=self.config["dataset"]["normalization_params"],
+                                                   **self.config["dataset"]["normalization_kwargs"])
+        return np.asarray(image, dtype=np.float32), mask
+
+    def get_feed_dict(self, images, masks):
+        feed_dict = {self.network.inputs: np.expand_dims(images, axis=-1)}
+        if self.network.mask:
+            feed_dict[self.network.masks] = np.expand_dims(masks, axis=-1)
+        return feed_dict
+
+    def segment_images(self, images, masks):
+        """Probability maps of a batch of equally sized (padded) images"""
+        segmentation_results = self.sess.run(self.network.segmentation_result,
+                                             feed_dict=self.get_feed_dict(np.asarray(images), np.asarray(masks)))
+        return segmentation_results[..., 0]
+
+    def segment_tiled(self, image, mask):
+        """Probability map of a single image of any size, segmented on tiles"""
+        tile_grid = get_tile_grid(image.shape[0], image.shape[1], self.tile_size, overlap=self.tile_overlap)
+        blender = TileBlender(image.shape, self.tile_size, blending=self.tile_blending)
+        for batch_grid in get_tile_batches(tile_grid, self.batch_size):
+            tiles = extract_tiles(image, batch_grid, self.tile_size)
+            mask_tiles = extract_tiles(mask, batch_grid, self.tile_size) if mask is not None else None
+            blender.add(self.segment_images(tiles, mask_tiles), batch_grid)
+        return blender.result()
+
+    def predict(self, image_paths, mask_paths=None):
+        """Yield `(image_path, probability map)` for every image"""
+        if mask_paths is None:
+            mask_paths = [None] * len(image_paths)
+        if self.tile_size is not None:
+            for image_path, mask_path in zip(image_paths, mask_paths):
+                image, mask = self.load_image(image_path, mask_path)
+                yield image_path, self.segment_tiled(image, mask)
+            return
+
+        for i in range(0, len(image_paths), self.batch_size):
+            batch_paths = image_paths[i:i + self.batch_size]
+            images, masks = zip(*[self.load_image(image_path, mask_path) for image_path, mask_path in
+                                  zip(batch_paths, mask_paths[i:i + self.batch_size])])
+            for image_path, segmentation_result in zip(batch_paths, self.segment_images(images, masks)):
+                yield image_path, segmentation_result
+
+    def predict_to_dir(self, image_paths, output_dir, mask_paths=None, threshold=None, output_format="png"):
+        """Write a probability map (or, with a `threshold`, a binary mask) per image and return the images/sec"""
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        start = time.time()
+        num_images = 0
+        for image_path, segmentation_result in self.predict(image_paths, mask_paths):
+            if threshold is not None:
+                segmentation_result = (segmentation_result > threshold).astype(np.uint8)
+            file_name = os.path.splitext(os.path.basename(image_path))[0]
+            if output_format == "npy":
+                np.save(os.path.join(output_dir, file_name + ".npy"), segmentation_result)
+            elif output_format == "png":
+                imsave(os.path.join(output_dir, file_name + ".png"),
+                       np.round(segmentation_result * 255.0).astype(np.uint8))
+            else:
+                raise ValueError("Output format {} not recognized".format(output_format))
+            num_images += 1
+        elapsed = time.time() - start
+        images_per_sec = num_images / elapsed if elapsed > 0 else float("inf")
+        print("segmented {} images in {:.2f}s, {:.2f} images/sec".format(num_images, elapsed, images_per_sec))
+        return images_per_sec
+
+    def close(self):
+        self.sess.close()
@@ -0,0 +1,97 @@
+"""This is the file for running the members of a job (cv folds, ensemble models) as concurrent processes"""
+import time
+import multiprocessing
+
+
+def get_threads_per_member(max_concurrent, threads_per_member=None):
+    """Cpu threads each member's TF session gets, by default an even share of the cpus"""
+    if threads_per_member is not None:
+        return threads_per_member
+    if max_concurrent <= 1:
+        return None
+    return max(1, multiprocessing.cpu_count() // max_concurrent)
+
+
+class MemberScheduler(object):
+    """Runs `target(**kwargs)` of every added member in its own process, `max_concurrent` at a time.
+
+    Members are started in the order they are added. A member whose process exits with a non-zero code is started
+    again, up to `max_retries` times; `run` raises a `RuntimeError` naming the members that still failed once all the
+    others are done. With `in_process`, the members run one after another in the calling process instead, e.g. to
+    share a graph, and are retried when they raise; it can't be combined with a `max_concurrent` above 1."""
+
+    def __init__(self, target, max_concurrent=1, max_retries=0, poll_interval=1.0, in_process=False):
+        if in_process and max_concurrent > 1:
+            raise ValueError("In-process members (e.g. with `reuse_graph`) run one after another, not {} at a "
+                             "time".format(max_concurrent))
+        self.target = target
+        self.in_process = in_process
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_retries = max_retries
+        self.poll_interval = poll_interval
+        self.members = []
+
+    def add(self, name, kwargs):
+        self.members.append((name, kwargs))
+
+    def start(self, name, kwargs):
+        process = multiprocessing.Process(target=self.target, kwargs=kwargs, name=name)
+        process.start()
+        print("started {} (pid {})".format(name, process.pid))
+        return process
+
+    def run_in_process(self):
+        failed = []
+        for name, kwargs in self.members:
+            for num_retries in range(self.max_retries + 1):
+                if num_retries > 0:
+                    print("retrying {} ({}/{})".format(name, num_retries, self.max_retries))
+                try:
+                    self.target(**kwargs)
+                    break
+                except Exception as e:
+                    print("{} failed: {!r}".format(name, e))
+            else:
+                failed.append(name)
+        return failed
+
+    def run(self):
+        if self.in_process:
+            failed = self.run_in_process()
+            if failed:
+                raise RuntimeError("Members failed: {}".format(", ".join(failed)))
+            return
+
+        pending = [(name, kwargs, 0) for name, kwargs in self.members]
+        running = []
+        failed = []
+        while pending or running:
+            while pending and len(running) < self.max_concurrent:
+                name, kwargs, num_retries = pending.pop(0)
+                running.append((self.start(name, kwargs), name, kwargs, num_retries))
+
+            # a single member is simply waited for
+            if len(running) == 1 and not pending:
+                running[0][0].join()
+            else:
+                time.sleep(self.poll_interval)
+
+            still_running = []
+            for process, name, kwargs, num_retries in running:
+                if process.is_alive():
+                    still_running.append((process, name, kwargs, num_retries))
+                    continue
+                process.join()
+                if process.exitcode == 0:
+                    continue
+                if num_retries < self.max_retries:
+                    print("{} exited with code {}, retrying ({}/{})".format(name, process.exitcode, num_retries + 1,
+                                                                           self.max_retries))
+                    pending.insert(0, (name, kwargs, num_retries + 1))
+                else:
+                    print("{} exited with code {}".format(name, process.exitcode))
+                    failed.append(name)
+            running = still_running
+
+        if failed:
+            raise RuntimeError("Members failed: {}".format(", ".join(failed)))
@@ -8,6 +8,21 @@ class Layer(object):
     def create_layer(self, input, **kwargs):
         pass
 
+    def get_inference_values(self, sess):
+        """Trained values `create_inference_layer` builds the layer from"""
+        return {}
+
+    def create_inference_layer(self, input, values, **kwargs):
+        """Inference-only version of the layer, by default the same ops as `create_layer`"""
+        return self.create_layer(input, **kwargs)
+
+    @staticmethod
+    def cast(tensor, dtype):
+        """`tensor` as `dtype`, unchanged if `dtype` is `None` or already its type"""
+        if dtype is None or tensor.dtype.base_dtype == tf.as_dtype(dtype):
+            return tensor
+        return tf.cast(tensor, dtype)
+
     def zero_center_output(self, output, center):
         if self.center is not None:
             if self.center:
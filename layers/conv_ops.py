@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow as tf
 import tensorlayer as tl
 
@@ -5,6 +6,10 @@ from layers.base import Layer
 from utilities.layer_ops import get_incoming_shape
 from utilities.activations import lrelu
 
+# epsilon of `tf.contrib.layers.batch_norm`
+BATCH_NORM_EPSILON = 0.001
+
+
 class Conv2d(Layer):
     def __init__(self, kernel_size, output_channels, name, batch_norm=True, act_fn="lrelu", act_leak_prob=.2,
                  add_to_input=None, concat_to_input=None, weight_init=None, dp_rate=None, dilation=1, **kwargs):
@@ -22,12 +27,13 @@ class Conv2d(Layer):
         self.dilation = dilation
         print("name: {}".format(self.name))
 
-    def create_layer(self, input, include_w_input=None, is_training=True, center=False, dp_rate=0.0, **kwargs):
+    def create_layer(self, input, include_w_input=None, is_training=True, center=False, dp_rate=0.0, dtype=None,
+                     compute_dtype=None, **kwargs):
         print("name: {}".format(self.name))
         if self.add_to_input:
-            input = tf.add(input, include_w_input)
+            input = tf.add(input, self.cast(include_w_input, input.dtype))
         if self.concat_to_input:
-            input = tf.concat([input, include_w_input],axis=-1)
+            input = tf.concat([input, self.cast(include_w_input, input.dtype)],axis=-1)
         self.input_shape = get_incoming_shape(input)
         print(self.input_shape)
         number_of_input_channels = self.input_shape[3]
@@ -41,20 +47,26 @@ class Conv2d(Layer):
             W = tf.get_variable(('W{}'.format(self.name)), shape=(self.kernel_size, self.kernel_size,
                                                                        number_of_input_channels, self.output_channels),
                                 initializer=initializer)
-            b = tf.Variable(tf.zeros([self.output_channels]))
+            # `get_variable`, so recomputed layers (`Network.recompute_segments`) reuse it
+            b = tf.get_variable('b{}'.format(self.name), shape=(self.output_channels,),
+                                initializer=tf.zeros_initializer())
+        self.W, self.b = W, b
         tf.add_to_collection(tf.GraphKeys.REGULARIZATION_LOSSES, W)
-        output = tf.nn.atrous_conv2d(input, W, rate=self.dilation, padding='SAME')
+        # with mixed precision, the conv runs in `compute_dtype` on a cast of the float32 weights, as do the batch norms
+        # (with float32 parameters), bias and activation, and the output is stored as `dtype`
+        output = self.apply_conv(self.cast(input, compute_dtype), self.cast(W, compute_dtype))
         output = self.apply_dropout(output, dp_rate, is_training)
+        output = self.cast(output, self.get_norm_dtype(output.dtype))
 
         # apply batch-norm
         if self.batch_norm:
             print("apply batch norm")
-            output = tf.contrib.layers.batch_norm(output, is_training=is_training)
+            output = self.apply_batch_norm(output, 1, is_training=is_training)
 
-        output = tf.add(tf.contrib.layers.batch_norm(output), b)
+        output = tf.add(self.apply_batch_norm(output, 2), self.cast(b, output.dtype))
         output = self.get_act_values(output)
         output = self.zero_center_output(output, center)
-        return output
+        return self.cast(output, dtype)
 
     def apply_dropout(self, input, dp_rate=0.0, is_training=True):
         if self.dp_rate is not None:
@@ -91,13 +103,79 @@ class Conv2d(Layer):
     def get_description(self):
         return "C{},{},{}".format(self.kernel_size, self.output_channels, self.dilation)
 
+    @staticmethod
+    def get_norm_dtype(dtype):
+        """Type the batch norms and activation run in for a conv output of `dtype`: the fused batch norm takes float16
+        inputs (keeping float32 parameters and statistics), but not bfloat16 ones"""
+        if dtype.base_dtype == tf.float16:
+            return tf.float16
+        return tf.float32
+
+    def apply_batch_norm(self, input, i, **kwargs):
+        # half precision inputs need the fused batch norm, float32 ones keep the default implementation
+        fused = True if input.dtype.base_dtype == tf.float16 else None
+        return tf.contrib.layers.batch_norm(input, fused=fused,
+                                            variables_collections=self.get_batch_norm_collections(i), **kwargs)
+
+    def get_batch_norm_collections(self, i):
+        """Per layer collections of the variables of the `i`th batch norm, to find them again for export"""
+        return {var: ["{}_batch_norm_{}_{}".format(self.name, i, var)]
+                for var in ("beta", "moving_mean", "moving_variance")}
+
+    def get_batch_norm_values(self, sess, i):
+        collections = self.get_batch_norm_collections(i)
+        return {var: sess.run(tf.get_collection(collection[0])[0]) for var, collection in collections.items()}
+
+    def get_inference_values(self, sess):
+        """Trained weights with the first batch norm folded in.
+
+        At inference the first batch norm uses its moving statistics, i.e. it is a per channel affine transform. The
+        second batch norm always normalizes with the batch statistics, so the shift of the first one cancels out and
+        only its scale remains, which is folded into `W`"""
+        W, b = sess.run([self.W, self.b])
+        values = {"W": W, "offset": self.get_batch_norm_values(sess, 2)["beta"] + b}
+        if self.batch_norm:
+            moving_variance = self.get_batch_norm_values(sess, 1)["moving_variance"]
+            values["W"] = self.fold_scale(W, 1.0 / np.sqrt(moving_variance + BATCH_NORM_EPSILON))
+        return values
+
+    @staticmethod
+    def fold_scale(W, scale):
+        # output channels are the last dimension of conv weights
+        return W * scale
+
+    def create_inference_layer(self, input, values, include_w_input=None, center=False, dtype=None, **kwargs):
+        """Inference-only version of `create_layer` on the values of `get_inference_values`: no dropout, no training
+        branches, batch norm folded and a single fused op for the batch statistics normalization. All ops run in
+        `dtype`, except for the float32 batch norm parameters"""
+        input = self.cast(input, dtype)
+        if self.add_to_input:
+            input = tf.add(input, self.cast(include_w_input, input.dtype))
+        if self.concat_to_input:
+            input = tf.concat([input, self.cast(include_w_input, input.dtype)],axis=-1)
+        self.input_shape = get_incoming_shape(input)
+        output = self.apply_conv(input, tf.constant(values["W"].astype(input.dtype.as_numpy_dtype)))
+        output, _, _ = tf.nn.fused_batch_norm(output, scale=tf.ones([self.output_channels]),
+                                              offset=tf.constant(values["offset"]), epsilon=BATCH_NORM_EPSILON,
+                                              is_training=True)
+        if self.act_fn == "lrelu" and 0 <= self.act_leak_prob <= 1:
+            # equal to `lrelu` for leaks in [0, 1], as a single op
+            output = tf.nn.leaky_relu(output, alpha=self.act_leak_prob)
+        else:
+            output = self.get_act_values(output)
+        return self.zero_center_output(output, center)
+
+    def apply_conv(self, input, W):
+        return tf.nn.atrous_conv2d(input, W, rate=self.dilation, padding='SAME')
+
 class ConvT2d(Conv2d):
-    def create_layer(self, input, include_w_input=None, is_training=True, center=False, dp_rate=0.0, **kwargs):
+    def create_layer(self, input, include_w_input=None, is_training=True, center=False, dp_rate=0.0, dtype=None,
+                     compute_dtype=None, **kwargs):
         print("name: {}".format(self.name))
         if self.add_to_input:
-            input = tf.add(input, include_w_input)
+            input = tf.add(input, self.cast(include_w_input, input.dtype))
         if self.concat_to_input:
-            input = tf.concat([input, include_w_input],axis=-1)
+            input = tf.concat([input, self.cast(include_w_input, input.dtype)],axis=-1)
         self.input_shape = get_incoming_shape(input)
         print(self.input_shape)
         number_of_input_channels = self.input_shape[3]
@@ -111,25 +189,37 @@ class ConvT2d(Conv2d):
             W = tf.get_variable(('W{}'.format(self.name)), shape=(self.kernel_size, self.kernel_size,
                                                                        self.output_channels, number_of_input_channels),
                                 initializer=initializer)
-            b = tf.Variable(tf.zeros([self.output_channels]))
+            b = tf.get_variable('b{}'.format(self.name), shape=(self.output_channels,),
+                                initializer=tf.zeros_initializer())
+        self.W, self.b = W, b
         tf.add_to_collection(tf.GraphKeys.REGULARIZATION_LOSSES, W)
-        # hard-code dimension as `1`, batch size = 1, due to bug
-        output = tf.nn.atrous_conv2d_transpose(input, W, tf.stack([1,
-                                                                   self.input_shape[1],
-                                                                   self.input_shape[2],
-                                                                   self.output_channels]),
-                                               rate=self.dilation, padding='SAME')
-        output = self.apply_dropout(output, dp_rate)
+        # mixed precision as in `Conv2d.create_layer`
+        output = self.apply_conv(self.cast(input, compute_dtype), self.cast(W, compute_dtype))
+        output = self.apply_dropout(output, dp_rate, is_training)
+        output = self.cast(output, self.get_norm_dtype(output.dtype))
         # apply batch-norm
         if self.batch_norm:
             print("apply batch norm")
-            output = tf.contrib.layers.batch_norm(output, is_training=is_training)
+            output = self.apply_batch_norm(output, 1, is_training=is_training)
 
-        output = tf.add(tf.contrib.layers.batch_norm(output), b)
+        output = tf.add(self.apply_batch_norm(output, 2), self.cast(b, output.dtype))
         output = self.get_act_values(output)
         output = self.zero_center_output(output, center)
 
-        return output
+        return self.cast(output, dtype)
+
+    @staticmethod
+    def fold_scale(W, scale):
+        # output channels are the third dimension of transposed conv weights
+        return W * scale[:, np.newaxis]
+
+    def apply_conv(self, input, W):
+        # the batch dimension is only known at run time
+        return tf.nn.atrous_conv2d_transpose(input, W, tf.stack([tf.shape(input)[0],
+                                                                 self.input_shape[1],
+                                                                 self.input_shape[2],
+                                                                 self.output_channels]),
+                                             rate=self.dilation, padding='SAME')
 
 
 class DeformableConv2d(Layer):
@@ -15,20 +15,21 @@ class Pool(Layer):
         print("name: {}".format(self.name))
 
     def create_layer(self, input, include_w_input=None, pooling_method="MAX", unpooling_method="nearest_neighbor",
-                     center=False, **kwargs):
+                     center=False, dtype=None, **kwargs):
         print("name: {}".format(self.name))
         self.input_shape = get_incoming_shape(input)
         print(self.input_shape)
 
         if self.add_to_input:
-            input = tf.add(input, include_w_input)
+            input = tf.add(input, self.cast(include_w_input, input.dtype))
         if self.concat_to_input:
-            input = tf.concat([input, include_w_input],axis=-1)
+            input = tf.concat([input, self.cast(include_w_input, input.dtype)],axis=-1)
 
         output = self.apply_pool(input, self.kernel_size, pooling_method=pooling_method,
                                  unpooling_method=unpooling_method)
         output = self.zero_center_output(output, center)
-        return output
+        # bilinear and bicubic upsampling output float32
+        return self.cast(output, dtype)
 
     def apply_pool(self, input, *args, **kwargs):
         raise NotImplementedError()
@@ -0,0 +1,190 @@
+"""This is the file for computing the test set metrics from binned score histograms in a single pass"""
+import numpy as np
+
+# scores are binned in float64, where `score * n_bins` of a float32 score is exact, so every bin edge is exact too
+BIN_DTYPE = np.float64
+
+
+def get_score_bins(scores, n_bins):
+    """Bin of every score (clipped to [0, 1]), see `ScoreHistogram`. `Network.get_score_histogram` bins the same way"""
+    return np.ceil(np.clip(np.asarray(scores, dtype=BIN_DTYPE), 0.0, 1.0) * n_bins).astype(np.int64)
+
+
+class ScoreHistogram(object):
+    """Counts of scores in `n_bins` bins over [0, 1], per class and inside/outside of the mask.
+
+    Bin `k` holds the scores in ((k - 1) / n_bins, k / n_bins] (bin 0 holds exact zeros), so `score > t` is exact for
+    every threshold `t` that is a multiple of 1 / n_bins, such as .5 and the usual decision thresholds. Scores are added
+    in chunks, so memory stays at a few arrays of `chunk_size` besides the counts."""
+
+    def __init__(self, n_bins=10000, chunk_size=1 << 20):
+        self.n_bins = n_bins
+        self.chunk_size = chunk_size
+        # [outside/inside mask, negative/positive, bin]
+        self.counts = np.zeros((2, 2, n_bins + 1), dtype=np.int64)
+
+    def add(self, scores, targets, masks=None):
+        scores = np.ravel(scores)
+        targets = np.ravel(targets)
+        masks = np.ravel(masks) if masks is not None else None
+        for start in range(0, len(scores), self.chunk_size):
+            end = start + self.chunk_size
+            bins = get_score_bins(scores[start:end], self.n_bins)
+            groups = np.round(targets[start:end]).astype(np.int64)
+            if masks is not None:
+                groups += 2 * (masks[start:end] > 0)
+            else:
+                groups += 2
+            self.counts += np.bincount(groups * (self.n_bins + 1) + bins,
+                                       minlength=4 * (self.n_bins + 1)).reshape(self.counts.shape)
+        return self
+
+    def get_class_counts(self, masked=True):
+        """Negative and positive counts per bin, inside the mask or over all pixels"""
+        counts = self.counts[1] if masked else self.counts.sum(axis=0)
+        return counts[0], counts[1]
+
+    def get_confusion_matrix(self, threshold, masked=True):
+        """tn, fp, fn, tp of predicting `score > threshold`"""
+        neg_counts, pos_counts = self.get_class_counts(masked)
+        threshold_bin = int(np.floor(threshold * self.n_bins + 1e-6))
+        fp, tp = neg_counts[threshold_bin + 1:].sum(), pos_counts[threshold_bin + 1:].sum()
+        return neg_counts.sum() - fp, fp, pos_counts.sum() - tp, tp
+
+    def get_roc_curve(self, masked=True):
+        """fprs, tprs and thresholds (upper bin edges) in order of decreasing threshold, like `roc_curve`"""
+        neg_counts, pos_counts = self.get_class_counts(masked)
+        occupied = (neg_counts + pos_counts)[::-1] > 0
+        fps = np.cumsum(neg_counts[::-1])[occupied]
+        tps = np.cumsum(pos_counts[::-1])[occupied]
+        thresholds = (np.arange(self.n_bins, -1, -1) / float(self.n_bins))[occupied]
+        # drop the points on straight stretches of the curve, as `roc_curve(drop_intermediate=True)` does
+        corners = np.r_[True, np.logical_or(np.diff(fps, 2), np.diff(tps, 2)), True]
+        fps, tps, thresholds = fps[corners], tps[corners], thresholds[corners]
+        fprs = np.concatenate([[0.0], fps / float(max(fps[-1], 1))])
+        tprs = np.concatenate([[0.0], tps / float(max(tps[-1], 1))])
+        return fprs, tprs, np.concatenate([[thresholds[0] + 1], thresholds])
+
+
+def get_kappa(tn, fp, fn, tp):
+    total = float(tn + fp + fn + tp)
+    observed = (tp + tn) / total
+    expected = ((tp + fp) * (tp + fn) + (tn + fn) * (tn + fp)) / total ** 2
+    return (observed - expected) / (1 - expected)
+
+
+def get_area(ys, xs):
+    """Trapezoidal area under the curve `ys` over `xs`"""
+    return float(np.sum(np.diff(xs) * (ys[1:] + ys[:-1]) / 2.0))
+
+
+def get_f1_score(precision, recall):
+    return 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+
+
+def get_partial_auc(fprs, tprs, max_fpr):
+    """AUC over the points of the curve below `max_fpr`"""
+    below = fprs < max_fpr
+    if below.sum() > 1:
+        return get_area(tprs[below], fprs[below])
+    return np.nan
+
+
+def get_max_threshold_accuracies(results, targets, neg_class_fracs, pos_class_fracs, masks=None, n_bins=10000):
+    """Best accuracy `(1 - fpr) * neg_class_frac + tpr * pos_class_frac` of every image in `results` over the thresholds
+    `k / n_bins`, and the threshold reaching it.
+
+    All images are binned with one `bincount` and the accuracy-vs-threshold curves come from cumulative sums of the
+    per-image histograms. Pixels are weighted by `masks`, like `sample_weight` in `roc_curve`"""
+    num_images = len(results)
+    results = np.reshape(results, (num_images, -1))
+    bins = get_score_bins(results, n_bins)
+    groups = 2 * np.arange(num_images, dtype=np.int64)[:, np.newaxis] + \
+        np.round(np.reshape(targets, results.shape)).astype(np.int64)
+    weights = np.ravel(masks) if masks is not None else None
+    counts = np.bincount((groups * (n_bins + 1) + bins).ravel(), weights=weights,
+                         minlength=num_images * 2 * (n_bins + 1)).reshape((num_images, 2, n_bins + 1))
+    return get_max_threshold_accuracies_from_counts(counts, neg_class_fracs, pos_class_fracs)
+
+
+def get_max_threshold_accuracies_from_counts(counts, neg_class_fracs, pos_class_fracs):
+    """`get_max_threshold_accuracies` from per-image class counts `[images, negative/positive, n_bins + 1]`"""
+    num_images, n_bins = counts.shape[0], counts.shape[-1] - 1
+    # predicting `score > k / n_bins` makes the counts of the bins above `k` positive
+    above = np.cumsum(counts[..., ::-1], axis=-1)[..., ::-1]
+    above = np.concatenate([above[..., 1:], np.zeros((num_images, 2, 1))], axis=-1)
+    totals = np.maximum(counts.sum(axis=-1), 1)
+    fprs, tprs = above[:, 0] / totals[:, 0:1], above[:, 1] / totals[:, 1:2]
+    accuracies = (1 - fprs) * np.reshape(neg_class_fracs, (-1, 1)) + tprs * np.reshape(pos_class_fracs, (-1, 1))
+    best_bins = np.argmax(accuracies, axis=1)
+    return accuracies[np.arange(num_images), best_bins], best_bins / float(n_bins)
+
+
+class EvaluationAccumulator(object):
+    """Test set metrics state updated image by image, so evaluation memory does not grow with the number of images.
+
+    Holds the `ScoreHistogram` of all images and the max threshold accuracy (and its threshold) of each image"""
+
+    def __init__(self, n_bins=10000):
+        self.histogram = ScoreHistogram(n_bins=n_bins)
+        self.max_threshold_accuracies = []
+        self.max_thresholds = []
+
+    def add(self, result, target, mask, neg_class_frac, pos_class_frac):
+        self.histogram.add(result, target, mask)
+        accuracies, thresholds = get_max_threshold_accuracies(np.expand_dims(result, 0), target, [neg_class_frac],
+                                                              [pos_class_frac], masks=mask,
+                                                              n_bins=self.histogram.n_bins)
+        self.max_threshold_accuracies.append(accuracies[0])
+        self.max_thresholds.append(thresholds[0])
+
+    def add_counts(self, counts, neg_class_frac, pos_class_frac):
+        """Add an image's in-graph score histogram `[outside/inside mask, negative/positive, n_bins + 1]`"""
+        self.histogram.counts += counts
+        accuracies, thresholds = get_max_threshold_accuracies_from_counts(counts[np.newaxis, 1], [neg_class_frac],
+                                                                          [pos_class_frac])
+        self.max_threshold_accuracies.append(accuracies[0])
+        self.max_thresholds.append(thresholds[0])
+
+    def get_max_threshold_accuracy(self):
+        return float(np.mean(self.max_threshold_accuracies))
+
+
+def get_histogram_metric_scores(histogram, decision_threshold, num_thresh_scores, neg_class_frac, pos_class_frac):
+    """The test set metrics of `Job.get_metrics_on_test_set` and its threshold scores, from a `ScoreHistogram`"""
+    metric_scores = dict()
+
+    fprs, tprs, thresholds = histogram.get_roc_curve()
+    metric_scores["auc"] = get_area(tprs, fprs)
+    metric_scores["aucfpr10"] = get_partial_auc(fprs, tprs, .10)
+    metric_scores["aucfpr05"] = get_partial_auc(fprs, tprs, .05)
+    metric_scores["aucfpr025"] = get_partial_auc(fprs, tprs, .025)
+
+    interval = 1.0 / num_thresh_scores
+    threshold_scores = []
+    for i in np.arange(0, 1.0 + interval, interval):
+        index = int(round((len(thresholds) - 1) * i, 0))
+        fpr, tpr, threshold = fprs[index], tprs[index], thresholds[index]
+        thresh_acc = (1 - fpr) * neg_class_frac + tpr * pos_class_frac
+        threshold_scores.append((threshold, thresh_acc, tpr, 1 - fpr))
+
+    # at .5, precision and recall are computed inside the mask, accuracy, specificity and kappa over all pixels
+    tn, fp, fn, tp = histogram.get_confusion_matrix(.5)
+    metric_scores["precision"] = float(tp) / (tp + fp) if tp + fp else 0.0
+    metric_scores["recall"] = float(tp) / (tp + fn) if tp + fn else 0.0
+    metric_scores["f1_score"] = get_f1_score(metric_scores["precision"], metric_scores["recall"])
+    tn, fp, fn, tp = histogram.get_confusion_matrix(.5, masked=False)
+    metric_scores["accuracy"] = float(tp + tn) / (tp + tn + fp + fn)
+    metric_scores["specificity"] = float(tn) / (tn + fp)
+    metric_scores["kappa"] = get_kappa(tn, fp, fn, tp)
+
+    # at `decision_threshold`, everything is computed inside the mask
+    tn, fp, fn, tp = histogram.get_confusion_matrix(decision_threshold)
+    metric_scores["dt precision"] = float(tp) / (tp + fp) if tp + fp else 0.0
+    metric_scores["dt recall"] = float(tp) / (tp + fn) if tp + fn else 0.0
+    metric_scores["dt f1_score"] = get_f1_score(metric_scores["dt precision"], metric_scores["dt recall"])
+    metric_scores["dt accuracy"] = float(tp + tn) / (tp + tn + fp + fn)
+    metric_scores["dt specificity"] = float(tn) / (tn + fp)
+    metric_scores["dt kappa"] = get_kappa(tn, fp, fn, tp)
+
+    return metric_scores, threshold_scores
@@ -10,6 +10,7 @@ from tensorflow.python.training.gradient_descent import GradientDescentOptimizer
 from utilities.objective_functions import generalised_dice_loss, sensitivity_specificity_loss, cross_entropy, dice
 from layers.conv_ops import Conv2d, ConvT2d
 from layers.pool_ops import Pool2d, Pool3d, UnPool2d
+from metrics.histogram import BIN_DTYPE
 
 class Network(object):
 
@@ -17,19 +18,45 @@ class Network(object):
                  learning_rate_and_kwargs=(.001, {}), op_fun_and_kwargs=("adam", {}), mask=False, dp_rate=0.0,
                  center=False, pooling_method="MAX", unpooling_method="nearest_neighbor", last_layer_op=None,
                  num_prev_last_conv_output_channels=1, layers=None, encoder_decoder=True, num_batches_in_epoch = 1,
-                 **kwargs):
+                 input_structure=None, patch_size=None, metrics_n_bins=None, precision="float32", compute_precision=None,
+                 loss_scale="dynamic", recompute_segments=None, grad_accum_steps=1, objective_fns=None, **kwargs):
         self.num_batches_in_epoch = num_batches_in_epoch
+        # objectives in the graph, `set_hyperparameters` switches between them
+        self.objective_fns = tuple(objective_fns) if objective_fns is not None else (objective_fn,)
+        if objective_fn not in self.objective_fns:
+            raise ValueError("Objective function {} not in {}".format(objective_fn, self.objective_fns))
+        # with gradient accumulation, `train_op` adds up the gradients of a batch and `apply_gradients_op` applies
+        # those of the last `grad_accum_steps` batches
+        self.grad_accum_steps = grad_accum_steps
+        self.apply_gradients_op = None
+        # mixed precision: layer outputs are stored as `precision` and convs run in `compute_precision` (float32 unless
+        # given, see `get_device_compute_precision`), while the weights, batch norm parameters and the loss stay float32
+        self.dtype = tf.as_dtype(precision)
+        self.compute_dtype = tf.as_dtype(compute_precision if compute_precision is not None else "float32")
+        self.loss_scale = loss_scale
+        # activation recomputation (gradient checkpointing), see `create_layers`
+        self.recompute_segments = recompute_segments
         self.cur_objective_fn = objective_fn
         self.cur_learning_rate = learning_rate_and_kwargs
         self.cur_op_fn = op_fun_and_kwargs
         self.regularization = regularizer_args
 
         self.mask = mask
-        self.inputs = tf.placeholder(tf.float32, [None, self.FIT_IMAGE_HEIGHT, self.FIT_IMAGE_WIDTH,
-                                                  self.IMAGE_CHANNELS], name='inputs')
-        self.targets = tf.placeholder(tf.float32, [None, self.IMAGE_HEIGHT, self.IMAGE_WIDTH, 1], name='targets')
-        if self.mask:
-            self.masks = tf.placeholder(tf.float32, [None, self.IMAGE_HEIGHT, self.IMAGE_WIDTH, 1], name='masks')
+        self.center = center
+        self.pooling_method = pooling_method
+        self.unpooling_method = unpooling_method
+        self.last_layer_op = None
+        # with a number of bins, the test set metrics are computed from in-graph score histograms
+        self.metrics_n_bins = metrics_n_bins
+        # networks trained on patches take (and output) patches instead of whole (padded) images
+        self.patch_size = patch_size
+        if patch_size is not None:
+            self.input_height, self.input_width = patch_size
+            self.output_height, self.output_width = patch_size
+        else:
+            self.input_height, self.input_width = self.FIT_IMAGE_HEIGHT, self.FIT_IMAGE_WIDTH
+            self.output_height, self.output_width = self.IMAGE_HEIGHT, self.IMAGE_WIDTH
+        self.init_inputs(input_structure)
 
         self.is_training = tf.placeholder_with_default(False, [], name='is_training')
         self.layer_outputs = []
@@ -56,7 +83,13 @@ class Network(object):
             else:
                 print("Decoder has no len attribute")
 
-            net = self.encode(self.inputs, center=center, pooling_method=pooling_method, dp_rate=dp_rate)
+            net_layers = [layer for part in (self.encoder, self.decoder) if isinstance(part, list) for layer in part]
+            if recompute_segments is not None and (dp_rate or any(getattr(layer, "dp_rate", None)
+                                                                  for layer in net_layers)):
+                raise ValueError("Recomputed layers would draw different dropout masks, set `dp_rate` to 0")
+
+            net = self.encode(tf.cast(self.inputs, self.dtype), center=center, pooling_method=pooling_method,
+                              dp_rate=dp_rate)
             net = self.decode(net, center=center, unpooling_method=unpooling_method, dp_rate=dp_rate)
         else:
             if layers == None:
@@ -76,13 +109,108 @@ class Network(object):
 
         self.calculate_net_output(net, **kwargs)
 
+    def init_inputs(self, input_structure=None):
+        """Create the input placeholders.
+
+        If `input_structure` (the output types and shapes of a `tf.data.Dataset`) is given, the inputs come from an
+        iterator selected by feeding its string handle to `input_handle`. The placeholders then default to the iterator
+        outputs, so arrays can still be fed directly."""
+        inputs_shape = [None, self.input_height, self.input_width, self.IMAGE_CHANNELS]
+        targets_shape = [None, self.output_height, self.output_width, 1]
+        if input_structure is None:
+            self.input_handle = None
+            self.inputs = tf.placeholder(tf.float32, inputs_shape, name='inputs')
+            self.targets = tf.placeholder(tf.float32, targets_shape, name='targets')
+            if self.mask:
+                self.masks = tf.placeholder(tf.float32, targets_shape, name='masks')
+        else:
+            output_types, output_shapes = input_structure
+            self.input_handle = tf.placeholder(tf.string, [], name='input_handle')
+            iterator = tf.data.Iterator.from_string_handle(self.input_handle, output_types, output_shapes)
+            input_tensors = iterator.get_next()
+            self.inputs = tf.placeholder_with_default(input_tensors[0], inputs_shape, name='inputs')
+            self.targets = tf.placeholder_with_default(input_tensors[-1], targets_shape, name='targets')
+            if self.mask:
+                self.masks = tf.placeholder_with_default(input_tensors[1], targets_shape, name='masks')
+
     def calculate_net_output(self, net,  **loss_kwargs):
-        net = tf.image.resize_image_with_crop_or_pad(net, self.IMAGE_HEIGHT, self.IMAGE_WIDTH)
+        net = tf.cast(net, tf.float32)
+        net = tf.image.resize_image_with_crop_or_pad(net, self.output_height, self.output_width)
+        targets = self.targets
         if self.mask:
             net = self.mask_results(net)
         self.segmentation_result = tf.sigmoid(net)
+        self.score_histogram = None
+        if self.metrics_n_bins is not None:
+            self.score_histogram = self.get_score_histogram(self.segmentation_result, targets,
+                                                            self.masks if self.mask else None)
+        # a variable, so a reused graph can train with another `pos_weight`
+        self.pos_weight = None
+        if "pos_weight" in loss_kwargs:
+            self.pos_weight = tf.Variable(float(loss_kwargs["pos_weight"]), trainable=False, name="pos_weight")
+            loss_kwargs["pos_weight"] = self.pos_weight
         self.calculate_loss(net, **loss_kwargs)
-        self.train_op = self.cur_op_fn.minimize(self.cost, global_step=self._global_step)
+        self.train_op = self.build_train_op()
+
+    def set_hyperparameters(self, sess, learning_rate_and_kwargs=(.001, {}), objective_fn="wce", pos_weight=None,
+                            num_batches_in_epoch=1, **kwargs):
+        """Load the learning rate, objective function and `pos_weight` of a run into the graph (same defaults as
+        `__init__`), to train a graph built for another run with them after its variables are initialized"""
+        base_learning_rate, learning_rate_kwargs = learning_rate_and_kwargs
+        self.base_learning_rate.load(base_learning_rate, sess)
+        if self.decay_steps is not None:
+            self.decay_steps.load(self.get_decay_steps(learning_rate_kwargs.get("decay_epochs", 10),
+                                                       num_batches_in_epoch), sess)
+        if objective_fn not in self.objective_fns:
+            raise ValueError("Objective function {} not in {}".format(objective_fn, self.objective_fns))
+        if self.objective_index is not None:
+            self.objective_index.load(self.objective_fns.index(objective_fn), sess)
+        self.objective_fn = objective_fn
+        if pos_weight is not None and self.pos_weight is not None:
+            self.pos_weight.load(pos_weight, sess)
+        self.num_batches_in_epoch = num_batches_in_epoch
+
+    @staticmethod
+    def get_device_compute_precision(precision, device=None):
+        """`compute_precision` for a network built on `device`: half precision convs are only fast on gpus, on cpus
+        only the activations are stored compactly. Decided from the device string, without initializing the devices"""
+        if device is not None and (tf.DeviceSpec.from_string(device).device_type or "").upper() == "GPU":
+            return precision
+        return "float32"
+
+    def build_train_op(self):
+        """Minimize the cost, scaling the loss for half precision convs so small gradients don't underflow.
+
+        `loss_scale` is a constant scale or `"dynamic"`, which starts high and halves the scale (skipping the update)
+        whenever gradients overflow. With `grad_accum_steps`, the returned op only adds up the gradients of a batch"""
+        optimizer = self.cur_op_fn
+        # the batch norm moving statistics are updated with every batch. The updates are collected before the gradients
+        # are built, which recreates those of recomputed segments (`recompute_segments`) a second time
+        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+        if self.compute_dtype != tf.float32 and self.loss_scale is not None:
+            if self.loss_scale == "dynamic":
+                loss_scale_manager = tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(
+                    init_loss_scale=2 ** 15, incr_every_n_steps=2000)
+            else:
+                loss_scale_manager = tf.contrib.mixed_precision.FixedLossScaleManager(self.loss_scale)
+            optimizer = tf.contrib.mixed_precision.LossScaleOptimizer(optimizer, loss_scale_manager)
+        if self.grad_accum_steps == 1:
+            grads_and_vars = optimizer.compute_gradients(self.cost)
+            with tf.control_dependencies(update_ops):
+                return optimizer.apply_gradients(grads_and_vars, global_step=self._global_step)
+
+        grads_and_vars = [(grad, var) for grad, var in optimizer.compute_gradients(self.cost) if grad is not None]
+        accumulators = [tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype), trainable=False,
+                                    name="grad_accumulator") for _, var in grads_and_vars]
+        with tf.control_dependencies(update_ops):
+            accumulate_op = tf.group(*[accumulator.assign_add(grad) for accumulator, (grad, _) in
+                                       zip(accumulators, grads_and_vars)])
+        apply_op = optimizer.apply_gradients([(accumulator / self.grad_accum_steps, var) for accumulator, (_, var) in
+                                              zip(accumulators, grads_and_vars)], global_step=self._global_step)
+        with tf.control_dependencies([apply_op]):
+            self.apply_gradients_op = tf.group(*[accumulator.assign(tf.zeros_like(accumulator))
+                                                 for accumulator in accumulators])
+        return accumulate_op
 
     def init_encoder(self, **encoder_kwargs):
         raise NotImplementedError("Method Not Implemented")
@@ -127,36 +255,122 @@ class Network(object):
 
     def encode(self, net, center=False, pooling_method="MAX", dp_rate=0.0):
         self.encoder_layers = {}
-        for i, layer in enumerate(self.encoder):
-            net = layer.create_layer(net, is_training=self.is_training, center=center, pooling_method=pooling_method,
-                                     dp_rate=dp_rate)
-            self.encoder_layers[layer.name] = net
-            self.description += "{}".format(layer.get_description())
-            self.layer_outputs.append(net)
+        # outputs decoder layers add or concatenate to their input
+        skip_names = set(layer.add_to_input or layer.concat_to_input for layer in self.decoder)
+        for layers in self.get_recompute_segments(self.encoder):
+            net, layer_outputs = self.create_layers(layers, net, kept_names=skip_names, center=center,
+                                                    pooling_method=pooling_method, dp_rate=dp_rate)
+            self.encoder_layers.update(layer_outputs)
         return net
 
     def decode(self, net, center=False, unpooling_method="MAX", dp_rate=0.0):
-        for i, layer in enumerate(self.decoder, start=1):
-            include_w_input = layer.add_to_input or layer.concat_to_input
-            net = layer.create_layer(net, is_training=self.is_training, center=center,
-                                     include_w_input=self.encoder_layers.get(include_w_input),
-                                     unpooling_method=unpooling_method, dp_rate=dp_rate)
-            self.description += "{}".format(layer.get_description())
-            self.layer_outputs.append(net)
+        for layers in self.get_recompute_segments(self.decoder):
+            net, _ = self.create_layers(layers, net, include_w_inputs=self.encoder_layers, center=center,
+                                        unpooling_method=unpooling_method, dp_rate=dp_rate)
         return net
 
+    def get_recompute_segments(self, layers):
+        """Split `layers` into the segments whose activations are recomputed: `recompute_segments` layers each, or
+        ending at the layers named in `recompute_segments`"""
+        if self.recompute_segments is None:
+            return [layers]
+        if isinstance(self.recompute_segments, int):
+            return [layers[i:i + self.recompute_segments] for i in range(0, len(layers), self.recompute_segments)]
+        segments = [[]]
+        for layer in layers:
+            segments[-1].append(layer)
+            if layer.name in self.recompute_segments:
+                segments.append([])
+        return [segment for segment in segments if segment]
+
+    def create_layers(self, layers, net, include_w_inputs=None, kept_names=(), **layer_kwargs):
+        """Create `layers` one after another on `net`, a layer adding or concatenating the output of layer `name` to
+        its input gets `include_w_inputs[name]`. Return the output and the layers' outputs by name.
+
+        With `recompute_segments`, the activations of the layers are not kept for the backward pass but recomputed
+        from the inputs of the layers, only the output and the outputs of layers in `kept_names` are kept"""
+        include_w_inputs = include_w_inputs if include_w_inputs is not None else {}
+        input_names = sorted(set(layer.add_to_input or layer.concat_to_input for layer in layers) &
+                             set(include_w_inputs))
+        output_names = [layer.name for layer in layers[:-1] if layer.name in kept_names]
+        forward_outputs = []
+
+        def create_layer(layer, net, include_w_input):
+            return layer.create_layer(net, is_training=self.is_training, include_w_input=include_w_input,
+                                      dtype=self.dtype, compute_dtype=self.compute_dtype, **layer_kwargs)
+
+        def segment_fn(net, *inputs):
+            layer_include_w_inputs = dict(zip(input_names, inputs))
+            outputs = []
+            for layer in layers:
+                include_w_input = layer_include_w_inputs.get(layer.add_to_input or layer.concat_to_input)
+                if self.recompute_segments is None:
+                    net = create_layer(layer, net, include_w_input)
+                else:
+                    # recomputed layers need resource variables, and a scope per layer so the recomputation finds the
+                    # batch norm variables again under the same default names
+                    with tf.variable_scope(layer.name, use_resource=True):
+                        net = create_layer(layer, net, include_w_input)
+                outputs.append(net)
+            # the recomputation in the backward pass creates the layers again
+            if not forward_outputs:
+                forward_outputs.extend(outputs)
+            return [net] + [output for layer, output in zip(layers, outputs) if layer.name in output_names]
+
+        inputs = [net] + [include_w_inputs[name] for name in input_names]
+        if self.recompute_segments is None:
+            segment_outputs = segment_fn(*inputs)
+        else:
+            segment_outputs = tf.contrib.layers.recompute_grad(segment_fn)(*inputs)
+
+        layer_outputs = dict((layer.name, output) for layer, output in zip(layers, forward_outputs))
+        layer_outputs.update(zip(output_names, segment_outputs[1:]))
+        layer_outputs[layers[-1].name] = segment_outputs[0]
+        for layer, output in zip(layers, forward_outputs):
+            self.description += "{}".format(layer.get_description())
+            self.layer_outputs.append(output)
+        return segment_outputs[0], layer_outputs
+
     def calculate_loss(self, net, **kwargs):
         print('segmentation_result.shape: {}, targets.shape: {}'.format(self.segmentation_result.get_shape(),
                                                                         self.targets.get_shape()))
-        self.cost = self.cur_objective_fn(self.targets, net, **kwargs) + self.regularization
+        self.objective_index = None
+        if len(self.objective_fns) == 1:
+            cost = self.cur_objective_fn(self.targets, net, **kwargs)
+        else:
+            # only the objective selected by `objective_index` is computed
+            self.objective_index = tf.Variable(self.objective_fns.index(self.objective_fn), trainable=False,
+                                               name="objective_index")
+            fns = [self.get_objective_fn(objective_fn) for objective_fn in self.objective_fns]
+            cost = tf.case([(tf.equal(self.objective_index, i), lambda fn=fn: fn(self.targets, net, **kwargs))
+                            for i, fn in enumerate(fns)],
+                           default=lambda: fns[0](self.targets, net, **kwargs), exclusive=True)
+        self.cost = cost + self.regularization
         self.cost_unweighted = self.get_objective_fn("ce")(self.targets, net) + self.regularization
 
     def apply_last_layer_op(self, net, **kwargs):
-        net = self.last_layer_op.create_layer(net, **kwargs)
+        net = self.last_layer_op.create_layer(net, dtype=self.dtype, compute_dtype=self.compute_dtype, **kwargs)
         self.description += "{}".format(self.last_layer_op.get_description())
         self.layer_outputs.append(net)
         return net
 
+    def get_score_histogram(self, segmentation_result, targets, masks=None):
+        """Per-image counts `[batch, outside/inside mask, negative/positive, metrics_n_bins + 1]` of the scores, binned
+        like `metrics.histogram.get_score_bins`"""
+        n_bins = self.metrics_n_bins
+        scores = tf.clip_by_value(tf.cast(segmentation_result, tf.as_dtype(BIN_DTYPE)), 0.0, 1.0)
+        bins = tf.cast(tf.ceil(scores * n_bins), tf.int32)
+        groups = tf.cast(tf.round(targets), tf.int32)
+        if masks is not None:
+            groups += 2 * tf.cast(masks > 0, tf.int32)
+        else:
+            groups += 2
+        batch_size = tf.shape(segmentation_result)[0]
+        image_ids = tf.reshape(tf.range(batch_size), [-1, 1, 1, 1])
+        segment_ids = (image_ids * 4 + groups) * (n_bins + 1) + bins
+        counts = tf.unsorted_segment_sum(tf.ones_like(segment_ids), segment_ids, batch_size * 4 * (n_bins + 1))
+        return tf.reshape(counts, [-1, 2, 2, n_bins + 1])
+
     def mask_results(self, net):
         net = tf.multiply(net, self.masks)
         self.targets = tf.multiply(self.targets, self.masks)
@@ -179,12 +393,23 @@ class Network(object):
     @cur_learning_rate.setter
     def cur_learning_rate(self, learning_rate_and_kwargs):
         base_learning_rate, kwargs = learning_rate_and_kwargs
+        kwargs = dict(kwargs)
         self._global_step = tf.Variable(0, trainable=False)
+        # variables, so a reused graph can train with other values (see `set_hyperparameters`)
+        self.base_learning_rate = tf.Variable(float(base_learning_rate), trainable=False, name="base_learning_rate")
+        self.decay_steps = None
         if kwargs:
-            kwargs['decay_steps']=kwargs.pop('decay_epochs',10)*self.num_batches_in_epoch
-            self.learning_rate = tf.train.exponential_decay(base_learning_rate, self._global_step, **kwargs)
+            self.decay_steps = tf.Variable(float(self.get_decay_steps(kwargs.pop('decay_epochs',10),
+                                                                      self.num_batches_in_epoch)),
+                                           trainable=False, name="decay_steps")
+            self.learning_rate = tf.train.exponential_decay(self.base_learning_rate, self._global_step,
+                                                            decay_steps=self.decay_steps, **kwargs)
         else:
-            self.learning_rate = tf.constant(base_learning_rate)
+            self.learning_rate = tf.identity(self.base_learning_rate)
+
+    def get_decay_steps(self, decay_epochs, num_batches_in_epoch):
+        # the global step counts updates, i.e. accumulated batches
+        return max(1, decay_epochs * num_batches_in_epoch // self.grad_accum_steps)
 
     @property
     def cur_op_fn(self):
@@ -0,0 +1,86 @@
+"""This is the file for exporting trained networks as frozen, inference-only graphs"""
+import os
+import numpy as np
+import tensorflow as tf
+
+
+def export_inference_graph(network, sess, export_path, device=None):
+    """Write a frozen inference-only graph of the trained `network` (a binary `GraphDef`) to `export_path`.
+
+    All weights become constants, batch norms are folded into the conv weights, dropout and the `is_training` branches
+    are left out and `lrelu` is a single op. The graph takes `inputs` (and `masks` for masked networks) and outputs
+    `segmentation_result`. Layers run in the network's `precision` if the graph is exported for a gpu `device` (to be
+    loaded with `InferenceGraph(gpu_device=device)`), else in float32, as half precision convs are slow or, for
+    bfloat16, missing on cpus (see `Network.get_device_compute_precision`)"""
+    dtype = tf.as_dtype(network.get_device_compute_precision(network.dtype.name, device))
+    if not isinstance(network.encoder, list) or not isinstance(network.decoder, list):
+        raise ValueError("Only networks built from `layers` can be exported")
+    last_layers = [network.last_layer_op] if network.last_layer_op is not None else []
+    layers_values = [(layer, layer.get_inference_values(sess)) for layer in network.encoder + network.decoder +
+                     last_layers]
+
+    graph = tf.Graph()
+    with graph.as_default():
+        inputs = tf.placeholder(tf.float32, [None, network.input_height, network.input_width, network.IMAGE_CHANNELS],
+                                name="inputs")
+        net = tf.cast(inputs, dtype)
+        encoder_layers = {}
+        for i, (layer, values) in enumerate(layers_values):
+            include_w_input = None
+            if i >= len(network.encoder):
+                include_w_input = encoder_layers.get(getattr(layer, "add_to_input", None) or
+                                                     getattr(layer, "concat_to_input", None))
+            net = layer.create_inference_layer(net, values, include_w_input=include_w_input, center=network.center,
+                                               pooling_method=network.pooling_method,
+                                               unpooling_method=network.unpooling_method, dtype=dtype)
+            if i < len(network.encoder):
+                encoder_layers[layer.name] = net
+
+        net = tf.cast(net, tf.float32)
+        net = tf.image.resize_image_with_crop_or_pad(net, network.output_height, network.output_width)
+        if network.mask:
+            masks = tf.placeholder(tf.float32, [None, network.output_height, network.output_width, 1], name="masks")
+            net = tf.multiply(net, masks)
+        tf.sigmoid(net, name="segmentation_result")
+
+    export_dir, export_name = os.path.split(os.path.abspath(export_path))
+    tf.train.write_graph(graph.as_graph_def(), export_dir, export_name, as_text=False)
+    print("exported inference graph: {}".format(export_path))
+    return export_path
+
+
+class InferenceGraph(object):
+    """Loads a graph written by `export_inference_graph` and runs it"""
+
+    def __init__(self, graph_path, gpu_device=None):
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(graph_path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            if gpu_device is not None:
+                with tf.device(gpu_device):
+                    tf.import_graph_def(graph_def, name="")
+            else:
+                tf.import_graph_def(graph_def, name="")
+        self.inputs = self.graph.get_tensor_by_name("inputs:0")
+        self.segmentation_result = self.graph.get_tensor_by_name("segmentation_result:0")
+        op_names = [op.name for op in self.graph.get_operations()]
+        self.masks = self.graph.get_tensor_by_name("masks:0") if "masks" in op_names else None
+
+        config = tf.ConfigProto(allow_soft_placement=True)
+        config.gpu_options.allow_growth = True
+        self.sess = tf.Session(graph=self.graph, config=config)
+
+    def run(self, images, masks=None):
+        """Probability maps `[batch, height, width]` of a batch of images `[batch, height, width]`"""
+        feed_dict = {self.inputs: np.expand_dims(images, axis=-1)}
+        if self.masks is not None:
+            if masks is None:
+                masks = np.ones(self.masks.get_shape().as_list()[1:3], dtype=np.float32)[np.newaxis].repeat(
+                    len(images), axis=0)
+            feed_dict[self.masks] = np.expand_dims(masks, axis=-1)
+        return self.sess.run(self.segmentation_result, feed_dict=feed_dict)[..., 0]
+
+    def close(self):
+        self.sess.close()
@@ -171,7 +171,7 @@ class SmallNetworkwKerasDecoder(SmallNetwork):
         # weights are hard-coded to be random, don't want to deal with pre-trained being clobbered during initialization
         # http://zachmoshe.com/2017/11/11/use-keras-models-with-tf.html
         base_model = self.encoder_model(weights=None, include_top=False, input_tensor=self.keras_inputs,
-                                        input_shape=[self.FIT_IMAGE_HEIGHT, self.FIT_IMAGE_WIDTH, 3])
+                                        input_shape=[self.input_height, self.input_width, 3])
         self.encoder_layers = {l.name: l.output for l in base_model.layers}
         if self.encoder_layer_name:
             self.encoder = self.encoder_layers[self.encoder_layer_name]
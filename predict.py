@@ -0,0 +1,45 @@
+"""Segment a directory (or list) of images with a model saved by `Job.train`, e.g.
+
+    python predict.py <OUTPUTS_DIR_PATH>/save/<description>/<timestamp> <images dir> <output dir> --batch_size 4
+"""
+import os
+import argparse
+
+from job.predictor import Predictor
+
+
+def list_images(inputs):
+    image_paths = []
+    for input_path in inputs:
+        if os.path.isdir(input_path):
+            image_paths += [os.path.join(input_path, file_name) for file_name in sorted(os.listdir(input_path))]
+        else:
+            image_paths.append(input_path)
+    return image_paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("model_dir", help="directory with `config.json` and the checkpoints of a run")
+    parser.add_argument("inputs", nargs="+", help="image files and/or directories of images")
+    parser.add_argument("output_dir")
+    parser.add_argument("--masks_dir", default=None, help="FOV masks, sorted like the images")
+    parser.add_argument("--checkpoint", default=None, help="checkpoint path, the latest one by default")
+    parser.add_argument("--batch_size", type=int, default=1, help="images (or tiles) per run")
+    parser.add_argument("--threshold", type=float, default=None, help="write binary masks instead of probabilities")
+    parser.add_argument("--output_format", default="png", choices=["png", "npy"])
+    parser.add_argument("--tile_size", type=int, default=None)
+    parser.add_argument("--tile_overlap", type=int, default=0)
+    parser.add_argument("--tile_blending", default=None, choices=["gaussian", "cosine"])
+    parser.add_argument("--gpu_device", default=None)
+    args = parser.parse_args()
+
+    image_paths = list_images(args.inputs)
+    mask_paths = list_images([args.masks_dir]) if args.masks_dir is not None else None
+
+    predictor = Predictor(args.model_dir, checkpoint_path=args.checkpoint, batch_size=args.batch_size,
+                          tile_size=args.tile_size, tile_overlap=args.tile_overlap, tile_blending=args.tile_blending,
+                          gpu_device=args.gpu_device)
+    predictor.predict_to_dir(image_paths, args.output_dir, mask_paths=mask_paths, threshold=args.threshold,
+                             output_format=args.output_format)
+    predictor.close()
@@ -15,6 +15,7 @@ if __name__ == '__main__':
     metrics_epoch_freq = 5
     viz_layer_epoch_freq = 101
     n_epochs = 20
+    early_stopping_patience = 2
 
     WRK_DIR_PATH = "/home/ubuntu/new_vessel_segmentation/vessel-segmentation/drive"
     n_splits = 3
@@ -70,6 +71,7 @@ if __name__ == '__main__':
 
         job = DriveJob(OUTPUTS_DIR_PATH=OUTPUTS_DIR_PATH)
         job.run_cv(WRK_DIR_PATH=WRK_DIR_PATH, mc=True, early_stopping=True, early_stopping_metric="auc",
+                   early_stopping_patience=early_stopping_patience,
                    save_model=False, save_sample_test_images=False,
                    metrics_epoch_freq=metrics_epoch_freq, viz_layer_epoch_freq=viz_layer_epoch_freq,
                    n_epochs=n_epochs, n_splits=n_splits, objective_fn=objective_fn,
@@ -0,0 +1,34 @@
+"""Output shapes of a `SmallNetwork` and a `LargeNetwork` for any batch size"""
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from network.drive import DriveNetwork
+from network.dsa import DsaNetwork
+
+# few channels and small patches, so the networks are built and run in a moment
+SMALL_LAYER_PARAMS = dict([(name, {"output_channels": 4}) for name in ("conv_1_1", "conv_2_1", "conv_3_1", "conv_3_2",
+                                                                       "convt_5_2", "convt_6_1", "convt_6_2",
+                                                                       "convt_7_1")] +
+                          [(name, {"output_channels": 8}) for name in ("conv_4_1", "conv_4_2", "convt_5_1")])
+LARGE_LAYER_PARAMS = dict((name, {"output_channels": 4}) for name in (
+    "conv_1_1", "conv_2_1", "conv_3_1", "conv_3_2", "conv_4_1", "conv_4_2", "conv_5_1", "conv_5_2", "conv_6_1",
+    "conv_6_2", "convt_7_1", "convt_7_2", "convt_8_1", "convt_8_2", "convt_9_1", "convt_9_2", "convt_10_1",
+    "convt_10_2", "convt_11_1"))
+
+
+@pytest.mark.parametrize("network_cls, patch_size, layer_params", [(DriveNetwork, 32, SMALL_LAYER_PARAMS),
+                                                                   (DsaNetwork, 64, LARGE_LAYER_PARAMS)])
+def test_output_shape(network_cls, patch_size, layer_params):
+    with tf.Graph().as_default():
+        network = network_cls(pos_weight=1.0, patch_size=(patch_size, patch_size), layer_params=layer_params)
+        random_state = np.random.RandomState(0)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            for batch_size in (1, 4, 16):
+                shape = (batch_size, patch_size, patch_size, 1)
+                feed_dict = {network.inputs: random_state.rand(*shape), network.targets: np.zeros(shape)}
+                if network.mask:
+                    feed_dict[network.masks] = np.ones(shape)
+                assert sess.run(network.segmentation_result, feed_dict=feed_dict).shape == shape
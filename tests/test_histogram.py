@@ -0,0 +1,57 @@
+"""Score bins of the host-side and the in-graph histograms on bin edges"""
+from fractions import Fraction
+import numpy as np
+import pytest
+
+from metrics.histogram import ScoreHistogram, get_score_bins, get_max_threshold_accuracies, \
+    get_max_threshold_accuracies_from_counts
+
+N_BINS = 10000
+
+
+def get_edge_scores(n_bins=N_BINS):
+    """float32 scores on, just below and just above bin edges, and outside of [0, 1]"""
+    edges = (np.arange(n_bins + 1) / float(n_bins)).astype(np.float32)
+    scores = np.concatenate([edges, np.nextafter(edges, np.float32(-1)), np.nextafter(edges, np.float32(2)),
+                             np.float32([-.5, 1.5])])
+    return scores.astype(np.float32)
+
+
+def test_bins_are_exact():
+    scores = get_edge_scores()
+    for score, score_bin in zip(scores, get_score_bins(scores, N_BINS)):
+        score, score_bin = min(max(Fraction(float(score)), 0), 1), int(score_bin)
+        assert Fraction(score_bin - 1, N_BINS) < score <= Fraction(score_bin, N_BINS) or score == score_bin == 0
+
+
+def test_max_threshold_accuracy_bins_like_histogram():
+    scores = get_edge_scores()
+    targets = (np.random.RandomState(0).rand(len(scores)) > .5).astype(np.float32)
+    accuracies, thresholds = get_max_threshold_accuracies(scores[np.newaxis], targets[np.newaxis], [.5], [.5],
+                                                          n_bins=N_BINS)
+    counts = ScoreHistogram(n_bins=N_BINS).add(scores, targets).counts
+    expected_accuracies, expected_thresholds = get_max_threshold_accuracies_from_counts(counts[np.newaxis, 1], [.5],
+                                                                                        [.5])
+    np.testing.assert_array_equal(accuracies, expected_accuracies)
+    np.testing.assert_array_equal(thresholds, expected_thresholds)
+
+
+def test_graph_histogram_matches_host_histogram():
+    tf = pytest.importorskip("tensorflow")
+    from network.base import Network
+
+    class HistogramNetwork(object):
+        metrics_n_bins = N_BINS
+
+    scores = get_edge_scores()
+    random_state = np.random.RandomState(0)
+    targets = (random_state.rand(len(scores)) > .5).astype(np.float32)
+    masks = (random_state.rand(len(scores)) > .2).astype(np.float32)
+    shape = (1, len(scores), 1, 1)
+    with tf.Graph().as_default():
+        counts = Network.get_score_histogram(HistogramNetwork(), tf.constant(scores.reshape(shape)),
+                                             tf.constant(targets.reshape(shape)), tf.constant(masks.reshape(shape)))
+        with tf.Session() as sess:
+            graph_counts = sess.run(counts)[0]
+    host_counts = ScoreHistogram(n_bins=N_BINS).add(scores, targets, masks).counts
+    np.testing.assert_array_equal(graph_counts, host_counts)
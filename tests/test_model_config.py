@@ -0,0 +1,23 @@
+"""Keyword arguments of a run written to and read back from the json model config"""
+import json
+import collections
+import numpy as np
+import pytest
+
+from utilities.misc import get_json_serializable, from_json_serializable
+
+
+def test_round_trip():
+    network_kwargs = {"learning_rate_and_kwargs": (.001, {"decay_epochs": np.int64(10)}),
+                      "encoder_model": collections.OrderedDict, "act_fn": np.maximum, "pos_weight": np.float32(2.5),
+                      "weight_init": None}
+    loaded = from_json_serializable(json.loads(json.dumps(get_json_serializable(network_kwargs))))
+    assert loaded == {"learning_rate_and_kwargs": [.001, {"decay_epochs": 10}],
+                      "encoder_model": collections.OrderedDict, "act_fn": np.maximum, "pos_weight": 2.5,
+                      "weight_init": None}
+
+
+@pytest.mark.parametrize("value", [object(), lambda x: x])
+def test_unserializable_values_raise(value):
+    with pytest.raises(TypeError, match="layers"):
+        get_json_serializable({"layers": [value]}, "network_kwargs")
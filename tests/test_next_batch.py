@@ -0,0 +1,47 @@
+"""Order of the training images in batches without SGD"""
+import numpy as np
+import pytest
+
+pytest.importorskip("imgaug")
+pytest.importorskip("cv2")
+
+from dataset.base import Dataset
+
+
+class OrderedDataset(Dataset):
+    """`Dataset` over in-memory images whose pixels hold their index, skipping all file loading"""
+
+    def __init__(self, num_images=5, batch_size=2, patch_size=None):
+        self.batch_size = batch_size
+        self.sgd = False
+        self.seq = None
+        images = np.tile(np.arange(num_images, dtype=np.float32)[:, np.newaxis, np.newaxis], (1, 8, 8))
+        self.train_data = (images, np.ones_like(images), np.zeros_like(images))
+        self.pointer = 0
+        self.num_batch_buffers = 1
+        self.batch_buffers = None
+        self.patch_size = (patch_size, patch_size) if patch_size is not None else None
+        self.patch_sampling = "random"
+        self.vessel_oversample = 0.0
+        self.patch_center_candidates = {}
+
+    def get_pads(self):
+        return 0, 0, 0, 0
+
+
+def get_image_ids(dataset, num_batches):
+    return [list(dataset.next_batch(np.random.RandomState(0))[0][:, 0, 0].astype(int)) for _ in range(num_batches)]
+
+
+def test_whole_image_batches_restart_every_epoch():
+    dataset = OrderedDataset(num_images=5, batch_size=2)
+    assert dataset.num_batches_in_epoch() == 2
+    # the image left over at the end of a pass is skipped, as with `reset_batch_pointer`
+    assert get_image_ids(dataset, 4) == [[0, 1], [2, 3], [0, 1], [2, 3]]
+    dataset.reset_batch_pointer()
+    assert get_image_ids(dataset, 1) == [[0, 1]]
+
+
+def test_patch_batches_cycle_through_the_images():
+    dataset = OrderedDataset(num_images=3, batch_size=2, patch_size=4)
+    assert get_image_ids(dataset, 3) == [[0, 1], [2, 0], [1, 2]]
@@ -0,0 +1,31 @@
+"""Combined predictions of a `PredictionStore` against the predictions of the runs held in memory"""
+import os
+import numpy as np
+import pytest
+
+from job.prediction_store import PredictionStore
+
+
+def save_runs(store_dir, predictions, mask_flat=None):
+    store = PredictionStore(store_dir)
+    run_names = []
+    for run_i, run_predictions in enumerate(predictions):
+        run_name = "run_{}".format(run_i)
+        writer = store.open_epoch(run_name, 0, len(run_predictions), mask_flat=mask_flat, fill_value=.5)
+        writer.write(run_predictions)
+        writer.close()
+        run_names.append(run_name)
+    return store, run_names
+
+
+@pytest.mark.parametrize("memory_budget", [1 << 28, 4 * 7])
+@pytest.mark.parametrize("trim", [1, 2])
+def test_trimmed_mean_in_blocks(tmpdir, memory_budget, trim):
+    random_state = np.random.RandomState(0)
+    predictions = random_state.rand(6, 25).astype(np.float16).astype(np.float32)
+    mask_flat = random_state.rand(25) > .3
+    store, run_names = save_runs(os.path.join(str(tmpdir), "predictions"), predictions, mask_flat)
+    combined = store.combine(run_names, 0, combining_metric="trimmed_mean", trim=trim, memory_budget=memory_budget)
+    expected = np.sort(predictions, 0)[trim:-trim].mean(0)
+    np.testing.assert_allclose(combined[mask_flat], expected[mask_flat], rtol=1e-6)
+    np.testing.assert_array_equal(combined[~mask_flat], .5)
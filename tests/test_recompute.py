@@ -0,0 +1,56 @@
+"""Batch norm moving statistics of training steps with and without activation recomputation"""
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from network.drive import DriveNetwork
+
+PATCH_SIZE = 32
+# a `SmallNetwork` with few channels, so a training step runs in a moment
+LAYER_PARAMS = dict([(name, {"output_channels": 4}) for name in ("conv_1_1", "conv_2_1", "conv_3_1", "conv_3_2",
+                                                                 "convt_5_2", "convt_6_1", "convt_6_2", "convt_7_1")] +
+                    [(name, {"output_channels": 8}) for name in ("conv_4_1", "conv_4_2", "convt_5_1")])
+BATCH_NORM_LAYERS = ("conv_1_1", "conv_3_2", "conv_4_1", "convt_5_2", "convt_7_1")
+
+
+def get_values(sess, layers):
+    values = []
+    for name in BATCH_NORM_LAYERS:
+        batch_norm_values = layers[name].get_batch_norm_values(sess, 1)
+        values += [batch_norm_values["moving_mean"], batch_norm_values["moving_variance"]]
+    return values
+
+
+def get_moving_statistics(recompute_segments, num_steps=2):
+    """Moving means and variances of the first batch norms of `BATCH_NORM_LAYERS` before and after `num_steps` training
+    steps from the same weights on the same batch"""
+    with tf.Graph().as_default():
+        network = DriveNetwork(pos_weight=1.0, patch_size=(PATCH_SIZE, PATCH_SIZE), layer_params=LAYER_PARAMS,
+                               recompute_segments=recompute_segments)
+        layers = dict((layer.name, layer) for layer in network.encoder + network.decoder)
+        random_state = np.random.RandomState(0)
+        shape = (2, PATCH_SIZE, PATCH_SIZE, 1)
+        feed_dict = {network.inputs: random_state.rand(*shape), network.masks: np.ones(shape),
+                     network.targets: (random_state.rand(*shape) > .9).astype(np.float32), network.is_training: True}
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            # variables are created in the same order with and without recomputation
+            for variable in tf.trainable_variables():
+                variable.load(random_state.normal(0.0, .1, variable.get_shape().as_list()), sess)
+            initial = get_values(sess, layers)
+            for _ in range(num_steps):
+                sess.run(network.train_op, feed_dict=feed_dict)
+            return initial, get_values(sess, layers)
+
+
+@pytest.mark.parametrize("recompute_segments", [1, 3, ["pool_2", "up_7"]])
+def test_moving_statistics_match_without_recomputation(recompute_segments):
+    initial, updated = get_moving_statistics(None)
+    recomputed_initial, recomputed_updated = get_moving_statistics(recompute_segments)
+    for value, recomputed_value in zip(initial, recomputed_initial):
+        np.testing.assert_allclose(recomputed_value, value)
+    for value, updated_value, recomputed_value in zip(initial, updated, recomputed_updated):
+        # the statistics are updated once per step, not a second time by the recomputation
+        assert not np.allclose(updated_value, value)
+        np.testing.assert_allclose(recomputed_value, updated_value, rtol=1e-4, atol=1e-6)
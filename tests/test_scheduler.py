@@ -0,0 +1,18 @@
+"""Members run by the `MemberScheduler` in the calling process"""
+import pytest
+
+from job.scheduler import MemberScheduler
+
+
+def test_in_process_members_run_in_order():
+    runs = []
+    scheduler = MemberScheduler(lambda i: runs.append(i), in_process=True)
+    for i in range(3):
+        scheduler.add("member_{}".format(i), {"i": i})
+    scheduler.run()
+    assert runs == [0, 1, 2]
+
+
+def test_in_process_members_are_not_concurrent():
+    with pytest.raises(ValueError):
+        MemberScheduler(lambda: None, max_concurrent=2, in_process=True)
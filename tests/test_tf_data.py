@@ -0,0 +1,98 @@
+"""Samples of the `tf_data` input pipeline against the dataset arrays they are read from"""
+import os
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from dataset.array_view import normalize_images, take_images
+from dataset.tf_data import TFDataPipeline, random_flip_aug
+from utilities.cache_ops import save_packed_arrays, load_packed_arrays
+
+
+class ArrayDataset(object):
+    tf_aug = None
+    seq = None
+
+
+def get_arrays():
+    random_state = np.random.RandomState(0)
+    images = np.round(random_state.rand(6, 8, 10) * 255) / 255
+    targets = (random_state.rand(6, 8, 10) > .5).astype(np.float32)
+    return images.astype(np.float32), targets
+
+
+def read_all(data, batch_size=4):
+    with tf.Graph().as_default():
+        pipeline = TFDataPipeline(ArrayDataset(), data, batch_size=batch_size)
+        iterator = pipeline.tf_dataset.make_initializable_iterator()
+        next_batch = iterator.get_next()
+        batches = []
+        with tf.Session() as sess:
+            sess.run(iterator.initializer, feed_dict=pipeline.get_feed_dict(ArrayDataset(), data))
+            while True:
+                try:
+                    batches.append(sess.run(next_batch))
+                except tf.errors.OutOfRangeError:
+                    break
+    return [np.concatenate(arrs)[..., 0] for arrs in zip(*batches)]
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_split_and_normalization(tmpdir, packed):
+    data = get_arrays()
+    if packed:
+        packed_dir = os.path.join(str(tmpdir), "packed")
+        save_packed_arrays(packed_dir, data)
+        data = load_packed_arrays(packed_dir)
+    indices = np.array([1, 2, 4])
+    views = [take_images(normalize_images(data[0], 2.0, -1.0), indices), take_images(data[1], indices)]
+    for result, view in zip(read_all(views), views):
+        np.testing.assert_allclose(result, np.asarray(view), atol=1e-3)
+
+
+def test_refeed_without_new_ops():
+    data = get_arrays()
+    other_data = [arr[::-1].copy() for arr in data]
+    with tf.Graph().as_default() as graph:
+        pipeline = TFDataPipeline(ArrayDataset(), data, batch_size=6)
+        iterator = pipeline.tf_dataset.make_initializable_iterator()
+        next_batch = iterator.get_next()
+        num_ops = len(graph.get_operations())
+        with tf.Session() as sess:
+            for arrays in (data, other_data, data):
+                sess.run(iterator.initializer, feed_dict=pipeline.get_feed_dict(ArrayDataset(), arrays))
+                batch = sess.run(next_batch)
+                for result, arr in zip(batch, arrays):
+                    np.testing.assert_array_equal(result[..., 0], arr)
+        assert len(graph.get_operations()) == num_ops
+
+
+class PaddedDataset(ArrayDataset):
+    """Images padded to the network input, labels at the image size, like DRIVE (584x584 and 584x565)"""
+    tf_aug = staticmethod(random_flip_aug)
+
+    @staticmethod
+    def get_pads():
+        return 1, 0, 1, 2
+
+
+def test_tf_aug_keeps_labels_aligned():
+    random_state = np.random.RandomState(0)
+    contents = random_state.rand(6, 7, 7).astype(np.float32)
+    images = np.pad(contents, [(0, 0), (1, 0), (1, 2)], mode="constant")
+    targets = (contents > .5).astype(np.float32)
+    with tf.Graph().as_default():
+        pipeline = TFDataPipeline(PaddedDataset(), (images, targets), batch_size=6, repeat=True, augment=True, seed=0)
+        iterator = pipeline.tf_dataset.make_initializable_iterator()
+        next_batch = iterator.get_next()
+        with tf.Session() as sess:
+            sess.run(iterator.initializer, feed_dict=pipeline.get_feed_dict(PaddedDataset(), (images, targets)))
+            flipped = False
+            for _ in range(8):
+                image_batch, target_batch = sess.run(next_batch)
+                assert image_batch.shape[1:3] == (8, 10) and target_batch.shape[1:3] == (7, 7)
+                # the labels are those of the image pixels the network output is cropped to
+                np.testing.assert_array_equal(target_batch[..., 0], image_batch[:, 1:, 1:8, 0] > .5)
+                flipped = flipped or not np.array_equal(target_batch[..., 0], targets)
+    assert flipped
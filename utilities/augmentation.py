@@ -11,6 +11,16 @@ def apply_image_aug(images, seq_det, masks=False):
     return [np.squeeze(image, axis=2) * 1.0 / 255.0 for image in images]
 
 
+def augment_uint8_images(images, seq_det, masks=False):
+    """Augment a uint8 batch of shape [batch, height, width] without converting it to floats"""
+    images = images[..., np.newaxis]
+    if masks:
+        images = seq_det.augment_images(images, hooks=get_hooks_binmasks())
+    else:
+        images = seq_det.augment_images(images)
+    return np.asarray(images)[..., 0]
+
+
 # change the activated augmenters for binary masks,
 def activator_binmasks(images, augmenter, parents, default):
     if augmenter.name in ["GaussianBlur", "Dropout", "GaussianNoise"]:
@@ -0,0 +1,94 @@
+"""Helpers for caching decoded and pre-processed dataset arrays on disk"""
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+
+def hash_dir_contents(DIR_PATH, hasher, chunk_size=1 << 20):
+    """Update `hasher` with the relative path and content of every file below `DIR_PATH`"""
+    for root, dirs, files in os.walk(DIR_PATH):
+        # walk in a deterministic order
+        dirs.sort()
+        for file_name in sorted(files):
+            file_path = os.path.join(root, file_name)
+            hasher.update(os.path.relpath(file_path, DIR_PATH).encode("utf-8"))
+            with open(file_path, "rb") as f:
+                chunk = f.read(chunk_size)
+                while chunk:
+                    hasher.update(chunk)
+                    chunk = f.read(chunk_size)
+    return hasher
+
+
+def get_cache_key(DIR_PATH, params):
+    """Produce a key from the source file contents in `DIR_PATH` and the (json serializable) `params`"""
+    hasher = hashlib.sha1()
+    hasher.update(json.dumps(params, sort_keys=True, default=str).encode("utf-8"))
+    hash_dir_contents(DIR_PATH, hasher)
+    return hasher.hexdigest()
+
+
+def load_cached_arrays(cache_path):
+    with np.load(cache_path) as data:
+        return tuple(data["arr_{}".format(i)] for i in range(len(data.files)))
+
+
+def save_cached_arrays(cache_path, arrays):
+    cache_dir = os.path.dirname(cache_path)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # write to a temporary file first so concurrent jobs never read a partially written cache entry
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.savez(f, *[np.asarray(arr) for arr in arrays])
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # another job already produced the same entry
+        os.remove(tmp_path)
+
+
+def get_packed_dtype(arr):
+    """Labels (integral values in [0, 255]) are packed as uint8, everything else as float16"""
+    arr = np.asarray(arr)
+    if arr.size and arr.min() >= 0 and arr.max() <= 255 and np.array_equal(arr, np.round(arr)):
+        return np.uint8
+    return np.float16
+
+
+def save_packed_arrays(packed_dir, arrays):
+    """Write each array as one contiguous raw file, described by an `index.json`"""
+    parent_dir = os.path.dirname(packed_dir)
+    if not os.path.exists(parent_dir):
+        os.makedirs(parent_dir)
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir, suffix=".tmp")
+    index = {"arrays": []}
+    for i, arr in enumerate(arrays):
+        arr = np.asarray(arr)
+        file_name = "arr_{}.dat".format(i)
+        dtype = np.dtype(get_packed_dtype(arr))
+        packed_arr = np.memmap(os.path.join(tmp_dir, file_name), dtype=dtype, mode="w+", shape=arr.shape)
+        packed_arr[...] = arr
+        packed_arr.flush()
+        del packed_arr
+        index["arrays"].append({"file": file_name, "dtype": dtype.name,
+                                "shape": list(arr.shape)})
+    with open(os.path.join(tmp_dir, "index.json"), "w") as f:
+        json.dump(index, f)
+    try:
+        os.rename(tmp_dir, packed_dir)
+    except OSError:
+        # another job already produced the same entry
+        for file_name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, file_name))
+        os.rmdir(tmp_dir)
+
+
+def load_packed_arrays(packed_dir, mode="r"):
+    """Open the arrays written by `save_packed_arrays` as read-only memory maps"""
+    with open(os.path.join(packed_dir, "index.json")) as f:
+        index = json.load(f)
+    return tuple(np.memmap(os.path.join(packed_dir, entry["file"]), dtype=entry["dtype"], mode=mode,
+                           shape=tuple(entry["shape"])) for entry in index["arrays"])
@@ -20,6 +20,19 @@ def preprocessing(img, histo_eq=False, clahe_kwargs=None, gamma=None, per_image_
         img = apply_per_image_zero_center_scale(img)
     return img
 
+def preprocess_green_channel(image_arr, pads, hist_eq=None, clahe_kwargs=None, gamma=None,
+                             per_image_z_score_norm=False, per_image_zero_center=False,
+                             per_image_zero_center_scale=False):
+    """Pad the green channel of a decoded BGR retinal image to the network input, pre-process it and scale it to [0, 1]"""
+    top_pad, bot_pad, left_pad, right_pad = pads
+    grn_chnl_arr = image_arr[:, :, 1]
+    grn_chnl_arr = cv2.copyMakeBorder(grn_chnl_arr, top_pad, bot_pad, left_pad, right_pad, cv2.BORDER_CONSTANT, 0)
+    grn_chnl_arr = preprocessing(grn_chnl_arr, histo_eq=hist_eq, clahe_kwargs=clahe_kwargs, gamma=gamma,
+                                 per_image_z_score_norm=per_image_z_score_norm,
+                                 per_image_zero_center=per_image_zero_center,
+                                 per_image_zero_center_scale=per_image_zero_center_scale)
+    return grn_chnl_arr * 1.0 / 255.0
+
 def histo_equalized(img):
     img_equalized = cv2.equalizeHist(np.array(img, dtype = np.uint8))
     return img_equalized
@@ -56,37 +69,60 @@ def apply_per_image_zero_center_scale(img):
     print("per image zero center scale mean {} min {} max {}".format(img_mean, min_val, max_val))
     return 2*(img - min_val)/(max_val-min_val)-1
 
-def apply_dataset_normalization(imgs, zero_center=False, zero_center_scale=False, z_score_norm=False, train_params=None):
-    """If training, calculate results on train data. otherwise use test data"""
+def get_dataset_stats(imgs):
+    """Mean, std, min and max over all pixels of `imgs`, one image at a time so a memory-mapped `imgs` is never loaded
+    whole"""
+    num_pixels = 0
+    total = 0.0
+    min_val, max_val = np.inf, -np.inf
+    for img in imgs:
+        img = np.asarray(img, dtype=np.float64)
+        num_pixels += img.size
+        total += img.sum()
+        min_val, max_val = min(min_val, img.min()), max(max_val, img.max())
+    mu = total / num_pixels
+    squares = sum(np.square(np.asarray(img, dtype=np.float64) - mu).sum() for img in imgs)
+    return mu, np.sqrt(squares / num_pixels), min_val, max_val
+
+
+def get_dataset_normalization(imgs, zero_center=False, zero_center_scale=False, z_score_norm=False, train_params=None):
+    """`(scale, shift, params)` of the dataset normalization `imgs * scale + shift`. If training (no `train_params`),
+    the params are calculated on `imgs`, otherwise those of the train data are used"""
+    if not (zero_center or zero_center_scale or z_score_norm):
+        return 1.0, 0.0, None
+    if not train_params:
+        mu, std, min_val, max_val = get_dataset_stats(imgs)
     if zero_center or zero_center_scale:
         # zero center by train mean and scale by [-1,1]
         if not train_params:
-            mu = np.mean(imgs)
             print("zc train: re-calculate mean {}".format(mu))
         else:
             mu = train_params[0]
             print("zc test: use train params mu {}".format(mu))
-        zero_centered = imgs - mu
         if zero_center_scale:
             if not train_params:
-                min_val = np.min(zero_centered)
-                max_val = np.max(zero_centered)
+                min_val, max_val = min_val - mu, max_val - mu
                 print("zcs train: re-calculate min {} max {}".format(min_val, max_val))
             else:
                 min_val = train_params[1]
                 max_val = train_params[2]
                 print("zcs test: use train params min {} max {}".format(min_val, max_val))
-            return 2*(zero_centered-min_val)/(max_val-min_val)-1, (mu, min_val, max_val)
-        else:
-            return zero_centered, (mu,)
-    elif z_score_norm:
-        # normalize by z-score from train data
-        if not train_params:
-            mu, std = np.mean(imgs), np.std(imgs)
-            print("zcn train: re-calculate values mean {} std {}".format(mu,std))
-        else:
-            mu, std = train_params
-            print("zcn test: use train params mean {} std {}".format(mu,std))
-        return (imgs - mu)/std, (mu, std)
+            scale = 2.0 / (max_val - min_val)
+            return scale, -(mu + min_val) * scale - 1, (mu, min_val, max_val)
+        return 1.0, -mu, (mu,)
+    # normalize by z-score from train data
+    if not train_params:
+        print("zcn train: re-calculate values mean {} std {}".format(mu, std))
     else:
+        mu, std = train_params
+        print("zcn test: use train params mean {} std {}".format(mu, std))
+    return 1.0 / std, -mu / std, (mu, std)
+
+
+def apply_dataset_normalization(imgs, zero_center=False, zero_center_scale=False, z_score_norm=False, train_params=None):
+    """If training, calculate results on train data. otherwise use test data"""
+    scale, shift, params = get_dataset_normalization(imgs, zero_center=zero_center, zero_center_scale=zero_center_scale,
+                                                     z_score_norm=z_score_norm, train_params=train_params)
+    if params is None:
         return imgs, None
+    return np.asarray(imgs) * scale + shift, params
@@ -1,4 +1,9 @@
+import os
+import tempfile
 import numpy as np
+import json
+import inspect
+import importlib
 from itertools import groupby
 import collections
 
@@ -41,4 +46,92 @@ def update(d, u):
             d[k] = update(d.get(k, {}), v)
         else:
             d[k] = v
-    return d
\ No newline at end of file
+    return d
+
+CALLABLE_KEY = "__callable__"
+
+
+def get_callable_name(obj):
+    """`module:qualname` of a class or function, checked to lead back to `obj`"""
+    name = "{}:{}".format(obj.__module__, getattr(obj, "__qualname__", obj.__name__))
+    try:
+        resolved = load_callable(name)
+    except (ImportError, AttributeError):
+        resolved = None
+    if resolved is not obj:
+        raise TypeError("{!r} can't be found again by its name {}".format(obj, name))
+    return name
+
+
+def load_callable(name):
+    module_name, qualname = name.split(":")
+    obj = importlib.import_module(module_name)
+    for attr in qualname.split("."):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def get_json_serializable(value, path="value"):
+    """`value` (e.g. the keyword arguments of a run) in a form json can write: numpy values become python values and
+    classes and functions `{"__callable__": "module:qualname"}`, which `from_json_serializable` resolves again. Raises
+    a `TypeError` naming the entry (`path`) for anything else json can't write, e.g. objects"""
+    if isinstance(value, dict):
+        return dict((key, get_json_serializable(item, "{}[{!r}]".format(path, key))) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [get_json_serializable(item, "{}[{}]".format(path, i)) for i, item in enumerate(value)]
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    if inspect.isclass(value) or callable(value) and hasattr(value, "__name__"):
+        try:
+            return {CALLABLE_KEY: get_callable_name(value)}
+        except TypeError as e:
+            raise TypeError("{}: {}".format(path, e))
+    try:
+        json.dumps(value)
+    except (TypeError, ValueError):
+        raise TypeError("{} = {!r} can't be written to json".format(path, value))
+    return value
+
+
+def from_json_serializable(value):
+    """Undo `get_json_serializable`: load the classes and functions it stored by name"""
+    if isinstance(value, dict):
+        if list(value.keys()) == [CALLABLE_KEY]:
+            return load_callable(value[CALLABLE_KEY])
+        return dict((key, from_json_serializable(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [from_json_serializable(item) for item in value]
+    return value
+
+
+def get_init_arg_names(cls):
+    """Names of the arguments of the `__init__` of `cls` and of its bases"""
+    get_argspec = getattr(inspect, "getfullargspec", None) or inspect.getargspec
+    arg_names = set()
+    for klass in inspect.getmro(cls):
+        init = klass.__dict__.get("__init__")
+        if inspect.isfunction(init):
+            arg_names.update(get_argspec(init).args)
+    arg_names.discard("self")
+    return arg_names
+
+
+def make_dirs(path):
+    """`os.makedirs` that accepts an existing directory, e.g. created meanwhile by a concurrent job"""
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def save_array_once(path, arr):
+    """Write `arr` to the `.npy` file `path` unless it exists. It is written to a temporary file first, so concurrent
+    jobs never read a partially written file"""
+    if os.path.exists(path):
+        return
+    make_dirs(os.path.dirname(path))
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.save(f, arr)
+    os.rename(tmp_path, path)
@@ -51,7 +51,8 @@ def generalised_dice_loss(prediction, ground_truth, weight_map=None, type_weight
         weights = tf.ones_like(ref_vol)
     elif type_weight == "Custom":
         # TODO: why reduce the sum by batch? applicable above as well
-        weights = ref_vol * tf.constant([1,pos_weight])
+        # `pos_weight` may be a tensor
+        weights = ref_vol * tf.convert_to_tensor([1.0, pos_weight], dtype=tf.float32)
     else:
         raise ValueError("The variable type_weight \"{}\""
                          "is not defined.".format(type_weight))
@@ -112,7 +113,8 @@ def sensitivity_specificity_loss(prediction, ground_truth, weight_map=None, r=0.
     squared_error = tf.square(one_hot - prediction)
 
     return tf.reduce_sum(tf.reduce_sum(squared_error * one_hot, [0,1,2]) /
-                         (tf.reduce_sum(one_hot, [0,1,2]) + epsilon_denominator) * tf.constant([1-r,r]))
+                         (tf.reduce_sum(one_hot, [0,1,2]) + epsilon_denominator) *
+                         tf.convert_to_tensor([1 - r, r], dtype=tf.float32))
 
 
 def dice(prediction, ground_truth, weight_map=None, pos_weight=1, **kwargs):
@@ -6,7 +6,7 @@ import cv2
 import os
 import io
 
-from utilities.misc import find_closest_pos
+from utilities.misc import find_closest_pos, make_dirs
 
 # assume this is square
 # TODO: return statistics on target image correlationn
@@ -58,7 +58,6 @@ def draw_results(test_inputs, test_targets, test_segmentations, test_accuracy, n
     plt.savefig(buf, format='png')
     buf.seek(0)
 
-    if not os.path.exists(IMAGE_PLOT_DIR):
-        os.makedirs(IMAGE_PLOT_DIR)
+    make_dirs(IMAGE_PLOT_DIR)
     plt.savefig('{}/figure{}.jpg'.format(IMAGE_PLOT_DIR, epoch_num))
     return buf
\ No newline at end of file
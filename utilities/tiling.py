@@ -0,0 +1,93 @@
+"""Helpers for cutting images into patches and stitching patch results back together"""
+import numpy as np
+
+
+def get_tile_offsets(length, tile_length, overlap=0):
+    """Start offsets of tiles of `tile_length`, overlapping by at least `overlap`, covering `length`. The last tile is
+    flush with the end"""
+    if tile_length > length:
+        raise ValueError("Tile length {} exceeds image length {}".format(tile_length, length))
+    if not 0 <= overlap < tile_length:
+        raise ValueError("Tile overlap {} has to be in [0, {})".format(overlap, tile_length))
+    offsets = list(range(0, length - tile_length, tile_length - overlap))
+    return offsets + [length - tile_length]
+
+
+def get_tile_grid(height, width, tile_size, overlap=0):
+    """(row, column) offsets of the tiles covering a `height` x `width` image"""
+    tile_height, tile_width = tile_size
+    return [(row, col) for row in get_tile_offsets(height, tile_height, overlap)
+            for col in get_tile_offsets(width, tile_width, overlap)]
+
+
+def get_tile_batches(tile_grid, batch_size=None):
+    """Split `tile_grid` into chunks of at most `batch_size` tiles, all tiles at once if `batch_size` is None"""
+    if batch_size is None:
+        return [tile_grid]
+    return [tile_grid[i:i + batch_size] for i in range(0, len(tile_grid), batch_size)]
+
+
+def get_blending_weights(tile_size, blending=None, min_weight=1e-3):
+    """Per-pixel weights of a tile. `gaussian` and `cosine` weights fade towards the tile borders, so overlapping tiles
+    blend smoothly; `None` weights all pixels equally, i.e. overlaps are averaged"""
+    if blending is None:
+        return np.ones(tile_size, dtype=np.float32)
+    windows = []
+    for length in tile_size:
+        x = np.arange(length) + .5
+        if blending == "gaussian":
+            window = np.exp(-(x - length / 2.0) ** 2 / (2 * (length / 8.0) ** 2))
+        elif blending == "cosine":
+            window = .5 - .5 * np.cos(2 * np.pi * x / length)
+        else:
+            raise ValueError("Tile blending {} not recognized".format(blending))
+        windows.append(window)
+    weights = np.outer(*windows)
+    # pixels covered by a single tile (e.g. at the image border) still need a non-zero weight
+    return np.maximum(weights / weights.max(), min_weight).astype(np.float32)
+
+
+def extract_patches(arr, image_indices, row_offsets, col_offsets, patch_size, out=None):
+    """Gather the patches starting at (`row_offsets`, `col_offsets`) of the images `image_indices` of `arr` with a
+    single fancy indexing operation"""
+    rows = np.asarray(row_offsets)[:, np.newaxis] + np.arange(patch_size[0])
+    cols = np.asarray(col_offsets)[:, np.newaxis] + np.arange(patch_size[1])
+    patches = arr[np.asarray(image_indices)[:, np.newaxis, np.newaxis], rows[:, :, np.newaxis], cols[:, np.newaxis, :]]
+    if out is None:
+        return patches
+    np.copyto(out, patches, casting="unsafe")
+    return out
+
+
+def extract_tiles(image, tile_grid, tile_size, row_pad=0, col_pad=0):
+    """Cut the tiles of `tile_grid` out of a single image, shifted by the padding of padded inputs"""
+    row_offsets, col_offsets = zip(*tile_grid)
+    return extract_patches(image[np.newaxis], np.zeros(len(tile_grid), dtype=np.int64),
+                           np.asarray(row_offsets) + row_pad, np.asarray(col_offsets) + col_pad, tile_size)
+
+
+class TileBlender(object):
+    """Accumulates weighted tile results into an image of `shape`, one batch of tiles at a time, so only the image and
+    its weight sum are kept in memory"""
+
+    def __init__(self, shape, tile_size, blending=None):
+        self.tile_size = tuple(tile_size)
+        self.weights = get_blending_weights(self.tile_size, blending)
+        self.image = np.zeros(shape, dtype=np.float32)
+        self.weight_sum = np.zeros(shape, dtype=np.float32)
+
+    def add(self, tiles, tile_grid):
+        tile_height, tile_width = self.tile_size
+        for tile, (row, col) in zip(tiles, tile_grid):
+            self.image[row:row + tile_height, col:col + tile_width] += tile * self.weights
+            self.weight_sum[row:row + tile_height, col:col + tile_width] += self.weights
+
+    def result(self):
+        return self.image / np.maximum(self.weight_sum, np.finfo(np.float32).tiny)
+
+
+def stitch_tiles(tiles, tile_grid, shape, blending=None):
+    """Place the tiles back into an image of `shape`, blending the overlaps"""
+    blender = TileBlender(shape, tiles.shape[1:3], blending=blending)
+    blender.add(tiles, tile_grid)
+    return blender.result()